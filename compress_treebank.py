@@ -1,9 +1,8 @@
-from collections import deque, defaultdict, Counter
+from collections import deque, defaultdict, Counter, OrderedDict
 from ltag_spinal import SpinalLTAG
 from spinal_loader import UncompressedSpinalLTAGLoader
-import matplotlib.pyplot as plt
-import numpy as np
-import os, pickle, json
+import os, sys, pickle, json, zlib
+from concurrent.futures import ProcessPoolExecutor
 
 def unlexicalized_spine(tree):
     ''' (S (VP (VB ran))) -> (S (VP (VB )))'''
@@ -34,33 +33,236 @@ def partition_trees(trees, partition_func=generalized_tree_representation):
         tree_dict[partition_func(tree)].append(tree)
     return tree_dict
 
-tree_loader = UncompressedSpinalLTAGLoader(filename="output/uncompressed_trees.json")
-trees = tree_loader.load()
-
-grouped = partition_trees(trees)
-
-id_map = {}
-for i, (tree_str, group) in enumerate(grouped.items()):
-    for tree in group:
-        id_map[tree.tree_id] = i
-id_map[None] = None
-
-attach_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-for t in trees:
-    attach_counts[str(id_map[t.parent_id])][str(t.parent_attach_id)][t.label()] += 1
-
-# write one unique tree to a json file for each group
-unique_trees = []
-for tree_str, group in grouped.items():
-    u_tree = group[0]
-    u_tree_id = id_map[u_tree.tree_id]
-    lexicalization = Counter([t.leaves()[0].lower() for t in group])
-    u_attach_counts = attach_counts[str(u_tree_id)]
-    t_dict = {
+class CompressionPartial(object):
+    """
+    Mergeable result of compressing one shard of the uncompressed treebank.
+
+    Groups are numbered in order of first appearance, which is the order a full run numbers them in,
+    and every count is kept in order of first occurrence. Merging partials in shard order therefore
+    gives exactly the output of one run over all shards, in time proportional to the merged partial.
+    A merged partial can also subtract a shard it merged earlier, see ShardMerge
+    """
+    def __init__(self):
+        self.keys = []
+        self.key_ids = {}
+        self.representatives = []
+        self.lexicalizations = []
+        self.tree_groups = {}
+
+        # (parent reference, attach id, child label) -> count. A parent reference is ('group', id)
+        # once the parent tree's group is known, or ('tree', tree_id) until then
+        self.attach_counts = {}
+
+    def __repr__(self):
+        return "<CompressionPartial: %d groups, %d trees, %d attach counts>" % (len(self.keys), len(self.tree_groups), len(self.attach_counts))
+
+    @classmethod
+    def from_trees(cls, trees):
+        partial = cls()
+        partial.add_trees(trees)
+        return partial
+
+    def group_id(self, key, tree_dict):
+        """
+        Returns the group id of a generalized tree key, creating the group with tree_dict as its representative if needed
+        """
+        group = self.key_ids.get(key)
+        if group is None:
+            group = len(self.keys)
+            self.key_ids[key] = group
+            self.keys.append(key)
+            self.representatives.append(tree_dict)
+            self.lexicalizations.append(Counter())
+        return group
+
+    def add_trees(self, trees):
+        grouped = partition_trees(trees)
+        for key, group in grouped.items():
+            u_tree = group[0]
+            group_id = self.group_id(key, representative_dict(u_tree))
+            self.lexicalizations[group_id].update([t.leaves()[0].lower() for t in group])
+            for tree in group:
+                self.tree_groups[tree.tree_id] = group_id
+
+        for t in trees:
+            if t.parent_id is None:
+                continue
+            self.count_attachment(('tree', t.parent_id), str(t.parent_attach_id), t.label(), 1)
+
+    def count_attachment(self, parent, attach_id, label, count):
+        parent = self.resolve(parent)
+        key = (parent, attach_id, label)
+        self.attach_counts[key] = self.attach_counts.get(key, 0) + count
+
+    def resolve(self, parent):
+        if parent[0] == 'tree' and parent[1] in self.tree_groups:
+            return ('group', self.tree_groups[parent[1]])
+        return parent
+
+    def merge(self, other):
+        """
+        Folds the partial of a later shard into this one
+        """
+        group_map = [self.group_id(key, other.representatives[i]) for i, key in enumerate(other.keys)]
+
+        for i, lexicalization in enumerate(other.lexicalizations):
+            self.lexicalizations[group_map[i]].update(lexicalization)
+
+        for tree_id, group in other.tree_groups.items():
+            self.tree_groups[tree_id] = group_map[group]
+
+        # Parents in other shards stay tree references, resolved on output, so that replacing
+        # the shard with the parent tree moves these counts along with it
+        for key, count in self._mapped_attach_counts(other, group_map):
+            self.attach_counts[key] = self.attach_counts.get(key, 0) + count
+        return self
+
+    def subtract(self, other):
+        """
+        Takes out the counts of a partial merged into this one earlier. Its groups keep their ids,
+        and are left out of compressed_trees() while no tree is left in them
+        """
+        group_map = [self.key_ids[key] for key in other.keys]
+
+        for i, lexicalization in enumerate(other.lexicalizations):
+            remaining = self.lexicalizations[group_map[i]]
+            remaining.subtract(lexicalization)
+            self.lexicalizations[group_map[i]] = +remaining
+
+        for tree_id, group in other.tree_groups.items():
+            if self.tree_groups.get(tree_id) == group_map[group]:
+                del self.tree_groups[tree_id]
+
+        for key, count in self._mapped_attach_counts(other, group_map):
+            remaining = self.attach_counts.get(key, 0) - count
+            if remaining > 0:
+                self.attach_counts[key] = remaining
+            else:
+                self.attach_counts.pop(key, None)
+        return self
+
+    def _mapped_attach_counts(self, other, group_map):
+        for (parent, attach_id, label), count in other.attach_counts.items():
+            if parent[0] == 'group':
+                parent = ('group', group_map[parent[1]])
+            yield (parent, attach_id, label), count
+
+    def tree_ids(self):
+        """
+        Returns the tree id written for each group id: groups emptied by subtract() are left out,
+        and the others numbered in order without gaps
+        """
+        tree_ids = {}
+        for group_id, lexicalization in enumerate(self.lexicalizations):
+            if len(lexicalization) > 0:
+                tree_ids[group_id] = len(tree_ids)
+        return tree_ids
+
+    def group_attach_counts(self):
+        """
+        Returns the attachment counts as (parent tree id, attach id, child label) -> count, see tree_ids
+        """
+        tree_ids = self.tree_ids()
+        counts = {}
+        for (parent, attach_id, label), count in self.attach_counts.items():
+            parent = self.resolve(parent)
+            if parent[0] != 'group':
+                raise KeyError("parent tree %s of an attachment is in no shard" % str(parent[1]))
+            if parent[1] not in tree_ids:
+                continue
+            key = (tree_ids[parent[1]], attach_id, label)
+            counts[key] = counts.get(key, 0) + count
+        return counts
+
+    def attachment_matrix(self):
+        """
+        Returns the attachment counts as a spinal_attachment.AttachmentMatrix
+        """
+        from spinal_attachment import AttachmentMatrix, attach_slot
+
+        counts = {}
+        for (tree_id, attach_id, label), count in self.group_attach_counts().items():
+            key = (tree_id, attach_slot(attach_id), label)
+            counts[key] = counts.get(key, 0) + count
+        return AttachmentMatrix(counts)
+
+    def compressed_trees(self):
+        """
+        Returns the list of unique tree dicts written to compressed_trees.json, numbered by tree_ids()
+        """
+        tree_ids = self.tree_ids()
+        attach_counts = [{} for _ in tree_ids]
+        for (tree_id, attach_id, label), count in self.group_attach_counts().items():
+            label_counts = attach_counts[tree_id].setdefault(attach_id, {})
+            label_counts[label] = label_counts.get(label, 0) + count
+
+        unique_trees = []
+        for group_id, tree_id in tree_ids.items():
+            representative = self.representatives[group_id]
+            t_dict = {
+                'spine': representative['spine'],
+                'tree_id': tree_id,
+                'lexicalization': dict(self.lexicalizations[group_id]),
+                'attach_counts': attach_counts[tree_id],
+            }
+            t_dict.update((k, v) for k, v in representative.items() if k != 'spine')
+            unique_trees.append(t_dict)
+        return unique_trees
+
+    def save(self, filename):
+        """
+        Writes this partial as the only record of filename
+        """
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads a partial written by save, or the merged partial of a ShardMerge
+        """
+        with open(filename, 'rb') as f:
+            partial = pickle.load(f)
+        return partial.merged if isinstance(partial, ShardMerge) else partial
+
+class ShardMerge(object):
+    """
+    The partials of named shards, in the order they were first merged, along with their merged partial.
+
+    A new shard is merged into the kept merged partial, and a shard merged again under the same name
+    (a re-extracted section) first has its earlier partial subtracted, so either costs time proportional
+    to that shard alone and nothing is counted twice. Group ids follow the order in which shards were
+    first merged: after a replacement, groups first seen in the new partial are numbered after all the others,
+    so the output only matches a full run numbering for shards merged once, in order
+    """
+    def __init__(self):
+        self.shards = OrderedDict()
+        self.merged = CompressionPartial()
+
+    def __repr__(self):
+        return "<ShardMerge: %d shards, %s>" % (len(self.shards), self.merged)
+
+    def add(self, name, partial):
+        """
+        Merges the partial of shard name, replacing that shard's earlier partial if there is one
+        """
+        if name in self.shards:
+            self.merged.subtract(self.shards[name])
+        self.shards[name] = partial
+        self.merged.merge(partial)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+def representative_dict(u_tree):
+    return {
         'spine': unlexicalized_spine(u_tree),
-        'tree_id': u_tree_id,
-        'lexicalization': dict(lexicalization),
-        'attach_counts': dict(u_attach_counts),
         'tree_type': u_tree.tree_type,
         'predicate': u_tree.predicate,
         'roleset_id': u_tree.roleset_id,
@@ -68,7 +270,154 @@ for tree_str, group in grouped.items():
         'semantic_role': u_tree.semantic_role,
         'rules': [r.to_dict() for r in u_tree.rules],
     }
-    unique_trees.append(t_dict)
 
-with open('output/compressed_trees.json', 'w') as f:
-   f.write(json.dumps(unique_trees))
+def compress_file(filename):
+    tree_loader = UncompressedSpinalLTAGLoader(filename=filename)
+    return CompressionPartial.from_trees(tree_loader.load())
+
+def write_compressed(partial, filename='output/compressed_trees.json'):
+    with open(filename, 'w') as f:
+       f.write(json.dumps(partial.compressed_trees()))
+
+def key_partition(key, partitions):
+    """
+    Stable partition of a generalized tree key, the same in every process (unlike hash())
+    """
+    return zlib.crc32(repr(key).encode('utf-8')) % partitions
+
+def _map_chunk(args):
+    """
+    Map step of the parallel compression, run on one contiguous chunk of tree dicts.
+
+    Returns, for every partition, the (index, key, word, tree id, representative) records of the chunk's trees
+    whose key falls into it, where the representative is only built for the first tree of each key in the chunk,
+    and the chunk's attachment counts as (parent tree id, attach id, label) -> [first index, count]
+    """
+    start, tree_dicts, partitions = args
+    loader = UncompressedSpinalLTAGLoader()
+    buckets = [[] for _ in range(partitions)]
+    seen = set()
+    attachments = {}
+
+    for index, tree_dict in enumerate(tree_dicts, start):
+        tree = loader.parse_ltag_from_dict(tree_dict)
+        key = generalized_tree_representation(tree)
+        representative = None
+        if key not in seen:
+            seen.add(key)
+            representative = representative_dict(tree)
+        buckets[key_partition(key, partitions)].append((index, key, tree.leaves()[0].lower(), tree.tree_id, representative))
+
+        if tree.parent_id is not None:
+            attachment = (tree.parent_id, str(tree.parent_attach_id), tree.label())
+            if attachment not in attachments:
+                attachments[attachment] = [index, 0]
+            attachments[attachment][1] += 1
+
+    return buckets, attachments
+
+def _reduce_partition(records):
+    """
+    Reduce step of the parallel compression: groups the records of one partition, given in index order,
+    into (first index, key, representative, lexicalization, tree ids) tuples
+    """
+    groups = {}
+    for index, key, word, tree_id, representative in records:
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (index, key, representative, Counter(), [])
+        group[3][word] += 1
+        group[4].append(tree_id)
+    return list(groups.values())
+
+def parallel_compress(tree_dicts, workers=None, chunk_size=None, partitions=None):
+    """
+    Compresses a list of uncompressed tree dicts on a process pool and returns the CompressionPartial.
+
+    Chunks of trees are parsed and keyed in parallel, the records are hash-partitioned by generalized key
+    and every partition is grouped in parallel. Groups are then numbered by the index of their first tree
+    and attachments are counted in order of first occurrence, so the result is identical to compress_file
+    """
+    workers = workers or os.cpu_count()
+    partitions = partitions or workers
+    chunk_size = chunk_size or max(1, (len(tree_dicts) + 4 * workers - 1) // (4 * workers))
+    chunks = [(start, tree_dicts[start:start + chunk_size], partitions) for start in range(0, len(tree_dicts), chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        mapped = list(executor.map(_map_chunk, chunks))
+        partition_records = [[record for buckets, _ in mapped for record in buckets[p]] for p in range(partitions)]
+        reduced = list(executor.map(_reduce_partition, partition_records))
+
+    partial = CompressionPartial()
+    for first_index, key, representative, lexicalization, tree_ids in sorted((g for groups in reduced for g in groups), key=lambda g: g[0]):
+        group_id = partial.group_id(key, representative)
+        partial.lexicalizations[group_id] = lexicalization
+        for tree_id in tree_ids:
+            partial.tree_groups[tree_id] = group_id
+
+    # Chunks are in index order, so the first chunk to see an attachment has its first index
+    attachments = {}
+    for _, chunk_attachments in mapped:
+        for attachment, (first_index, count) in chunk_attachments.items():
+            if attachment in attachments:
+                attachments[attachment][1] += count
+            else:
+                attachments[attachment] = [first_index, count]
+
+    for (parent_id, attach_id, label), (_, count) in sorted(attachments.items(), key=lambda a: a[1][0]):
+        partial.count_attachment(('tree', parent_id), attach_id, label, count)
+    return partial
+
+def parallel_compress_file(filename, workers=None, chunk_size=None):
+    with open(filename) as json_file:
+        tree_dicts = json.loads(json_file.read())
+    return parallel_compress(tree_dicts, workers=workers, chunk_size=chunk_size)
+
+def merge_partials(partials):
+    merged = CompressionPartial()
+    for partial in partials:
+        merged.merge(partial)
+    return merged
+
+def shard_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def merge_files(compressed_filename, merged_filename, shard_filenames):
+    """
+    Adds the shard partials, in order, to the ShardMerge in merged_filename (created if missing), naming each
+    by its file name, and writes the compressed trees. See ShardMerge for shards that were merged before
+    """
+    shard_merge = ShardMerge.load(merged_filename) if os.path.exists(merged_filename) else ShardMerge()
+    for filename in shard_filenames:
+        shard_merge.add(shard_name(filename), CompressionPartial.load(filename))
+    shard_merge.save(merged_filename)
+    write_compressed(shard_merge.merged, compressed_filename)
+    return shard_merge
+
+USAGE = """usage:
+    python compress_treebank.py
+        compresses output/uncompressed_trees.json into output/compressed_trees.json
+    python compress_treebank.py parallel [workers]
+        the same, on a pool of worker processes (one per core by default)
+    python compress_treebank.py partial <uncompressed_shard.json> <shard.partial>
+        compresses one shard into a mergeable partial
+    python compress_treebank.py merge <compressed_trees.json> <merged.partial> <shard.partial> ...
+        merges the shard partials, in order, into merged.partial (which is created if missing) and writes
+        the compressed trees. A shard merged before under the same file name replaces its earlier counts
+    python compress_treebank.py attachments <merged.partial> <attachments.pickle>
+        writes the attachment counts of a partial as a sparse AttachmentMatrix"""
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        write_compressed(compress_file("output/uncompressed_trees.json"))
+    elif len(sys.argv) <= 3 and sys.argv[1] == 'parallel':
+        workers = int(sys.argv[2]) if len(sys.argv) == 3 else None
+        write_compressed(parallel_compress_file("output/uncompressed_trees.json", workers=workers))
+    elif len(sys.argv) == 4 and sys.argv[1] == 'partial':
+        compress_file(sys.argv[2]).save(sys.argv[3])
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'merge':
+        merge_files(sys.argv[2], sys.argv[3], sys.argv[4:])
+    elif len(sys.argv) == 4 and sys.argv[1] == 'attachments':
+        CompressionPartial.load(sys.argv[2]).attachment_matrix().save(sys.argv[3])
+    else:
+        print(USAGE)
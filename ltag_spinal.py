@@ -1,8 +1,12 @@
-import nltk, random
+import random
 from collections import deque, defaultdict
 from nltk.tree import Tree, ParentedTree
 #from spinal.spinal_loader import *
 
+# Compiled on first use by noun_chunker() instead of on every call. Only the compilation is deferred:
+# importing nltk.tree already runs nltk/__init__, which imports the chunk package as well
+_noun_chunker = None
+
 class SpinalLTAG(ParentedTree):
     """
     Represents a Spinal LTAG as described in Libin Shen's thesis. 
@@ -10,6 +14,21 @@ class SpinalLTAG(ParentedTree):
     Written as a subclass of nltk.Tree for Natural Language purposes
     """
 
+    # Cached canonical hash and measurements; class attributes so that trees restored from old pickles have them
+    _hash = None
+    _leaf_tuple = None
+    _node_count = None
+    _flat_length = None
+    _lengths = None
+    _string = None
+    _spine_index = None
+
+    # On the root of a derived tree: (initial tree, (attached tree, treeposition, rule index), ...), see attach_at
+    _derivation = None
+
+    # Set on grammar trees by freeze_in_place
+    _frozen = False
+
     def __init__(self, name, **kwargs):
 
         self.rules = kwargs.get('rules', [])
@@ -23,6 +42,13 @@ class SpinalLTAG(ParentedTree):
         self.roleset_id = kwargs.get('roleset_id')
         self.num_args = int(kwargs.get('num_args')) if kwargs.get('num_args' ) is not None else None
         self.semantic_role = kwargs.get('semantic_role')
+        self._hash = None
+        self._leaf_tuple = None
+        self._node_count = None
+        self._flat_length = None
+        self._lengths = None
+        self._string = None
+        self._spine_index = None
 
         if "^" in name:
             name = name[:-1]
@@ -32,6 +58,115 @@ class SpinalLTAG(ParentedTree):
 
         super(SpinalLTAG, self).__init__(name, children=self.children)
 
+    def __setattr__(self, name, value):
+        # Caches (underscored attributes) may still be filled in on frozen trees
+        if self._frozen and not name.startswith('_'):
+            raise TypeError("can not set %s of frozen tree %s, thaw() it to modify a copy" % (name, self._label))
+        super(SpinalLTAG, self).__setattr__(name, value)
+
+    def _check_mutable(self):
+        if self._frozen:
+            raise TypeError("can not modify frozen tree %s, thaw() it to modify a copy" % self._label)
+
+    # The mutators below also clear the cached hash and measurements of the node and its ancestors
+
+    def __setitem__(self, index, value):
+        self._check_mutable()
+        super(SpinalLTAG, self).__setitem__(index, value)
+        self.invalidate_hash()
+
+    def __delitem__(self, index):
+        self._check_mutable()
+        super(SpinalLTAG, self).__delitem__(index)
+        self.invalidate_hash()
+
+    def append(self, child):
+        self._check_mutable()
+        super(SpinalLTAG, self).append(child)
+        self.invalidate_hash()
+
+    def extend(self, children):
+        self._check_mutable()
+        super(SpinalLTAG, self).extend(children)
+        self.invalidate_hash()
+
+    def insert(self, index, child):
+        self._check_mutable()
+        super(SpinalLTAG, self).insert(index, child)
+        self.invalidate_hash()
+
+    def pop(self, index=-1):
+        self._check_mutable()
+        child = super(SpinalLTAG, self).pop(index)
+        self.invalidate_hash()
+        return child
+
+    def remove(self, child):
+        self._check_mutable()
+        super(SpinalLTAG, self).remove(child)
+        self.invalidate_hash()
+
+    def set_label(self, label):
+        self._check_mutable()
+        super(SpinalLTAG, self).set_label(label)
+        self.invalidate_hash()
+
+    def freeze_in_place(self, shared=None):
+        """
+        Makes this tree immutable, as SpinalGrammar does with its trees, so they can be referenced by any
+        number of states and actions without defensive copies. Attaching, copy() and thaw() give mutable copies.
+        Rule lists become tuples, so they can't be changed in place either; shared (a dict kept across calls)
+        turns a rule list shared between trees into one shared tuple.
+        (nltk's freeze() instead returns an ImmutableParentedTree copy, which is not a SpinalLTAG)
+        """
+
+        shared = {} if shared is None else shared
+        for node in self.subtrees():
+            if isinstance(node, SpinalLTAG):
+                if not isinstance(node.rules, tuple):
+                    # The list is kept next to its tuple so that its id is not reused
+                    rules = shared.get(id(node.rules))
+                    if rules is None or rules[0] is not node.rules:
+                        rules = shared[id(node.rules)] = (node.rules, tuple(node.rules))
+                    node.rules = rules[1]
+                node._frozen = True
+        return self
+
+    def is_frozen(self):
+        return self._frozen
+
+    def thaw(self):
+        """
+        Returns a mutable copy of this tree, like copy(True) but keeping every attribute and cached value.
+        Nodes are cloned from their attribute dicts instead of going through the constructors
+        """
+
+        node = SpinalLTAG.__new__(type(self))
+        state = node.__dict__
+        state.update(self.__dict__)
+        state['_parent'] = None
+        state.pop('_frozen', None)
+        # Lists and dicts the copy may change in place are its own; the Rule objects are shared
+        state['rules'] = list(self.rules)
+        if self._lengths is not None:
+            state['_lengths'] = dict(self._lengths)
+
+        children = [child.thaw() if isinstance(child, SpinalLTAG) else child.copy(True) if isinstance(child, Tree) else child for child in self]
+        list.extend(node, children)
+        state['children'] = children
+        for child in children:
+            if isinstance(child, Tree):
+                child.__dict__['_parent'] = node
+        return node
+
+    def __getstate__(self):
+        # Cached hashes are salted per process, so they are never pickled, and measurements are cheap to recompute.
+        # The derivation refers to grammar trees, and is sent as a spinal_encoding.Derivation instead
+        state = dict(self.__dict__)
+        for cached in ('_hash', '_leaf_tuple', '_node_count', '_flat_length', '_lengths', '_string', '_spine_index', '_derivation'):
+            state.pop(cached, None)
+        return state
+
     def terminal_tree(self):
         """
         No applicable rules left in any part of this tree
@@ -40,7 +175,7 @@ class SpinalLTAG(ParentedTree):
         return len(self.all_applicable_rules()) == 0
 
     def all_rules(self): 
-        return self.rules + [rule for child in self if isinstance(child, SpinalLTAG) for rule in child.all_rules()]
+        return list(self.rules) + [rule for child in self if isinstance(child, SpinalLTAG) for rule in child.all_rules()]
 
     def all_applicable_rules(self):
         """
@@ -80,16 +215,20 @@ class SpinalLTAG(ParentedTree):
 
     def spine_index(self):
         """
-        Returns the index of the immediate child that is along the same spine as this node
+        Returns the index of the immediate child that is along the same spine as this node.
+        Cached per node like canonical_hash, so grammar trees and their copies compute it once
         """
 
-        count = 0
-        for child in self:
-            if type(child) == str or not child.attached:
-                return count
-            else:
+        if self._spine_index is None:
+            count = 0
+            for child in self:
+                if type(child) == str or not child.attached:
+                    break
                 count += 1
-        assert False
+            else:
+                assert False
+            self._spine_index = count
+        return self._spine_index
 
     def pos_rule_dict(self):
         """
@@ -103,6 +242,130 @@ class SpinalLTAG(ParentedTree):
             rule_dict[r.pos].append(r)
         return rule_dict
 
+    def canonical_hash(self):
+        """
+        Returns a hash of the derived tree rooted at this node that only depends on its
+        structure, labels, leaves and remaining rules, not on the order of the attachments that built it.
+        Values are cached per node; attach only clears the cache along the path it modifies
+        """
+
+        if self._hash is None:
+            child_hashes = tuple(child.canonical_hash() if isinstance(child, SpinalLTAG) else hash(child) for child in self)
+            rule_keys = tuple(sorted(rule.key() for rule in self.rules))
+            self._hash = hash((self.label(), self.foot, self.predicate, self.semantic_role, rule_keys, child_hashes))
+        return self._hash
+
+    def invalidate_hash(self):
+        """
+        Clears the cached hash and measurements of this node and all of its ancestors
+        """
+
+        node = self
+        while node is not None:
+            node._hash = None
+            node._leaf_tuple = None
+            node._node_count = None
+            node._flat_length = None
+            node._lengths = None
+            node._string = None
+            node._spine_index = None
+            # Unpickling extends nodes with their children before restoring their attributes
+            node = getattr(node, '_parent', None)
+
+    def copy_hashes_from(self, other):
+        """
+        Copies cached hashes and measurements from a tree of identical shape (e.g. the tree this one was copied from)
+        """
+
+        for node, other_node in zip(self.subtrees(), other.subtrees()):
+            if isinstance(node, SpinalLTAG) and isinstance(other_node, SpinalLTAG):
+                node._hash = other_node._hash
+                node._leaf_tuple = other_node._leaf_tuple
+                node._node_count = other_node._node_count
+                node._flat_length = other_node._flat_length
+                node._lengths = other_node._lengths
+                node._string = other_node._string
+                node._spine_index = other_node._spine_index
+
+    def leaf_tuple(self):
+        """
+        The leaves of this tree as a tuple, cached per node like canonical_hash
+        """
+
+        if self._leaf_tuple is None:
+            leaves = []
+            for child in self:
+                if isinstance(child, SpinalLTAG):
+                    leaves.extend(child.leaf_tuple())
+                elif isinstance(child, Tree):
+                    leaves.extend(child.leaves())
+                else:
+                    leaves.append(child)
+            self._leaf_tuple = tuple(leaves)
+        return self._leaf_tuple
+
+    def leaves(self):
+        return list(self.leaf_tuple())
+
+    def node_count(self):
+        """
+        Number of nodes (not leaves) in this tree
+        """
+
+        if self._node_count is None:
+            self._node_count = 1 + sum(child.node_count() if isinstance(child, SpinalLTAG) else len(list(child.subtrees()))
+                                       for child in self if isinstance(child, Tree))
+        return self._node_count
+
+    def flat_length(self):
+        """
+        Length of this tree printed on one line, "(label child child ...)"
+        """
+
+        if self._flat_length is None:
+            length = 3 + len(self._label) + max(len(self) - 1, 0)
+            for child in self:
+                if isinstance(child, SpinalLTAG):
+                    length += child.flat_length()
+                elif isinstance(child, Tree):
+                    length += len(child._pformat_flat("", "()", ("", "")))
+                else:
+                    length += len(child) if isinstance(child, str) else len(repr(child))
+            self._flat_length = length
+        return self._flat_length
+
+    def pformat_length(self, margin=70, indent=0):
+        """
+        Returns len(self.pformat(margin, indent)), and len(str(self)) by default, without printing the tree.
+        Like pformat, a subtree is printed on one line if it fits within the margin and otherwise one child per line,
+        so only the subtrees that are printed over several lines are visited
+        """
+
+        flat = self.flat_length()
+        if flat + indent < margin:
+            return flat
+
+        if self._lengths is None:
+            self._lengths = {}
+        key = (margin, indent)
+        if key not in self._lengths:
+            # "(label" and ")", then a newline and the indentation before each child
+            length = 2 + len(self._label) + len(self) * (indent + 3)
+            for child in self:
+                if isinstance(child, SpinalLTAG):
+                    length += child.pformat_length(margin, indent + 2)
+                elif isinstance(child, Tree):
+                    length += len(child.pformat(margin, indent + 2))
+                else:
+                    length += len(child) if isinstance(child, str) else len(repr(child))
+            self._lengths[key] = length
+        return self._lengths[key]
+
+    def __str__(self):
+        if self._string is None:
+            self._string = self.pformat()
+        return self._string
+
     def pos_set(self):
         pos = set()
         pos.add(self.label())
@@ -115,19 +378,49 @@ class SpinalLTAG(ParentedTree):
 
         return pos
 
-    def attach(self, att_tree):
+    def attachment_index(self, rule, spine_index=None):
         """
-        Does a breadth first search through the tree
-        For each location at each node that it is possible to attach att_tree: 
-            1. The entire tree will be copied
-            2. att_tree will be attached at the possible location
-            3. The resulting tree will be appended to trees
+        Returns (insertion node, child index) where a tree attached with one of this node's rules would be
+        inserted, or None if the rule's slot and order do not match the current siblings.
+        Nothing is copied, so this can be used to check attachments before performing them
         """
 
-        trees = []
-        queue = deque([self])
+        loc = rule.action_location
+        if spine_index is None:
+            spine_index = self.spine_index()
 
-        # Breadth first search
+        # Find the node that is specified by the attachment rule
+        try:
+            insertion_node = self[loc.treeposition]
+        except IndexError:
+            return None
+
+        # Count siblings on either side of the spine to determine attachment position
+        left_siblings = len(insertion_node[:spine_index])
+        right_siblings = len(insertion_node[spine_index + 1:])
+
+        # Attach to the left of the spine
+        if loc.slot == 0:
+            if left_siblings == loc.order:
+                return insertion_node, loc.order
+
+        # Attach to the right of the spine
+        elif loc.slot == 1:
+            if right_siblings == loc.order:
+                return insertion_node, loc.order + 1 + spine_index
+
+        # Only slot options are 0 (left) and 1 (right)
+        else:
+            assert False, loc
+
+        return None
+
+    def _feasible_locations(self, label):
+        """
+        Breadth first search yielding (node, rule) for every applicable rule that can attach a tree with the given root label
+        """
+
+        queue = deque([self])
         while len(queue) > 0:
             current = queue.popleft()
 
@@ -137,56 +430,93 @@ class SpinalLTAG(ParentedTree):
                     queue.append(child)
 
             # Get all attachment locations for the POS specified by the root of att_tree
-            rules = current.pos_rule_dict()[att_tree.label()]
+            rules = [r for r in current.applicable_rules() if r.pos == label]
             if len(rules) == 0:
                 continue
 
-            # Make a new tree for each possible location
+            spine_index = current.spine_index()
             for rule in rules:
-                loc = rule.action_location
-                root = current.root().copy(True)
-                current = root[current.treeposition()]
-                att_tree = att_tree.copy(True)
-                att_tree.semantic_role = rule.semantic_role
-                att_tree.attached = True
-
-                # Find the node that is specified by the attachment rule
-                insertion_node = current[loc.treeposition]
-                if insertion_node is None:
-                    continue
-
-                # Count siblings on either side of the spine to determine attachment position
-                left_siblings = insertion_node[:current.spine_index()]
-                right_siblings = insertion_node[current.spine_index() + 1:]
-
-                # Attach to the left of the spine
-                if loc.slot == 0:
-                    if len(left_siblings) == loc.order:
-                        attachment_location = loc.order
-                    else:
-                        continue
-
-                # Attach to the right of the spine
-                elif loc.slot == 1:
-                    if len(right_siblings) == loc.order:
-                        attachment_location = loc.order + 1 + current.spine_index()
-                    else:
-                        continue
-
-                # Only slot options are 0 (left) and 1 (right)
-                else:
-                    print(loc)
-                    assert False
+                if current.attachment_index(rule, spine_index) is not None:
+                    yield current, rule
+
+    def feasible_locations(self, att_tree):
+        """
+        Returns (node, rule) for every location att_tree can be attached at, without copying anything
+        """
+
+        return list(self._feasible_locations(att_tree.label()))
+
+    def can_attach(self, att_tree):
+        """
+        Returns whether att_tree can be attached anywhere in this tree
+        """
+
+        return next(self._feasible_locations(att_tree.label()), None) is not None
+
+    def attach(self, att_tree):
+        """
+        Does a breadth first search through the tree
+        For each location at each node that it is possible to attach att_tree: 
+            1. The entire tree will be copied
+            2. att_tree will be attached at the possible location
+            3. The resulting tree will be appended to trees
+        """
+
+        return [self.attach_at(att_tree, node.treeposition(), rule) for node, rule in self.feasible_locations(att_tree)]
+
+    def attach_many(self, att_trees, lazy=False):
+        """
+        Attaches every tree in att_trees at every location it fits, searching this tree for
+        locations once per distinct root label instead of once per candidate.
+        Returns one list per candidate, in order, of the resulting trees, or with lazy=True of
+        PendingAttachments that only copy and attach when their tree is requested
+        """
+
+        locations = {}
+        results = []
+        for att_tree in att_trees:
+            label = att_tree.label()
+            if label not in locations:
+                locations[label] = [(node.treeposition(), rule) for node, rule in self._feasible_locations(label)]
+
+            pending = [PendingAttachment(self, att_tree, treeposition, rule) for treeposition, rule in locations[label]]
+            results.append(pending if lazy else [p.tree() for p in pending])
+        return results
+
+    def attach_at(self, att_tree, treeposition, rule):
+        """
+        Returns a copy of this tree's root with att_tree attached by rule, which must be an applicable
+        rule of the node at treeposition (relative to the root).
+        The new root records the steps of its derivation, which spinal_encoding encodes against a grammar
+        """
+
+        root = self.root().thaw()
+        current = root[treeposition]
+
+        location = current.attachment_index(rule)
+        if location is None:
+            raise ValueError("%s can not attach %s at %s" % (rule, att_tree.label(), str(treeposition)))
+        insertion_node, attachment_location = location
+
+        original_att_tree = att_tree
+        att_tree = att_tree.thaw()
+        att_tree.semantic_role = rule.semantic_role
+        att_tree.attached = True
+        # The semantic role is part of the hash the thawed copy kept from the grammar tree
+        att_tree.invalidate_hash()
 
-                # Perform attachment
-                insertion_node.insert(attachment_location, att_tree)
+        # Perform attachment
+        insertion_node.insert(attachment_location, att_tree)
 
-                # Remove the attachment rule just used
-                root[current.treeposition()].rules = [r for r in current.rules if r != rule]
+        # Remove the attachment rule just used
+        rule_index = current.rules.index(rule)
+        current.rules = [r for r in current.rules if r != rule]
+        insertion_node.invalidate_hash()
 
-                trees.append(root)
+        original_root = self.root()
+        root._derivation = (original_root._derivation or (original_root,)) + ((original_att_tree, tuple(treeposition), rule_index),)
 
-        return trees
+        return root
 
     def amr_semantics(self):
         nodes = set()
@@ -253,9 +583,7 @@ class SpinalLTAG(ParentedTree):
             return remove_chars(self[treepos].label() + "_" + str(treepos), "() ").replace(",", "_")
 
     def predicate_from_treeposition(self, treepos, i=0):
-        grammar = "SimpleNoun: {(<NNP>|<NN>|<NNS>)*}"
-        cp = nltk.RegexpParser(grammar)
-        chunked = cp.parse(self[treepos])
+        chunked = noun_chunker().parse(self[treepos])
         simple_nouns = [c for c in chunked.subtrees(lambda tree: tree.label() == "SimpleNoun")]
 
         if len(simple_nouns) > 0:
@@ -290,6 +618,25 @@ class SpinalLTAG(ParentedTree):
         else:
             return val
 
+class PendingAttachment(object):
+    """
+    An attachment of att_tree to host that has been checked to be possible but not performed yet
+    """
+    def __init__(self, host, att_tree, treeposition, rule):
+        self.host = host
+        self.att_tree = att_tree
+        self.treeposition = treeposition
+        self.rule = rule
+        self._tree = None
+
+    def tree(self):
+        if self._tree is None:
+            self._tree = self.host.attach_at(self.att_tree, self.treeposition, self.rule)
+        return self._tree
+
+    def __repr__(self):
+        return "<PendingAttachment: %s at %s by %s>" % (self.att_tree.label(), str(self.treeposition), self.rule)
+
 class Rule(object):
     def __init__(self, rule_type, pos, action_location, action_id=None, semantic_role=None, role_desc=None):
         self.rule_type = rule_type
@@ -309,7 +656,14 @@ class Rule(object):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(str(pos) + str(action_location) + str(semantic_role))
+        return hash(self.key())
+
+    def key(self):
+        """
+        Returns a tuple identifying what this rule does, independent of the object
+        """
+        loc = self.action_location
+        return (self.rule_type, self.pos, self.semantic_role, tuple(loc.treeposition), loc.slot, loc.order)
 
     def to_dict(self):
         return {
@@ -353,6 +707,16 @@ class ActionLocation(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+def noun_chunker():
+    """
+    Returns the chunker used to find simple nouns, compiling it on first use
+    """
+    global _noun_chunker
+    if _noun_chunker is None:
+        from nltk.chunk import RegexpParser
+        _noun_chunker = RegexpParser("SimpleNoun: {(<NNP>|<NN>|<NNS>)*}")
+    return _noun_chunker
+
 def remove_chars(s, chars):
     return s.translate(str.maketrans("", "", chars))
 
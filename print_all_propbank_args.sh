@@ -2,11 +2,16 @@
 
 FILENAME='output/propbank_args.txt'
 
-# Create new file with opening brace
-`rm $FILENAME; touch $FILENAME;`
+# Create new file, unless resuming an interrupted run from its manifest
+if [ ! -f $FILENAME.manifest ]; then
+    `rm $FILENAME; touch $FILENAME;`
+fi
 
 # Generate trees one at a time
 for ((i=0; i <= 24; i++)); do
     echo jython -J-XX:+UseConcMarkSweepGC -J-Xmx1g print_generalized_trees.py $i
     `jython -J-XX:+UseConcMarkSweepGC -J-Xmx1g print_generalized_trees.py $i $FILENAME print_args`
 done
+
+# The run is complete, so the next one starts over
+`rm $FILENAME.manifest`
\ No newline at end of file
@@ -2,8 +2,10 @@
 
 FILENAME='output/uncompressed_trees.json'
 
-# Create new file with opening brace
-`rm $FILENAME; printf '[' > $FILENAME;`
+# Create new file with opening brace, unless resuming an interrupted run from its manifest
+if [ ! -f $FILENAME.manifest ]; then
+    `rm $FILENAME; printf '[' > $FILENAME;`
+fi
 
 # Generate trees one at a time
 for ((i=0; i <= 24; i++)); do
@@ -15,4 +17,7 @@ done
 `sed -i '' '$ s/.$//' $FILENAME`
 
 # Close opening brace
-`printf ']' >> $FILENAME`
\ No newline at end of file
+`printf ']' >> $FILENAME`
+
+# The run is complete, so the next one starts over
+`rm $FILENAME.manifest`
\ No newline at end of file
@@ -1,12 +1,22 @@
 import json, os, re, sys, gc, glob
 from collections import deque
-sys.path.append('/Users/piffle/Documents/luna_workspace/spinal/bin')
-from edu.upenn.cis.propbank_shen import *
-from edu.upenn.cis.spinal import *
 from itertools import product
 from collections import defaultdict
 
-propbank = Propbank()
+if sys.platform.startswith('java'):
+    sys.path.append('/Users/piffle/Documents/luna_workspace/spinal/bin')
+    from edu.upenn.cis.propbank_shen import *
+    from edu.upenn.cis.spinal import *
+else:
+    # Pure Python port of the Java API, for running extraction on CPython
+    from spinal_propbank import *
+    from spinal_derivation import *
+
+if sys.platform.startswith('java'):
+    propbank = Propbank()
+else:
+    # Memory-mapped if compiled with 'python spinal_propbank.py compile', so parallel workers share it
+    propbank = open_propbank()
 tid = 0
 
 def get_propbank_label(attach):
@@ -153,16 +163,84 @@ def print_tree(tree_str, output_file):
     except SkippedSentenceException:
         return None
 
-def process(section, output_filename='uncompressed_trees_u_rules.json', tree_function=print_tree):
+class OutputShard(object):
+    """Buffers the output of one input file, so it reaches the output file in a single write"""
+    def __init__(self):
+        self.parts = []
+
+    def write(self, string):
+        self.parts.append(string)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+class ExtractionManifest(object):
+    """
+    Progress of an extraction into one output file: the input files already extracted, the size of the
+    output file after them and the next tree id. It is replaced atomically at every checkpoint, so after
+    a crash the output is cut back to the last checkpoint and extraction resumes with the next input file,
+    without duplicated trees or gaps in the tree ids
+    """
+    def __init__(self, output_filename):
+        self.output_filename = output_filename
+        self.filename = output_filename + ".manifest"
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+            self.completed = set(state['completed'])
+            self.offset = state['offset']
+            self.next_tid = state['next_tid']
+        else:
+            self.completed = set()
+            self.offset = os.path.getsize(output_filename) if os.path.exists(output_filename) else 0
+            self.next_tid = 0
+
+    def restore(self):
+        """Truncates output written after the last checkpoint"""
+        size = os.path.getsize(self.output_filename) if os.path.exists(self.output_filename) else 0
+        if size < self.offset:
+            raise ValueError("%s is shorter than its manifest %s" % (self.output_filename, self.filename))
+        if size > self.offset:
+            with open(self.output_filename, 'r+b') as f:
+                f.truncate(self.offset)
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump({'completed': sorted(self.completed), 'offset': self.offset, 'next_tid': self.next_tid}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+
+def process(section, output_filename='uncompressed_trees_u_rules.json', tree_function=print_tree, checkpoint_every=100):
+    """
+    Extracts the trees of one section, resuming from output_filename's manifest, and checkpoints
+    the manifest every checkpoint_every input files and at the end of the section
+    """
+    global tid
     directory = "trees"
 
-    for filename in glob.glob(directory + '/' + section +'_*.txt'):
-        with open(filename, 'r') as f:
-            tree = ""
-            for line in f:
-                tree += line
-        with open(output_filename, 'a') as output_file:
-            tree_function(tree, output_file=output_file)
+    manifest = ExtractionManifest(output_filename)
+    manifest.restore()
+    tid = manifest.next_tid
+
+    filenames = sorted(f for f in glob.glob(directory + '/' + section +'_*.txt') if f not in manifest.completed)
+    with open(output_filename, 'a') as output_file:
+        for i, filename in enumerate(filenames):
+            with open(filename, 'r') as f:
+                tree = f.read()
+
+            shard = OutputShard()
+            tree_function(tree, output_file=shard)
+            output_file.write(shard.getvalue())
+            manifest.completed.add(filename)
+
+            if (i + 1) % checkpoint_every == 0 or i + 1 == len(filenames):
+                output_file.flush()
+                os.fsync(output_file.fileno())
+                manifest.offset = os.path.getsize(output_filename)
+                manifest.next_tid = tid
+                manifest.save()
 
 def generate_semantics(tree_str, output_file="propbank_args.txt"):
     sentence = Sentence(tree_str)
@@ -211,5 +289,5 @@ if __name__ == "__main__":
     elif sys.argv[3] == 'print_args':
         tree_function = generate_semantics
     else:
-        print("usage: jython print_generalized_trees.py <section_num> <output_filename> [print_trees | print_args]")
+        print("usage: [jython|python] print_generalized_trees.py <section_num> <output_filename> [print_trees | print_args]")
     process(sys.argv[1], output_filename=sys.argv[2], tree_function=tree_function)
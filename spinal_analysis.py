@@ -0,0 +1,148 @@
+import sys
+from collections import defaultdict, Counter
+from spinal.spinal_grammar import SpinalGrammar
+from spinal.ltag_spinal import SpinalLTAG
+from spinal.spinal_memory import deep_size
+
+class POSReport(object):
+    """
+    Size statistics of the elementary trees of one POS
+    """
+    def __init__(self, pos):
+        self.pos = pos
+        self.trees = 0
+        self.rules = 0
+        self.open_slots = 0
+        self.bytes = 0
+        self.actions = 0
+        self.rule_pos = Counter()
+        self.open_pos = Counter()
+
+    def add_tree(self, tree, tree_bytes, pos_trees):
+        """
+        pos_trees maps each POS to its trees in the grammar. As in SpinalState.actions, an open POS
+        only counts if its first tree can be attached, and then contributes all of its trees
+        """
+        rules = tree.all_rules()
+        open_pos = [pos for pos in tree.open_actions() if len(pos_trees.get(pos, [])) > 0 and tree.can_attach(pos_trees[pos][0])]
+        self.trees += 1
+        self.rules += len(rules)
+        self.open_slots += len(set((r.action_location.original_treeposition, r.action_location.slot) for r in rules))
+        self.bytes += tree_bytes
+        self.actions += sum(len(pos_trees[pos]) for pos in open_pos)
+        self.rule_pos.update(r.pos for r in rules)
+        self.open_pos.update(open_pos)
+
+    def mean(self, total):
+        return total / float(self.trees) if self.trees > 0 else 0.0
+
+    def mean_rule_pos(self):
+        """
+        Expected number of rules per POS on a tree of this POS
+        """
+        return dict((pos, count / float(self.trees)) for pos, count in self.rule_pos.items())
+
+    def open_probabilities(self):
+        """
+        Probability that a POS can be attached to a tree of this POS, i.e. that it is open and its trees fit
+        """
+        return dict((pos, count / float(self.trees)) for pos, count in self.open_pos.items())
+
+class GrammarReport(object):
+    """
+    Branching factors and action-space estimates of a SpinalGrammar, computed in one pass over its trees
+    """
+    def __init__(self, grammar, max_depth=10):
+        self.grammar = grammar
+        self.max_depth = max_depth
+        self.pos_reports = {}
+
+        for pos, trees in grammar.tree_dict.items():
+            report = POSReport(pos)
+            for tree in trees:
+                report.add_tree(tree, estimated_tree_bytes(tree), grammar.tree_dict)
+            self.pos_reports[pos] = report
+
+        self.expected_actions = self.estimate_actions()
+
+    def estimate_actions(self, pos=None):
+        """
+        Estimates the expected size of SpinalState.actions() at each derivation depth, for derivations
+        starting with a tree of pos (the start symbol by default).
+
+        A derivation is modelled by the expected number of open rules per POS and the probability that each
+        POS is open: it starts with the trees of pos, and each step consumes one open rule, chosen in proportion
+        to the open rules, and attaches a tree of that rule's POS, which brings the rules and open POS measured
+        on the trees of that POS. An open POS contributes all of its trees to the actions.
+        Depth 0 is the choice of the initial tree, and depth 1 is exact
+        """
+        start = self.pos_reports.get(pos if pos is not None else self.grammar.start)
+        if start is None:
+            return [0.0]
+
+        expected = [float(start.trees)]
+        open_rules = defaultdict(float, start.mean_rule_pos())
+        open_probabilities = defaultdict(float, start.open_probabilities())
+
+        for depth in range(1, self.max_depth + 1):
+            total = sum(open_rules.values())
+            if total <= 0:
+                expected.append(0.0)
+                continue
+
+            expected.append(sum(p * len(self.grammar.tree_dict.get(open_pos, [])) for open_pos, p in open_probabilities.items()))
+
+            next_open = defaultdict(float)
+            # Probability that the attached tree brings each POS, and that the consumed rule closes it
+            brought = defaultdict(float)
+            closed = defaultdict(float)
+            for rule_pos, count in open_rules.items():
+                share = count / total
+                next_open[rule_pos] += count - share
+                closed[rule_pos] += share / max(1.0, count)
+                if rule_pos in self.pos_reports:
+                    report = self.pos_reports[rule_pos]
+                    for child_pos, child_count in report.mean_rule_pos().items():
+                        next_open[child_pos] += share * child_count
+                    for child_pos, p in report.open_probabilities().items():
+                        brought[child_pos] += share * p
+            open_rules = next_open
+            open_probabilities = defaultdict(float, ((p, 1.0 - (1.0 - open_probabilities[p] * (1.0 - closed[p])) * (1.0 - min(1.0, brought[p])))
+                for p in set(open_probabilities) | set(brought)))
+
+        return expected
+
+    def rows(self):
+        for pos in sorted(self.pos_reports, key=lambda p: -self.pos_reports[p].trees):
+            report = self.pos_reports[pos]
+            yield (pos, report.trees, report.mean(report.rules), report.mean(report.open_slots), report.mean(report.actions), report.mean(report.bytes))
+
+    def __str__(self):
+        lines = ["%-8s %8s %10s %10s %12s %12s" % ("POS", "trees", "rules/tree", "slots/tree", "actions/tree", "bytes/tree")]
+        for row in self.rows():
+            lines.append("%-8s %8d %10.2f %10.2f %12.1f %12.0f" % row)
+
+        lines.append("")
+        lines.append("%-8s %16s" % ("depth", "expected actions"))
+        for depth, actions in enumerate(self.expected_actions):
+            lines.append("%-8d %16.1f" % (depth, actions))
+        return "\n".join(lines)
+
+def estimated_tree_bytes(tree):
+    """
+    Estimates the memory held by one elementary tree: nodes, their attribute dicts and rules for
+    SpinalLTAGs, or the tree's share of the arrays for views of a CompactTreeStore
+    """
+    if not isinstance(tree, SpinalLTAG):
+        store = tree.store
+        entries = store.entry_end[tree.entry] - tree.entry
+        return entries * store.nbytes() / float(max(1, len(store.entry_label)))
+
+    # Parent pointers would pull in the whole containing tree
+    seen = set([id(tree._parent)])
+    return deep_size(tree, seen, skip=(), attributes=True)
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else "output/compressed_trees.json"
+    max_depth = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(GrammarReport(SpinalGrammar.from_file(filename=filename), max_depth=max_depth))
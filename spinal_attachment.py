@@ -0,0 +1,177 @@
+"""
+Sparse counts of the child labels attached at each slot of each generalized tree, with vectorized
+conditional probability and top-k queries. Run as a module from the directory containing output/:
+    python -m spinal.spinal_attachment [compressed_trees.json] [k]
+"""
+
+import ast, json, pickle, sys
+import numpy as np
+
+def attach_slot(attach_id):
+    """
+    The (treeposition, slot) of an attach id as written in the treebanks, such as "('0.1', '0')", with
+    the treeposition relative to the root as in Rule.action_location.original_treeposition
+    """
+    position, slot = ast.literal_eval(attach_id) if isinstance(attach_id, str) else attach_id
+    return (tuple(int(i) for i in position.split(".")[1:]), int(slot))
+
+def rule_slot(rule):
+    location = rule.action_location
+    position = location.original_treeposition if location.original_treeposition is not None else location.treeposition
+    return (tuple(position), location.slot)
+
+class AttachmentMatrix(object):
+    """
+    Attachment counts as a CSR matrix: one row per (parent tree id, (treeposition, slot)) and one column per
+    child label. Rows and labels are numbered in sorted order, and the entries of each row are sorted by label,
+    so every entry also has a unique sorted key (row * number of labels + label) that batches of
+    (row, label) pairs are looked up in with one searchsorted
+    """
+    def __init__(self, counts):
+        """
+        counts maps (parent tree id, (treeposition, slot), child label) to a count
+        """
+        self.rows = sorted(set((parent, slot) for parent, slot, _ in counts))
+        self.labels = sorted(set(label for _, _, label in counts))
+        self.row_ids = dict((row, i) for i, row in enumerate(self.rows))
+        self.label_ids = dict((label, i) for i, label in enumerate(self.labels))
+
+        entries = sorted((self.row_ids[(parent, slot)], self.label_ids[label], count) for (parent, slot, label), count in counts.items() if count > 0)
+        entry_rows = np.array([e[0] for e in entries], dtype=np.int64)
+        self.indices = np.array([e[1] for e in entries], dtype=np.int64)
+        self.counts = np.array([e[2] for e in entries], dtype=np.int64)
+        self.indptr = np.zeros(len(self.rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(entry_rows, minlength=len(self.rows)), out=self.indptr[1:])
+
+        self.keys = entry_rows * max(1, len(self.labels)) + self.indices
+        self.totals = np.add.reduceat(self.counts, self.indptr[:-1]) if len(entries) > 0 else np.zeros(len(self.rows), dtype=np.int64)
+        self.conditionals = self.counts / np.repeat(self.totals, np.diff(self.indptr)) if len(entries) > 0 else np.zeros(0)
+
+    def __repr__(self):
+        return "<AttachmentMatrix: %d rows, %d labels, %d entries>" % (len(self.rows), len(self.labels), len(self.counts))
+
+    @classmethod
+    def from_tree_dicts(cls, tree_dicts):
+        """
+        Builds the matrix from the attach_counts of compressed tree dicts
+        """
+        counts = {}
+        for tree_dict in tree_dicts:
+            for attach_id, label_counts in tree_dict['attach_counts'].items():
+                slot = attach_slot(attach_id)
+                for label, count in label_counts.items():
+                    key = (tree_dict['tree_id'], slot, label)
+                    counts[key] = counts.get(key, 0) + count
+        return cls(counts)
+
+    @classmethod
+    def from_file(cls, filename="output/compressed_trees.json"):
+        with open(filename) as json_file:
+            return cls.from_tree_dicts(json.loads(json_file.read()))
+
+    @classmethod
+    def from_trees(cls, trees):
+        """
+        Builds the matrix from the attach_counts the loader sets on the rules of grammar trees.
+        The lexicalizations of a tree share its counts, so each tree id is counted once
+        """
+        counts = {}
+        seen = set()
+        for tree in trees:
+            if tree.tree_id in seen:
+                continue
+            seen.add(tree.tree_id)
+            for rule in tree.all_rules():
+                for label, count in (getattr(rule, 'attach_counts', None) or {}).items():
+                    counts[(tree.tree_id, rule_slot(rule), label)] = count
+        return cls(counts)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def row_index(self, parent, slot):
+        """
+        The row of a parent tree id and (treeposition, slot), or -1 if nothing was attached there
+        """
+        return self.row_ids.get((parent, slot), -1)
+
+    def row(self, parent, slot):
+        """
+        The child label counts of one row, as a dict
+        """
+        i = self.row_index(parent, slot)
+        if i < 0:
+            return {}
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return dict((self.labels[j], int(c)) for j, c in zip(self.indices[start:end], self.counts[start:end]))
+
+    def count(self, parent, slot, label):
+        return self.row(parent, slot).get(label, 0)
+
+    def probability(self, parent, slot, label):
+        """
+        P(child label | parent, slot), 0 for slots nothing was attached at
+        """
+        return float(self.probabilities(self.row_index(parent, slot), self.label_ids.get(label, -1)))
+
+    def probabilities(self, rows, labels):
+        """
+        P(child label | row) for arrays (or scalars) of row and label ids, broadcast against each other.
+        Unknown rows or labels (id -1) have probability 0
+        """
+        rows, labels = np.broadcast_arrays(np.asarray(rows, dtype=np.int64), np.asarray(labels, dtype=np.int64))
+        result = np.zeros(rows.shape)
+        if len(self.keys) == 0:
+            return result
+
+        keys = rows * len(self.labels) + labels
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = (rows >= 0) & (labels >= 0) & (self.keys[positions] == keys)
+        result[found] = self.conditionals[positions[found]]
+        return result
+
+    def distribution(self, parent, slot):
+        """
+        The child labels seen at a slot and their probabilities, as a list and an array
+        """
+        i = self.row_index(parent, slot)
+        if i < 0:
+            return [], np.zeros(0)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return [self.labels[j] for j in self.indices[start:end]], self.conditionals[start:end]
+
+    def top_k(self, parent, slot, k=5):
+        """
+        The k most probable child labels at a slot, as (label, probability) pairs, most probable first
+        """
+        labels, probabilities = self.distribution(parent, slot)
+        if len(labels) > k:
+            best = np.argpartition(-probabilities, k - 1)[:k]
+        else:
+            best = np.arange(len(labels))
+        best = best[np.argsort(-probabilities[best], kind='stable')]
+        return [(labels[i], float(probabilities[i])) for i in best]
+
+    def rule_probabilities(self, tree_id, rules):
+        """
+        P(rule.pos | tree_id, slot of the rule) for each of a grammar tree's rules, as an array
+        """
+        rows = [self.row_index(tree_id, rule_slot(rule)) for rule in rules]
+        labels = [self.label_ids.get(rule.pos, -1) for rule in rules]
+        return self.probabilities(rows, labels)
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else "output/compressed_trees.json"
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    matrix = AttachmentMatrix.from_file(filename)
+    print(matrix)
+    for i in np.argsort(-matrix.totals, kind='stable')[:20]:
+        parent, slot = matrix.rows[i]
+        print("%s %s %d: %s" % (parent, slot, matrix.totals[i], " ".join("%s=%.3f" % child for child in matrix.top_k(parent, slot, k))))
@@ -0,0 +1,72 @@
+"""
+Measurements of the generation pipeline. Run as a module from the directory containing output/:
+    python -m spinal.spinal_benchmark startup
+"""
+
+import os, pickle, subprocess, sys, tempfile, json
+from spinal.spinal_grammar import SpinalGrammar
+
+# Run in a fresh interpreter so that imports and loading are measured cold
+STARTUP_SCRIPT = """
+import time, json, sys
+start = time.time()
+from spinal.spinal_grammar import SpinalGrammar
+imported = time.time()
+
+mode, path = sys.argv[1], sys.argv[2]
+if mode == 'json':
+    grammar = SpinalGrammar.from_file(filename=path, update=True)
+elif mode == 'pickle':
+    import pickle
+    grammar = SpinalGrammar(pickle.load(open(path, 'rb')), 'S')
+else:
+    grammar = SpinalGrammar.from_snapshot(path, freeze=True)
+loaded = time.time()
+
+tree = grammar.tree_dict[grammar.start][0]
+while not tree.terminal_tree():
+    candidates = [t for pos in tree.open_actions() for t in grammar.tree_dict[pos]]
+    tree = [d for t in candidates for d in tree.attach(t)][0]
+generated = time.time()
+
+print(json.dumps({'import': imported - start, 'load': loaded - imported, 'generate': generated - loaded, 'total': generated - start}))
+"""
+
+def time_to_first_generation(filename="output/compressed_trees.json", repeat=3):
+    """
+    Returns the best of repeat cold-start timings (import, load, first derivation) for loading
+    the grammar from json, from a pickle of its trees and from a snapshot
+    """
+    grammar = SpinalGrammar.from_file(filename=filename)
+    tmp_dir = tempfile.mkdtemp()
+
+    # The json path writes a snapshot as a side effect, so it works on a copy of the input
+    json_filename = os.path.join(tmp_dir, "trees.json")
+    with open(filename) as src, open(json_filename, 'w') as dest:
+        dest.write(src.read())
+
+    pickle_filename = os.path.join(tmp_dir, "trees.pickle")
+    with open(pickle_filename, 'wb') as f:
+        pickle.dump(grammar.trees, f)
+
+    snapshot_filename = os.path.join(tmp_dir, "trees.snapshot")
+    grammar.save_snapshot(snapshot_filename)
+
+    timings = {}
+    for mode, path in [('json', json_filename), ('pickle', pickle_filename), ('snapshot', snapshot_filename)]:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, mode, path])
+            runs.append(json.loads(output.decode('utf-8').strip().split("\n")[-1]))
+        timings[mode] = min(runs, key=lambda r: r['total'])
+    return timings
+
+def print_timings(timings):
+    for name, timing in timings.items():
+        print("%-10s " % name + " ".join("%s=%.3fs" % (k, v) for k, v in sorted(timing.items())))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'startup':
+        print_timings(time_to_first_generation(*sys.argv[2:]))
+    else:
+        print("usage: python -m spinal.spinal_benchmark startup [compressed_trees.json]")
@@ -0,0 +1,782 @@
+"""
+Pure Python reader for Libin Shen's LTAG-spinal derivation format, a port of Sentence, ElemTree and SpinalNode
+from src/edu/upenn/cis/spinal. The classes keep the Java method names, so print_generalized_trees.py runs on
+CPython as well as under jython. Graphviz output and the walkers are not ported.
+
+Under jython, both readers can be compared on the same files:
+    jython spinal_derivation.py compare trees/00_*.txt
+"""
+
+import re, sys
+from spinal_propbank import PASLoc, WordSpan, java_split, parse_int
+
+__all__ = ['Sentence', 'ElemTree', 'TAGAttachment', 'SpinalNode', 'GornAddress',
+           'ElemTreeFormatException', 'SkippedSentenceException', 'UncompletedElemTreeException']
+
+class ElemTreeFormatException(Exception):
+    def __init__(self, message):
+        super(ElemTreeFormatException, self).__init__("Error while parsing an elementary tree: " + message)
+
+class SkippedSentenceException(Exception):
+    def __init__(self, source=None):
+        super(SkippedSentenceException, self).__init__()
+        self.source = source
+
+    def getSource(self):
+        return self.source
+
+class UncompletedElemTreeException(Exception):
+    def __init__(self):
+        super(UncompletedElemTreeException, self).__init__("ElemTrees should be completed before being used.")
+
+class GornAddress(list):
+    """
+    An address in a spine, e.g. 0.1 is the second child of the root of the spine
+    """
+    SEPARATOR = "."
+
+    def __init__(self, string):
+        super(GornAddress, self).__init__(parse_int(part) for part in string.split(GornAddress.SEPARATOR))
+
+    def toString(self, separator=SEPARATOR):
+        return separator.join(str(part) for part in self)
+
+    __str__ = toString
+
+    def __hash__(self):
+        return hash(self.toString())
+
+class SpinalNode(object):
+    """
+    One node of the spine of an elementary tree
+    """
+    ANCHOR = "^"
+    ANCHORS = u"\u02c6\u005e\u0302"
+    FOOT = "*"
+    STANDARD = ""
+
+    def __init__(self, representation, host, parent=None):
+        self.host = host
+        self.parent = parent
+        self.label = None
+        self.type = SpinalNode.STANDARD
+        self.children = []
+
+        tokens = representation
+        if not isinstance(tokens, list):
+            tokens = java_split(" ", representation)
+        if len(tokens) == 0:
+            raise ElemTreeFormatException("Can't create a SpinalNode from an empty string.")
+
+        if len(tokens) == 1:
+            self.parseLabelAndType(tokens[0])
+        else:
+            tokens = SpinalNode.stripSurroundingBrackets(tokens)
+            self.parseLabelAndType(tokens[0])
+            self.children = self.parseChildren(tokens[1:])
+            if self.children is None:
+                raise ElemTreeFormatException("Spinal node %s has an empty list of children" % tokens[0])
+            for child in self.children:
+                child.parent = self
+
+    def parseLabelAndType(self, label):
+        if len(label) == 0:
+            raise ElemTreeFormatException("Empty spinal node label")
+        if label.endswith(SpinalNode.ANCHOR) or label[-1] in SpinalNode.ANCHORS:
+            self.type = SpinalNode.ANCHOR
+            self.label = label[:-1]
+        elif label.endswith(SpinalNode.FOOT):
+            self.type = SpinalNode.FOOT
+            self.label = label[:-1]
+        else:
+            self.type = SpinalNode.STANDARD
+            self.label = label
+
+    def parseChildren(self, tokens):
+        if len(tokens) == 0:
+            return None
+        if len(tokens) == 1:
+            return [SpinalNode(tokens, self.host, self)]
+
+        children = []
+        while len(tokens) > 0:
+            if tokens[0] == "(":
+                end = SpinalNode.whereIsClosingBracket(tokens) + 1
+            else:
+                end = 1
+            children.append(SpinalNode(tokens[:end], self.host))
+            tokens = tokens[end:]
+        return children
+
+    @staticmethod
+    def stripSurroundingBrackets(tokens):
+        while tokens[0] == "(" and tokens[-1] == ")":
+            tokens = tokens[1:-1]
+        return tokens
+
+    @staticmethod
+    def whereIsClosingBracket(tokens):
+        if tokens[0] != "(":
+            return -1
+        stack = 0
+        for position, token in enumerate(tokens):
+            if token == "(":
+                stack += 1
+            elif token == ")":
+                stack -= 1
+                if stack == 0:
+                    return position
+        raise ElemTreeFormatException("Bad spine")
+
+    def getLabel(self):
+        return self.label
+
+    def getType(self):
+        return self.type
+
+    def isAnchor(self):
+        return self.type == SpinalNode.ANCHOR
+
+    def isFoot(self):
+        return self.type == SpinalNode.FOOT
+
+    def isStandard(self):
+        return self.type == SpinalNode.STANDARD
+
+    def getChildren(self):
+        return self.children
+
+    def getChildrenList(self):
+        return list(self.children)
+
+    def getChild(self, n):
+        return self.children[n]
+
+    def getAllNodes(self):
+        nodes = [self]
+        for child in self.children:
+            nodes.extend(child.getAllNodes())
+        return nodes
+
+    def getElemTree(self):
+        return self.host
+
+    def isRootOfSpine(self):
+        return self.parent is None
+
+    def getParent(self, acrossElemTrees=False):
+        if acrossElemTrees and self.isRootOfSpine():
+            return self.host.getAttachmentSite()
+        return self.parent
+
+    def getLocationInSpine(self):
+        path = []
+        current = self
+        while not current.isRootOfSpine():
+            path.append(str(current.parent.children.index(current)))
+            current = current.parent
+        return GornAddress(".".join(["0"] + path[::-1]))
+
+    def toString(self):
+        result = self.label + self.type
+        if len(self.children) == 0:
+            return result
+        return "( " + " ".join([result] + [child.toString() for child in self.children]) + " )"
+
+    __str__ = toString
+
+class TAGAttachment(object):
+    """
+    An attachment, adjunction or coordination of a child elementary tree onto a node of its parent's spine
+    """
+    TYPES = {'att': 4, 'adj': 5, 'crd': 6, 'con': 7}
+    TYPE_STRINGS = dict((v, k) for k, v in TYPES.items())
+
+    def __init__(self, parent, representation):
+        self.type = -1
+        self.nodeNumber = -1
+        self.gornAddress = None
+        self.slot = ElemTree.UNKNOWN
+        self.order = -1
+        self.child = None
+        self.parent = parent
+        self.completed = False
+        self.locationKnown = True
+        self.loadFromStringRepresentation(representation)
+
+    def loadFromStringRepresentation(self, representation):
+        representation = representation.strip()
+        parts = java_split(r"\s+", representation)
+        if len(parts) not in (8, 4, 2):
+            raise ElemTreeFormatException("Malformed attachment representation: " + representation)
+        parts = [part[:-1] if part.endswith(",") else part for part in parts]
+
+        if parts[0] not in TAGAttachment.TYPES:
+            raise ElemTreeFormatException("Unknown attachment type %s at %s." % (parts[0], self.parent.getSentence().prettyPrintLocation()))
+        self.type = TAGAttachment.TYPES[parts[0]]
+
+        try:
+            self.nodeNumber = parse_int(parts[1][1:])
+        except ValueError:
+            raise ElemTreeFormatException("Invalid node number %s. Attachment representation was %s" % (parts[1][1:], representation))
+
+        if len(parts) == 2:
+            self.locationKnown = False
+            return
+
+        self.gornAddress = GornAddress(parts[3])
+        if len(parts) == 8:
+            slot = parse_int(parts[5])
+            if slot == 0:
+                self.slot = ElemTree.LEFT
+            elif slot == 1:
+                self.slot = ElemTree.RIGHT
+            self.order = parse_int(parts[7])
+
+    def complete(self):
+        child = self.child = self.parent.containingSentence.getElemTree(self.nodeNumber)
+        child.parent = self.parent
+        child.attachmentToParent = self
+        child.slot = self.slot
+        if child.isBidirectionalParserOutput():
+            if self.type == ElemTree.ATTACH:
+                child.type = ElemTree.INITIAL
+            elif self.type == ElemTree.ADJOIN:
+                child.type = ElemTree.AUXILIARY
+        self.completed = True
+
+    def checkCompletion(self):
+        if not self.completed:
+            raise UncompletedElemTreeException()
+
+    def _location_string(self, slot_offset):
+        if not self.locationKnown:
+            return ""
+        s = ", on " + self.gornAddress.toString()
+        if self.getSlot() != -1 and self.getOrder() != -1:
+            s += ", slot %d, order %d" % (self.getSlot() - slot_offset, self.getOrder())
+        return s
+
+    def toString(self):
+        self.checkCompletion()
+        return " %s #%d" % (TAGAttachment.TYPE_STRINGS.get(self.type, ""), self.nodeNumber) + self._location_string(0)
+
+    __str__ = toString
+
+    def getGeneralString(self):
+        """
+        The attachment with the label of the child's spine in place of its number and slots as 0 (left) or 1 (right)
+        """
+        self.checkCompletion()
+        return "%s %s" % (TAGAttachment.TYPE_STRINGS.get(self.type, ""), self.child.getSpine().getLabel()) + self._location_string(ElemTree.LEFT)
+
+    def getParent(self):
+        return self.parent
+
+    def getChild(self):
+        return self.child
+
+    getElemTree = getChild
+
+    def getAttachmentSiteOnParent(self):
+        if not self.locationKnown:
+            return None
+        return self.parent.getSpinalNodeAt(self.gornAddress)
+
+    def getType(self):
+        return self.type
+
+    def getNodeNumber(self):
+        return self.nodeNumber
+
+    def getSlot(self):
+        return self.slot if self.locationKnown else -1
+
+    def getOrder(self):
+        return self.order if self.locationKnown else -1
+
+    def getGornAddress(self):
+        return self.gornAddress if self.locationKnown else None
+
+class ElemTree(object):
+    """
+    A spinal elementary tree of a derivation, e.g.
+        #3 failed
+         spine: a_( S ( VP VBD^ ) )
+         att #0, on 0, slot 0, order 0
+    """
+    UNKNOWN = -1
+    INITIAL = 0
+    AUXILIARY = 1
+    COORD = 2
+    ROOT = 3
+    ATTACH = 4
+    ADJOIN = 5
+    CONJUNCT = 6
+    CONJUNCT_OR_CONNECTIVE = 7
+    LEFT = 8
+    RIGHT = 9
+
+    TYPE_STRINGS = {INITIAL: "initial", AUXILIARY: "auxiliary", COORD: "coordination", UNKNOWN: "unknown"}
+    SPINE_TYPES = {'a': INITIAL, 'b': AUXILIARY, 'c': COORD}
+    SPINE_CHARS = {INITIAL: "a", AUXILIARY: "b", COORD: "c"}
+
+    coordPattern = re.compile(r"\s*coord\s*\Z")
+    posPattern = re.compile(r"\s*pos: (.*)\Z")
+    spinePattern = re.compile(r"\s*spine: (.*)\Z")
+
+    def __init__(self, container, representation):
+        self.containingSentence = container
+        self.number = -1
+        self.terminal = ""
+        self.type = ElemTree.UNKNOWN
+        self.rootOfSpine = None
+        self.bidirectionalParserOutput = False
+        self.pos = None
+        self.attachments = []
+        self.parent = None
+        self.attachmentToParent = None
+        self.span = None
+        self.slot = ElemTree.UNKNOWN
+        self.completed = False
+        self.loadFromStringRepresentation(representation)
+
+    def loadFromStringRepresentation(self, representation):
+        lines = java_split("\n", representation)
+        first_line = java_split(r"\s+", lines[0])
+        if len(first_line) == 1:
+            # Coordination doesn't come with a word
+            self.type = ElemTree.COORD
+        self.number = parse_int(first_line[0])
+        self.terminal = "".join(first_line[1:])
+
+        second_line = lines[1]
+        coord = ElemTree.coordPattern.match(second_line)
+        pos = ElemTree.posPattern.match(second_line)
+        spine = ElemTree.spinePattern.match(second_line)
+        if coord is not None:
+            self.type = ElemTree.COORD
+        elif pos is not None:
+            self.pos = pos.group(1)
+            self.bidirectionalParserOutput = True
+        elif spine is not None:
+            spine = spine.group(1)
+            self.type = ElemTree.SPINE_TYPES.get(spine[:1], self.type)
+            self.rootOfSpine = SpinalNode(spine[2:], self)
+
+        self.attachments = [TAGAttachment(self, line) for line in lines[2:]]
+
+    def complete(self):
+        for attachment in self.attachments:
+            attachment.complete()
+        self.completed = True
+
+    def checkCompletion(self):
+        if not self.completed:
+            raise UncompletedElemTreeException()
+
+    def attachesFromLeft(self):
+        return self.getSlot() == ElemTree.LEFT
+
+    def attachesFromRight(self):
+        return self.getSlot() == ElemTree.RIGHT
+
+    def getAnchor(self):
+        for node in self.getSpine().getAllNodes():
+            if node.isAnchor():
+                return node
+        return None
+
+    def getFoot(self):
+        for node in self.getSpine().getAllNodes():
+            if node.isFoot():
+                return node
+        return None
+
+    def getAttachmentSite(self):
+        self.checkCompletion()
+        if self.isRoot():
+            return None
+        return self.parent.getSpinalNodeAt(self.attachmentToParent.getGornAddress())
+
+    def getAttachmentToParent(self):
+        return self.attachmentToParent
+
+    def getAttachmentType(self):
+        if self.isRoot():
+            return ElemTree.ROOT
+        return self.attachmentToParent.getType()
+
+    def getAttachments(self):
+        return self.attachments
+
+    def getChildren(self):
+        self.checkCompletion()
+        return [attachment.getChild() for attachment in self.attachments]
+
+    def getChildrenSpans(self):
+        self.checkCompletion()
+        return [attachment.getChild().getSpan() for attachment in self.attachments]
+
+    def getDominatedElemTrees(self):
+        return [tree for tree in self.getSentence().getElemTrees() if self.dominates(tree)]
+
+    def getDominatedTerminals(self):
+        return [tree.getTerminal() for tree in self.getDominatedElemTrees()]
+
+    def getSurfaceString(self):
+        return " ".join(self.getDominatedTerminals())
+
+    def getNumber(self):
+        self.checkCompletion()
+        return self.number
+
+    def getPASLoc(self):
+        """
+        The location of this tree's predicate in Propbank, or None outside of the treebank
+        """
+        if self.getSectionNumber() == -1 or self.getFileNumber() == -1:
+            return None
+        section, file_number = [n if len(n) > 1 else "0" + n for n in [str(self.getSectionNumber()), str(self.getFileNumber())]]
+        path = "wsj/" + section + "/wsj_" + section + file_number + ".mrg"
+        return PASLoc(path, self.getSentenceNumber(), self.getNumber())
+
+    def getPOS(self):
+        if self.pos is not None:
+            return self.pos
+        anchor = self.getAnchor()
+        if anchor is None:
+            return "NA"
+        return anchor.getLabel()
+
+    def getParent(self):
+        self.checkCompletion()
+        return self.parent
+
+    def getSentence(self):
+        return self.containingSentence
+
+    def getSectionNumber(self):
+        return self.containingSentence.getSectionNumber()
+
+    def getFileNumber(self):
+        return self.containingSentence.getFileNumber()
+
+    def getSentenceNumber(self):
+        return self.containingSentence.getSentenceNumber()
+
+    def getSlot(self):
+        if self.isRoot():
+            return ElemTree.ROOT
+        return self.slot
+
+    def getSpan(self):
+        self.checkCompletion()
+        if self.span is None:
+            self.computeSpan()
+        return self.span
+
+    def computeSpan(self):
+        lexical_span = WordSpan(self.number, self.number)
+        if self.getType() == ElemTree.COORD:
+            self.span = WordSpan.merge(self.getChildrenSpans())
+        elif self.hasChildren():
+            self.span = WordSpan.combine(lexical_span, WordSpan.merge(self.getChildrenSpans()))
+        else:
+            self.span = lexical_span
+
+    def getSpinalNodeAt(self, address):
+        self.checkCompletion()
+        if address[0] != 0:
+            raise ValueError("Bad GornAddress: " + address.toString())
+        node = self.getSpine()
+        for child in address[1:]:
+            node = node.getChild(child)
+        return node
+
+    def getSpine(self):
+        self.checkCompletion()
+        return self.rootOfSpine
+
+    def getTerminal(self):
+        self.checkCompletion()
+        return self.terminal
+
+    def getType(self):
+        self.checkCompletion()
+        return self.type
+
+    def getTypeAsString(self):
+        self.checkCompletion()
+        return ElemTree.TYPE_STRINGS.get(self.type, "unknown")
+
+    def isCoord(self):
+        return self.type == ElemTree.COORD
+
+    def isAuxiliary(self):
+        return self.type == ElemTree.AUXILIARY
+
+    def isInitial(self):
+        return self.type == ElemTree.INITIAL
+
+    def isOfUnknownType(self):
+        return self.type == ElemTree.UNKNOWN
+
+    def isEmptyElement(self):
+        if self.isCoord():
+            return False
+        return "*" in self.getTerminal() and "\\*" not in self.getTerminal()
+
+    def isRoot(self):
+        return self.getParent() is None
+
+    def hasChildren(self):
+        return len(self.getChildren()) > 0
+
+    def isBidirectionalParserOutput(self):
+        return self.bidirectionalParserOutput
+
+    def dominates(self, other):
+        if self is other or self.isParentOf(other):
+            return True
+        return not other.isRoot() and self.dominates(other.getParent())
+
+    def isParentOf(self, other):
+        # As in the Java API, only the last child is compared
+        children = self.getChildren()
+        return len(children) > 0 and children[-1] is other
+
+    def toString(self):
+        self.checkCompletion()
+        if self.type == ElemTree.COORD:
+            lines = ["&%d" % self.number]
+        else:
+            lines = ["#%d %s" % (self.number, self.terminal)]
+
+        if self.bidirectionalParserOutput:
+            lines.append(" pos: " + self.getPOS())
+        elif self.rootOfSpine is not None:
+            lines.append(" spine: " + ElemTree.SPINE_CHARS.get(self.type, "") + "_" + self.rootOfSpine.toString())
+        elif self.type == ElemTree.COORD:
+            lines.append(" coord")
+
+        lines.extend(attachment.toString() for attachment in self.attachments)
+        return "\n".join(lines) + "\n"
+
+    __str__ = toString
+
+    def __repr__(self):
+        return "<ElemTree #%d %s>" % (self.number, self.terminal)
+
+class Sentence(object):
+    """
+    A sentence of the treebank: its location, the number of its root and its elementary trees, e.g.
+        2 11 4
+        root 3
+        #0 ...
+    """
+    elemTreePattern = re.compile(r"^[#|&]", re.MULTILINE)
+    multirootedParses = 0
+
+    def __init__(self, representation):
+        self.skip = False
+        self.sectionNumber = -1
+        self.fileNumber = -1
+        self.sentenceNumber = -1
+        self.root = None
+        self.elemTrees = []
+        self.spanTable = None
+        self.loadFromStringRepresentation(representation)
+
+    @staticmethod
+    def ofString(representation):
+        return Sentence(representation)
+
+    def loadFromStringRepresentation(self, representation):
+        lines = representation.split("\n", 2)
+        locations = java_split(" ", lines[0])
+        try:
+            if len(locations) == 1:
+                self.sentenceNumber = parse_int(locations[0])
+            elif len(locations) == 3:
+                self.sectionNumber, self.fileNumber, self.sentenceNumber = [parse_int(l) for l in locations]
+            else:
+                raise ElemTreeFormatException("Invalid sentence number " + lines[0])
+        except ValueError:
+            raise ElemTreeFormatException("Invalid sentence number " + lines[0])
+
+        if lines[1] == "skip":
+            self.skip = True
+            return
+
+        root_parts = java_split(r"\s+", lines[1])
+        if len(root_parts) > 2:
+            sys.stderr.write("WARNING: %s has a multirooted parse (\"%s\"). Only the first root has been read in.\n" % (self.prettyPrintLocation(), lines[1]))
+            Sentence.multirootedParses += 1
+        if len(root_parts) < 2:
+            sys.stderr.write("WARNING: Bad root: %s\n" % self.prettyPrintLocation())
+        try:
+            root_number = parse_int(root_parts[1])
+        except ValueError:
+            raise ElemTreeFormatException("Invalid root number: " + lines[1][5:])
+
+        representations = java_split(Sentence.elemTreePattern, lines[2])
+        self.elemTrees = [ElemTree(self, r) for r in representations[1:]]
+        self.root = self.elemTrees[root_number]
+        for tree in self.elemTrees:
+            tree.complete()
+
+    @staticmethod
+    def readTree(f):
+        """
+        Reads the next sentence from a file of sentences separated by blank lines, or returns None at the end
+        """
+        lines = []
+        for line in iter(f.readline, ''):
+            if line.strip() == '':
+                break
+            lines.append(line.rstrip("\r\n") + "\n")
+        if len(lines) == 0:
+            return None
+        return Sentence("".join(lines))
+
+    def checkSkipped(self):
+        if self.skip:
+            raise SkippedSentenceException(self)
+
+    def getLocation(self):
+        location = ""
+        if self.sectionNumber != -1 and self.fileNumber != -1:
+            location = "%d %d " % (self.sectionNumber, self.fileNumber)
+        return location + str(self.sentenceNumber)
+
+    def prettyPrintLocation(self):
+        location = ""
+        if self.sectionNumber != -1 and self.fileNumber != -1:
+            location = "Section: %d  File: %d  " % (self.sectionNumber, self.fileNumber)
+        return location + "Sentence: %d" % self.sentenceNumber
+
+    def getSubTree(self, start, end=None):
+        """
+        The elementary tree spanning exactly from start to end, which can also be given as a WordSpan
+        """
+        if end is None:
+            start, end = start.start(), start.end()
+        self.checkSkipped()
+        if self.length() - 1 < end:
+            raise ValueError("Attempted to retrieve a subtree from a WordSpan that spans outside of the sentence")
+        for tree in self.getElemTrees(start, end):
+            span = tree.getSpan()
+            if span.start() == start and span.end() == end:
+                return tree
+        return None
+
+    def subTreeForSpan(self, word_span):
+        self.checkSkipped()
+        if self.spanTable is None:
+            self.spanTable = dict((tree.getSpan(), tree) for tree in self.elemTrees)
+        return self.spanTable.get(word_span)
+
+    def computeSpanTable(self):
+        self.checkSkipped()
+        self.spanTable = dict((tree.getSpan(), tree) for tree in self.elemTrees)
+
+    def isBidirectionalParserOutput(self):
+        return self.getRoot().isBidirectionalParserOutput()
+
+    def isSkipped(self):
+        return self.skip
+
+    def getSentenceNumber(self):
+        return self.sentenceNumber
+
+    def getSectionNumber(self):
+        return self.sectionNumber
+
+    def getFileNumber(self):
+        return self.fileNumber
+
+    def containsAttachment(self):
+        self.checkSkipped()
+        return any(tree.isInitial() for tree in self.elemTrees)
+
+    def containsAdjunction(self):
+        self.checkSkipped()
+        return any(tree.isAuxiliary() for tree in self.elemTrees)
+
+    def containsCoordination(self):
+        self.checkSkipped()
+        return any(tree.isCoord() for tree in self.elemTrees)
+
+    def length(self):
+        self.checkSkipped()
+        return len(self.elemTrees)
+
+    def getRoot(self):
+        self.checkSkipped()
+        return self.root
+
+    def elemTreesIterator(self):
+        self.checkSkipped()
+        return iter(self.elemTrees)
+
+    def getElemTree(self, n):
+        self.checkSkipped()
+        return self.elemTrees[n]
+
+    def getElemTrees(self, start=None, end=None):
+        self.checkSkipped()
+        if start is None:
+            return self.elemTrees
+        return self.elemTrees[start:end + 1]
+
+    def toString(self):
+        if self.skip:
+            return self.getLocation() + "\nskip\n\n"
+        return self.getLocation() + "\nroot %d\n" % self.root.getNumber() + "".join(tree.toString() for tree in self.elemTrees) + "\n"
+
+    __str__ = toString
+
+    def __repr__(self):
+        return "<Sentence %s>" % self.getLocation()
+
+def sentence_summary(sentence):
+    """
+    Everything the extraction reads from a sentence, as plain strings, for comparing the two readers
+    """
+    if sentence.isSkipped():
+        return ['skip']
+
+    summary = [str(sentence.toString()), str(sentence.getRoot().getNumber())]
+    for tree in sentence.getElemTrees():
+        summary.append("%s|%s|%s|%s|%s|%s" % (tree.getNumber(), tree.getTypeAsString(), tree.getSpine(), tree.getTerminal(), tree.getSpan().toString(), tree.getPASLoc()))
+        for attachment in tree.getAttachments():
+            summary.append("%s|%s" % (attachment.getGeneralString(), attachment.getChild().getSpan().toString()))
+    return summary
+
+def compare_with_java(filenames):
+    """
+    Under jython, parses every file with the Java API and with this module and returns the files they disagree on
+    """
+    import edu.upenn.cis.spinal
+
+    mismatches = []
+    for filename in filenames:
+        with open(filename) as f:
+            text = f.read()
+        if sentence_summary(edu.upenn.cis.spinal.Sentence(text)) != sentence_summary(Sentence(text)):
+            mismatches.append(filename)
+    return mismatches
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == 'compare':
+        mismatches = compare_with_java(sys.argv[2:])
+        print("%d of %d files differ" % (len(mismatches), len(sys.argv) - 2))
+        for filename in mismatches:
+            print(filename)
+    elif len(sys.argv) > 1:
+        for filename in sys.argv[1:]:
+            with open(filename) as f:
+                sys.stdout.write(Sentence(f.read()).toString())
+    else:
+        print("usage: python spinal_derivation.py <sentence_file> ...\n       jython spinal_derivation.py compare <sentence_file> ...")
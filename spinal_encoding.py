@@ -0,0 +1,184 @@
+"""
+Compact encoding of derived trees as the derivation steps that built them from a SpinalGrammar,
+for moving search states between processes and checkpointing them in a few bytes each
+"""
+
+import sys
+from spinal.spinal_grammar import SpinalGrammar
+
+ENCODING_VERSION = 1
+
+def write_varint(out, value):
+    """
+    Appends a non-negative int to a bytearray, 7 bits per byte with the high bit marking continuation
+    """
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, offset):
+    """
+    Returns (value, next offset) of the varint at offset
+    """
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def grammar_cache(grammar, name, build):
+    """
+    Returns build(grammar.trees), cached on the grammar as name until grammar.trees is replaced or changes length.
+    The cache keeps the list it was built from, so that a new list reusing the id of a freed one is not mistaken for it
+    """
+    cached = getattr(grammar, name, None)
+    if cached is None or cached[0] is not grammar.trees or cached[1] != len(grammar.trees):
+        cached = (grammar.trees, len(grammar.trees), build(grammar.trees))
+        setattr(grammar, name, cached)
+    return cached[2]
+
+def tree_positions(grammar):
+    """
+    Maps each tree of the grammar (by identity) to its index in grammar.trees, cached on the grammar
+    """
+    return grammar_cache(grammar, '_tree_positions', lambda trees: dict((id(tree), i) for i, tree in enumerate(trees)))
+
+def elementary_key(tree):
+    """
+    Identifies an elementary tree across copies (unpickled, materialized from a store or thawed) by its tree id,
+    lexicalization and number of rules. A derived tree has more leaves or fewer rules than the grammar tree
+    it started from, so it never has the key of one
+    """
+    return (tree.tree_id, tuple(tree.leaves()), len(tree.all_rules()))
+
+def _tree_keys(trees):
+    keys = {}
+    for i, tree in enumerate(trees):
+        keys.setdefault(elementary_key(tree), i)
+    return keys
+
+def tree_keys(grammar):
+    """
+    Maps the elementary_key of each tree of the grammar to its index in grammar.trees, cached on the grammar
+    """
+    return grammar_cache(grammar, '_tree_keys', _tree_keys)
+
+class Derivation(object):
+    """
+    A derived tree as the steps that built it: the index of its initial tree in grammar.trees, then one
+    (grammar tree index, host treeposition, rule index) step per attachment, where the rule index is
+    the position of the attaching rule among the host node's rules when it was used.
+    An empty derivation (initial is None) stands for a state without a tree
+    """
+    def __init__(self, grammar_size, initial=None, steps=()):
+        self.grammar_size = grammar_size
+        self.initial = initial
+        self.steps = tuple(steps)
+
+    def __repr__(self):
+        return "<Derivation: initial=%s, %d steps>" % (self.initial, len(self.steps))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __eq__(self, other):
+        return isinstance(other, Derivation) and (self.grammar_size, self.initial, self.steps) == (other.grammar_size, other.initial, other.steps)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @classmethod
+    def from_tree(cls, tree, grammar):
+        """
+        Returns the derivation recorded on a tree by attach_at. Every tree it used must be in grammar.trees,
+        or be a copy of one (such as a tree materialized from a CompactTreeStore or unpickled), which is
+        resolved to it by its elementary_key
+        """
+        if tree is None:
+            return cls(len(grammar.trees))
+
+        positions = tree_positions(grammar)
+        def position(grammar_tree):
+            i = positions.get(id(grammar_tree))
+            if i is None:
+                i = tree_keys(grammar).get(elementary_key(grammar_tree))
+            if i is None:
+                raise ValueError("%s is neither a tree of %s nor a copy of one; a derived tree whose recorded derivation "
+                                 "was lost (e.g. by pickling) can not be encoded" % (" ".join(grammar_tree.leaves()), grammar))
+            return i
+
+        recorded = tree.root()._derivation or (tree.root(),)
+        steps = [(position(att_tree), treeposition, rule_index) for att_tree, treeposition, rule_index in recorded[1:]]
+        return cls(len(grammar.trees), position(recorded[0]), steps)
+
+    def replay(self, grammar):
+        """
+        Rebuilds the derived tree against the grammar it was recorded with
+        """
+        if self.grammar_size != len(grammar.trees):
+            raise ValueError("derivation was recorded against a grammar of %d trees, not %d" % (self.grammar_size, len(grammar.trees)))
+        if self.initial is None:
+            return None
+
+        tree = grammar.trees[self.initial]
+        for tree_index, treeposition, rule_index in self.steps:
+            tree = tree.attach_at(grammar.trees[tree_index], treeposition, tree[treeposition].rules[rule_index])
+        return tree
+
+    def to_bytes(self):
+        """
+        Version, grammar size, initial tree index + 1 (0 for none) and step count, then for each step
+        the tree index, treeposition length, treeposition and rule index, all as varints
+        """
+        out = bytearray()
+        write_varint(out, ENCODING_VERSION)
+        write_varint(out, self.grammar_size)
+        write_varint(out, 0 if self.initial is None else self.initial + 1)
+        write_varint(out, len(self.steps))
+        for tree_index, treeposition, rule_index in self.steps:
+            write_varint(out, tree_index)
+            write_varint(out, len(treeposition))
+            for i in treeposition:
+                write_varint(out, i)
+            write_varint(out, rule_index)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, offset = read_varint(data, 0)
+        if version != ENCODING_VERSION:
+            raise ValueError("derivation has encoding version %d, expected %d" % (version, ENCODING_VERSION))
+        grammar_size, offset = read_varint(data, offset)
+        initial, offset = read_varint(data, offset)
+        num_steps, offset = read_varint(data, offset)
+
+        steps = []
+        for _ in range(num_steps):
+            tree_index, offset = read_varint(data, offset)
+            length, offset = read_varint(data, offset)
+            treeposition = []
+            for _ in range(length):
+                i, offset = read_varint(data, offset)
+                treeposition.append(i)
+            rule_index, offset = read_varint(data, offset)
+            steps.append((tree_index, tuple(treeposition), rule_index))
+        return cls(grammar_size, None if initial == 0 else initial - 1, steps)
+
+def demo(filename="output/compressed_trees.json"):
+    grammar = SpinalGrammar.from_file(filename=filename)
+    tree = grammar.tree_dict[grammar.start][0]
+    while not tree.terminal_tree():
+        tree = [d for pos in tree.open_actions() for t in grammar.tree_dict[pos] for d in tree.attach(t)][0]
+
+    derivation = Derivation.from_tree(tree, grammar)
+    data = derivation.to_bytes()
+    print(tree)
+    print(derivation, "%d bytes" % len(data))
+    print(Derivation.from_bytes(data).replay(grammar))
+
+if __name__ == "__main__":
+    demo(*sys.argv[1:])
@@ -0,0 +1,286 @@
+"""
+Streams sentences from random derivations of a SpinalGrammar. Run as a module from the directory containing output/:
+    python -m spinal.spinal_generator [n] [processes] [seed]
+"""
+
+import itertools, random, sys, time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from spinal.spinal_grammar import SpinalGrammar, INFINITY
+
+class GeneratorStats(object):
+    """
+    Counters collected while generating, used to report throughput
+    """
+    def __init__(self):
+        self.sentences = 0
+        self.attempts = 0
+        self.abandoned = 0
+        self.steps = 0
+        self.elapsed = 0.0
+
+    def merge(self, other):
+        self.sentences += other.sentences
+        self.attempts += other.attempts
+        self.abandoned += other.abandoned
+        self.steps += other.steps
+        return self
+
+    def sentences_per_second(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.sentences / self.elapsed
+
+    def __repr__(self):
+        return "<GeneratorStats: %d sentences, %d attempts, %d abandoned, %d steps, %.3fs, %.1f sentences/s>" % (
+            self.sentences, self.attempts, self.abandoned, self.steps, self.elapsed, self.sentences_per_second())
+
+class SentenceGenerator(object):
+    """
+    Generates derived trees by random derivations: the initial tree and every attached tree are drawn
+    in proportion to their lexicalization counts, at a location drawn uniformly from the feasible ones.
+    A derivation is abandoned and started over when it reaches a dead end, or exceeds max_depth attachments
+    or max_length words. With completable_only, trees that can never be completed (see CompletionTables)
+    are never drawn, and a derivation is abandoned as soon as the tables show it needs more than max_depth
+    attachments. Derivations are reproducible for a given seed. After max_failures abandoned derivations
+    in a row generation stops with a RuntimeError, rather than retrying forever.
+    Counters go to stats, a new GeneratorStats unless one is given
+    """
+    def __init__(self, grammar, seed=None, max_depth=None, max_length=None, completable_only=True, max_failures=10000, stats=None):
+        self.grammar = grammar
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+        self.max_length = max_length
+        self.completable_only = completable_only
+        self.max_failures = max_failures
+        self.stats = stats if stats is not None else GeneratorStats()
+        self._open_positions = {}
+
+        completion = self.completion = grammar.completion() if completable_only else None
+        self.choices = {}
+        for label, trees in grammar.tree_dict.items():
+            if completion is not None:
+                trees = [tree for tree in trees if completion.tree_cost(tree) < INFINITY]
+            if len(trees) > 0:
+                weights = [getattr(tree, 'lexicalization_count', None) or 1 for tree in trees]
+                self.choices[label] = (trees, list(itertools.accumulate(weights)))
+
+        if grammar.start not in self.choices:
+            raise ValueError("%s has no %strees for its start symbol %s" % (grammar, "completable " if completable_only else "", grammar.start))
+        if completion is not None and max_depth is not None and completion.label_cost(grammar.start) > max_depth:
+            raise ValueError("%s has no derivations of %d attachments or less" % (grammar, max_depth))
+
+    def __repr__(self):
+        return "<SentenceGenerator: seed=%s, max_depth=%s, max_length=%s>" % (self.seed, self.max_depth, self.max_length)
+
+    def choose(self, label):
+        trees, cum_weights = self.choices[label]
+        return self.random.choices(trees, cum_weights=cum_weights)[0]
+
+    def open_positions(self, tree):
+        """
+        The treepositions of the nodes of a grammar tree that have rules left, cached per tree
+        """
+        positions = self._open_positions.get(id(tree))
+        if positions is None:
+            positions = self._open_positions[id(tree)] = [node.treeposition() for node in tree.subtrees() if len(node.rules) > 0]
+        return positions
+
+    def advance(self, frontier, tree, position, insertion, index, att_tree):
+        """
+        Updates the frontier (the sorted treepositions of the nodes with rules left) after att_tree was attached
+        at index of the node at insertion, by a rule of the node at position. Later siblings and their subtrees
+        shift by one, the host leaves the frontier once its rules are used up, and the attached tree's own
+        open positions join it
+        """
+        depth = len(insertion)
+        updated = []
+        for p in frontier:
+            if len(p) > depth and p[depth] >= index and p[:depth] == insertion:
+                p = p[:depth] + (p[depth] + 1,) + p[depth + 1:]
+            if p != position or len(tree[p].rules) > 0:
+                updated.append(p)
+        updated.extend(insertion + (index,) + p for p in self.open_positions(att_tree))
+        updated.sort()
+        return updated
+
+    def locations(self, tree, frontier=None):
+        """
+        Returns the (node, rule) pairs a drawn tree can be attached at, or None if the tree has applicable
+        rules but none of them can be used, so it can not be completed. Only the nodes at the frontier's
+        treepositions are visited, or every node without one
+        """
+        if frontier is None:
+            frontier = [node.treeposition() for node in tree.subtrees()]
+        locations = self._locations(tree, frontier)
+        return None if locations is None else [(node, rule) for node, rule, _, _ in locations]
+
+    def _locations(self, tree, frontier):
+        locations = []
+        applicable = False
+        for position in frontier:
+            node = tree[position]
+            rules = node.applicable_rules()
+            if len(rules) == 0:
+                continue
+            applicable = True
+            spine_index = node.spine_index()
+            for rule in rules:
+                if rule.pos not in self.choices:
+                    continue
+                attachment = node.attachment_index(rule, spine_index)
+                if attachment is not None:
+                    locations.append((node, rule, position, attachment))
+        if applicable and len(locations) == 0:
+            return None
+        return locations
+
+    def too_deep(self, tree, depth):
+        """
+        Whether a tree derived in depth attachments can not be completed within max_depth
+        """
+        if self.max_depth is None:
+            return False
+        if self.completion is not None:
+            depth += self.completion.remaining_cost(tree)
+        return depth > self.max_depth
+
+    def derive(self):
+        """
+        Makes one attempt at a derivation, returning the derived tree or None if it was abandoned
+        """
+        self.stats.attempts += 1
+        tree = self.choose(self.grammar.start)
+        frontier = list(self.open_positions(tree))
+        depth = 0
+        while not self.too_deep(tree, depth):
+            locations = self._locations(tree, frontier)
+            if locations is None:
+                break
+            if len(locations) == 0:
+                self.stats.sentences += 1
+                return tree
+
+            node, rule, position, (insertion_node, index) = self.random.choice(locations)
+            insertion = insertion_node.treeposition()
+            att_tree = self.choose(rule.pos)
+            tree = tree.attach_at(att_tree, position, rule)
+            frontier = self.advance(frontier, tree, position, insertion, index, att_tree)
+            depth += 1
+            self.stats.steps += 1
+            if self.max_length is not None and len(tree.leaf_tuple()) > self.max_length:
+                break
+
+        self.stats.abandoned += 1
+        return None
+
+    def _derivations(self, n):
+        count = 0
+        failures = 0
+        while n is None or count < n:
+            tree = self.derive()
+            if tree is not None:
+                count += 1
+                failures = 0
+                yield tree
+                continue
+            failures += 1
+            if failures >= self.max_failures:
+                raise RuntimeError("abandoned %d derivations in a row: %s" % (failures, self.stats))
+
+    def trees(self, n=None):
+        """
+        Yields n derived trees, or indefinitely if n is None, drawn with the generator's own random state
+        """
+        start = time.time()
+        try:
+            for tree in self._derivations(n):
+                self.stats.elapsed = time.time() - start
+                yield tree
+        finally:
+            self.stats.elapsed = time.time() - start
+
+    def sentences(self, n=None, processes=1, chunk_size=100):
+        """
+        Yields n sentences, or indefinitely if n is None, in chunks of chunk_size sentences that are each
+        seeded from the seed and the chunk number. With more than one process the chunks are generated by
+        forked workers sharing the grammar, and yielded in chunk order, so the output only depends on the
+        seed and chunk_size, not on the number of processes
+        """
+        start = time.time()
+        base_seed = self.seed if self.seed is not None else self.random.getrandbits(64)
+        chunks = itertools.count() if n is None else range((n + chunk_size - 1) // chunk_size)
+        remaining = n
+
+        if processes <= 1:
+            try:
+                for i in chunks:
+                    self.random.seed("%s/%d" % (base_seed, i))
+                    size = chunk_size if remaining is None else min(chunk_size, remaining - i * chunk_size)
+                    for tree in self._derivations(size):
+                        self.stats.elapsed = time.time() - start
+                        yield sentence(tree)
+            finally:
+                self.stats.elapsed = time.time() - start
+            return
+
+        options = (self.max_depth, self.max_length, self.completable_only, self.max_failures)
+
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker, initargs=(self.grammar, options)) as executor:
+            # Keep a bounded number of chunks in flight, so an endless stream does not queue work without limit
+            in_flight = []
+            chunks = iter(chunks)
+            try:
+                while True:
+                    while len(in_flight) < 2 * processes:
+                        i = next(chunks, None)
+                        if i is None:
+                            break
+                        size = chunk_size if remaining is None else min(chunk_size, remaining - i * chunk_size)
+                        in_flight.append(executor.submit(_generate_chunk, "%s/%d" % (base_seed, i), size))
+                    if len(in_flight) == 0:
+                        break
+
+                    sentences, stats = in_flight.pop(0).result()
+                    self.stats.merge(stats)
+                    self.stats.elapsed = time.time() - start
+                    for s in sentences:
+                        yield s
+            finally:
+                for future in in_flight:
+                    future.cancel()
+                self.stats.elapsed = time.time() - start
+
+def sentence(tree):
+    return " ".join(tree.leaf_tuple())
+
+# The generator of a worker process, built once per worker from the grammar inherited from the parent
+_worker_generator = None
+
+def _init_worker(grammar, options):
+    global _worker_generator
+    max_depth, max_length, completable_only, max_failures = options
+    _worker_generator = SentenceGenerator(grammar, max_depth=max_depth, max_length=max_length,
+                                          completable_only=completable_only, max_failures=max_failures)
+
+def _generate_chunk(seed, n):
+    generator = _worker_generator
+    generator.seed = seed
+    generator.random.seed(seed)
+    generator.stats = GeneratorStats()
+    sentences = [sentence(tree) for tree in generator.trees(n)]
+    return sentences, generator.stats
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    # Frozen before forking so that collections in the workers don't touch the shared grammar pages
+    grammar = SpinalGrammar.from_file(freeze=True)
+    generator = SentenceGenerator(grammar, seed=seed)
+    for s in generator.sentences(n, processes=processes):
+        print(s)
+    print(generator.stats, file=sys.stderr)
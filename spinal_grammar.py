@@ -1,31 +1,149 @@
-import re, os, pickle
-from collections import defaultdict
+import re, os, pickle, gc, heapq
+from collections import defaultdict, Counter
 from spinal.ltag_spinal import SpinalLTAG
 from spinal.spinal_loader import CompressedLTAGLoader
+from spinal.spinal_memory import checkpoint, track
+
+SNAPSHOT_VERSION = 1
+INFINITY = float('inf')
 
 class SpinalGrammar(object):
     """
-    Stores the grammar formed by a full set of LTAG-Spinal elementary trees
+    Stores the grammar formed by a full set of LTAG-Spinal elementary trees.
+    The trees are frozen, so states and actions share them instead of copying them
     """
     def __init__(self, trees, start_symbol, limit=None):
+        shared_rules = {}
+        for tree in trees:
+            if isinstance(tree, SpinalLTAG):
+                tree.freeze_in_place(shared_rules)
+
         self.trees = trees
         self.start = start_symbol
         self.tree_dict = defaultdict(list)
         for tree in trees:
             if limit is None or len(self.tree_dict[tree.label()]) < limit:
                 self.tree_dict[tree.label()].append(tree)
+        track(self)
 
     def __repr__(self):
         return "<SpinalGrammar: start symbol=%s, num trees=%d>" % (self.start, len(self.trees))
 
+    def index(self):
+        """
+        Returns the GrammarIndex shared by this grammar and all views derived from it.
+        The index covers all of the grammar's trees, and views start from the trees kept in tree_dict
+        (all of them unless the grammar was built with a limit)
+        """
+        if getattr(self, '_index', None) is None:
+            self._index = GrammarIndex(self.trees)
+            positions = dict((id(tree), i) for i, tree in enumerate(self.trees))
+            self._mask = self._index.mask_of(positions[id(tree)] for trees in self.tree_dict.values() for tree in trees)
+        return self._index
+
+    def completion(self):
+        """
+        Returns the CompletionTables of this grammar's trees, computed on first use
+        """
+        if getattr(self, '_completion', None) is None:
+            self._completion = CompletionTables(self)
+        return self._completion
+
+    def attachments(self):
+        """
+        Returns the spinal_attachment.AttachmentMatrix of the attach counts on this grammar's rules, built on first use
+        """
+        if getattr(self, '_attachments', None) is None:
+            from spinal.spinal_attachment import AttachmentMatrix
+            self._attachments = AttachmentMatrix.from_trees(self.trees)
+        return self._attachments
+
+    def generate(self, n=None, seed=None, max_depth=None, max_length=None, processes=1, stats=None):
+        """
+        Yields n sentences, or indefinitely if n is None, from random derivations weighted by lexicalization
+        counts. See spinal_generator.SentenceGenerator, whose counters and throughput go to stats if given
+        """
+        from spinal.spinal_generator import SentenceGenerator
+        generator = SentenceGenerator(self, seed=seed, max_depth=max_depth, max_length=max_length, stats=stats)
+        return generator.sentences(n, processes=processes)
+
+    def view(self, pos_whitelist=None, tree_whitelist=None, min_count=None, top_k=None, limit=None, start_symbol=None, completable=False):
+        """
+        Returns a SpinalGrammar over the subset of this grammar's trees that pass the filters, sharing the tree
+        objects and the index of the base grammar, so many filter combinations can be tried on one load:
+            pos_whitelist: keep trees whose pos_set() is a subset of it
+            tree_whitelist: keep trees whose string matches at least one of these regexes
+            min_count: keep trees lexicalized at least min_count times
+            top_k: keep the top_k most frequently lexicalized trees per label, after the other filters
+            limit: keep the first limit trees per label, after the other filters, as in SpinalGrammar
+            completable: keep the trees that can be completed with the trees kept by the other filters
+        """
+        index = self.index()
+        mask = self._mask
+        if pos_whitelist is not None:
+            mask &= index.pos_mask(pos_whitelist)
+        if tree_whitelist is not None:
+            mask &= index.regex_mask(tree_whitelist)
+        if min_count is not None:
+            mask &= index.count_mask(min_count)
+        if top_k is not None:
+            mask &= index.top_k_mask(top_k, mask)
+        if limit is not None:
+            mask &= index.first_k_mask(limit, mask)
+
+        grammar = self._from_mask(mask, start_symbol or self.start)
+        if completable:
+            completion = grammar.completion()
+            mask = index.mask_of(i for i in index.indices(mask) if completion.tree_cost(index.trees[i]) < INFINITY)
+            grammar = self._from_mask(mask, grammar.start)
+
+            # Removing trees that can never be completed does not change the costs of the others
+            grammar._completion = completion
+        return grammar
+
+    def _from_mask(self, mask, start_symbol):
+        index = self._index
+        grammar = SpinalGrammar.__new__(SpinalGrammar)
+        grammar.trees = index.trees_of(mask)
+        grammar.start = start_symbol
+        grammar.tree_dict = defaultdict(list)
+        for i in index.indices(mask):
+            grammar.tree_dict[index.labels[i]].append(index.trees[i])
+        grammar._index = index
+        grammar._mask = mask
+        track(grammar)
+        return grammar
+
+    def save_snapshot(self, filename):
+        save_snapshot(self.trees, filename, start_symbol=self.start)
+
     @classmethod
-    def from_file(cls, tree_loader_cls=CompressedLTAGLoader, filename="output/compressed_trees.json", pos_whitelist=None, tree_whitelist=None, limit=None, update=False):
+    def from_snapshot(cls, filename, limit=None, freeze=False):
+        """
+        Restores a grammar written by save_snapshot. See load_snapshot for freeze
+        """
+        snapshot = load_snapshot(filename, freeze=freeze)
+        return SpinalGrammar(snapshot['trees'], snapshot['start'], limit=limit)
+
+    @classmethod
+    def from_file(cls, tree_loader_cls=CompressedLTAGLoader, filename="output/compressed_trees.json", pos_whitelist=None, tree_whitelist=None, limit=None, update=False, freeze=False):
         """
         Loads the grammar from a file and returns a SpinalGrammar object
         During loading, filters according to a pos whitelist and a tree whitelist
+
+        The filtered trees are cached in a snapshot next to filename (see load_snapshot), which
+        is restored instead of reloading unless update is set, and frozen out of garbage collection
+        if freeze is set. Older pickle caches are still read
         """
+        snapshot_filename = filename.split(".")[0] + ".snapshot"
         pickle_filename = filename.split(".")[0] + ".pickle"
-        if not os.path.exists(pickle_filename) or update:
+        if os.path.exists(snapshot_filename) and not update:
+            grammar = SpinalGrammar.from_snapshot(snapshot_filename, limit=limit, freeze=freeze)
+            checkpoint("SpinalGrammar.from_file %s" % snapshot_filename, grammar.trees)
+            return grammar
+        elif os.path.exists(pickle_filename) and not update:
+            final_trees = pickle.load(open(pickle_filename, 'rb'))
+        else:
 
             if pos_whitelist is None:
                 pos_whitelist = set(["S", "NP", "NN", "VP", "VB", "VBD", "DT", 'JJ', 'ADJP', 'NNS', 'IN', 'JJR', 'JJS', 'NNP', 'PRN'])
@@ -45,8 +163,231 @@ class SpinalGrammar(object):
                     continue
 
                 final_trees.append(tree)
-            pickle.dump(final_trees, open(pickle_filename, 'wb'))
-        else:
-            final_trees = pickle.load(open(pickle_filename, 'rb'))
 
-        return SpinalGrammar(final_trees, "S", limit=limit)
+        save_snapshot(final_trees, snapshot_filename)
+        grammar = SpinalGrammar(final_trees, "S", limit=limit)
+        checkpoint("SpinalGrammar.from_file %s" % filename, grammar.trees)
+        return grammar
+
+class GrammarIndex(object):
+    """
+    Per-tree data of a list of grammar trees, kept as bitsets (python ints, bit i for trees[i])
+    from which the masks of grammar views are combined. Masks are cached per filter value,
+    and tree strings are only rendered the first time a regex filter needs them
+    """
+    def __init__(self, trees):
+        self.trees = trees
+        self.all = (1 << len(trees)) - 1
+        self.labels = [tree.label() for tree in trees]
+        self.counts = [getattr(tree, 'lexicalization_count', None) or 0 for tree in trees]
+
+        label_indices = defaultdict(list)
+        pos_indices = defaultdict(list)
+        for i, tree in enumerate(trees):
+            label_indices[self.labels[i]].append(i)
+            for pos in tree.pos_set():
+                pos_indices[pos].append(i)
+
+        self.label_indices = dict(label_indices)
+        self.pos_masks = dict((pos, self.mask_of(indices)) for pos, indices in pos_indices.items())
+
+        # Tree indices of each label, most frequently lexicalized first
+        self.label_ranking = dict((label, sorted(indices, key=lambda i: -self.counts[i])) for label, indices in self.label_indices.items())
+
+        self._strings = None
+        self._regex_masks = {}
+        self._count_masks = {}
+
+    def __repr__(self):
+        return "<GrammarIndex: %d trees, %d labels>" % (len(self.trees), len(self.label_indices))
+
+    def indices(self, mask):
+        bits = bin(mask)[:1:-1]
+        return [i for i, bit in enumerate(bits) if bit == '1']
+
+    def mask_of(self, indices):
+        # Built from a bit string, since or-ing in one bit at a time copies the whole int each time
+        bits = bytearray(b'0' * len(self.trees))
+        for i in indices:
+            bits[i] = ord('1')
+        return int(bytes(bits[::-1]) or b'0', 2)
+
+    def trees_of(self, mask):
+        return [self.trees[i] for i in self.indices(mask)]
+
+    def pos_mask(self, pos_whitelist):
+        """
+        Trees using no POS outside of pos_whitelist
+        """
+        excluded = 0
+        for pos, mask in self.pos_masks.items():
+            if pos not in pos_whitelist:
+                excluded |= mask
+        return self.all & ~excluded
+
+    def regex_mask(self, tree_whitelist):
+        """
+        Trees whose string matches any of the regexes in tree_whitelist
+        """
+        if self._strings is None:
+            self._strings = [str(tree) for tree in self.trees]
+
+        mask = 0
+        for pattern in tree_whitelist:
+            if pattern not in self._regex_masks:
+                regex = re.compile(pattern)
+                self._regex_masks[pattern] = self.mask_of(i for i, string in enumerate(self._strings) if regex.search(string) is not None)
+            mask |= self._regex_masks[pattern]
+        return mask
+
+    def count_mask(self, min_count):
+        if min_count not in self._count_masks:
+            self._count_masks[min_count] = self.mask_of(i for i, count in enumerate(self.counts) if count >= min_count)
+        return self._count_masks[min_count]
+
+    def top_k_mask(self, k, mask):
+        """
+        The k most frequently lexicalized trees of each label among the trees in mask
+        """
+        return self._first_k(self.label_ranking, k, mask)
+
+    def first_k_mask(self, k, mask):
+        """
+        The first k trees of each label among the trees in mask
+        """
+        return self._first_k(self.label_indices, k, mask)
+
+    def _first_k(self, label_order, k, mask):
+        allowed = set(self.indices(mask))
+        selected = []
+        for ordered in label_order.values():
+            selected.extend([i for i in ordered if i in allowed][:k])
+        return self.mask_of(selected)
+
+class CompletionTables(object):
+    """
+    Reachability and completion costs of the trees of a grammar, computed once:
+        opens: the POS labels a tree's rules open, i.e. the root labels of the trees it needs attached
+        tree costs: the fewest attachments that complete a tree, counting every attachment below it
+        label costs: the fewest attachments that complete some tree with the given root label
+    A tree can be completed iff its cost is finite. Slot and order constraints are ignored, so the
+    costs are lower bounds, and remaining_cost() is an admissible heuristic for searches
+    """
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.opens = {}
+        self.tree_costs = {}
+        self.label_costs = {}
+        self._reachable = {}
+
+        # Knuth's generalization of Dijkstra's algorithm: a label is settled at the cheapest cost of its trees,
+        # and a tree's cost is known once all labels it opens are settled, since it costs more than each of them
+        rule_counts = {}
+        waiting = defaultdict(list)
+        pending = {}
+        heap = []
+        for trees in grammar.tree_dict.values():
+            for tree in trees:
+                counts = Counter(r.pos for r in tree.all_rules())
+                rule_counts[id(tree)] = counts
+                self.opens[id(tree)] = frozenset(counts)
+                pending[id(tree)] = len(counts)
+                for pos in counts:
+                    waiting[pos].append(tree)
+                if len(counts) == 0:
+                    self.tree_costs[id(tree)] = 0
+                    heapq.heappush(heap, (0, tree.label()))
+
+        while len(heap) > 0:
+            cost, label = heapq.heappop(heap)
+            if label in self.label_costs:
+                continue
+            self.label_costs[label] = cost
+
+            for tree in waiting[label]:
+                pending[id(tree)] -= 1
+                if pending[id(tree)] == 0:
+                    tree_cost = sum(count * (1 + self.label_costs[pos]) for pos, count in rule_counts[id(tree)].items())
+                    self.tree_costs[id(tree)] = tree_cost
+                    heapq.heappush(heap, (tree_cost, tree.label()))
+
+    def __repr__(self):
+        completable = sum(1 for cost in self.tree_costs.values() if cost < INFINITY)
+        return "<CompletionTables: %d/%d trees completable, %d labels>" % (completable, len(self.opens), len(self.label_costs))
+
+    def tree_cost(self, tree):
+        return self.tree_costs.get(id(tree), INFINITY)
+
+    def label_cost(self, label):
+        return self.label_costs.get(label, INFINITY)
+
+    def opens_of(self, tree):
+        return self.opens[id(tree)]
+
+    def completable(self, tree):
+        """
+        Whether a grammar tree can be completed with this grammar's trees
+        """
+        return self.tree_cost(tree) < INFINITY
+
+    def reachable(self, label):
+        """
+        The labels that can occur in derivations below a tree with the given root label
+        """
+        if label not in self._reachable:
+            reachable = set()
+            queue = [label]
+            while len(queue) > 0:
+                for tree in self.grammar.tree_dict.get(queue.pop(), []):
+                    for pos in self.opens[id(tree)] - reachable:
+                        reachable.add(pos)
+                        queue.append(pos)
+            self._reachable[label] = frozenset(reachable)
+        return self._reachable[label]
+
+    def remaining_cost(self, tree):
+        """
+        Lower bound on the actions left before a derived tree is terminal, or infinity if it can never be.
+        None is the empty derivation, which needs an initial tree first
+        """
+        if tree is None:
+            return 1 + self.label_cost(self.grammar.start)
+        return sum(1 + self.label_cost(rule.pos) for rule in tree.all_rules())
+
+    def heuristic(self, state):
+        return self.remaining_cost(state.tree)
+
+def save_snapshot(trees, filename, start_symbol="S"):
+    """
+    Writes the grammar's trees with the highest pickle protocol under a versioned header.
+    Rule lists shared between lexicalizations of the same tree stay shared
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'start': start_symbol,
+        'trees': trees,
+    }
+    with open(filename, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_snapshot(filename, freeze=False):
+    """
+    Restores a snapshot with the garbage collector paused. The grammar is built from many small
+    objects that would otherwise trigger repeated full collections while loading.
+    With freeze, everything alive after loading is moved out of later collections (gc.freeze).
+    That affects the whole process, so it is left to scripts whose grammar lives as long as they do
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(filename, 'rb') as f:
+            snapshot = pickle.load(f)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if freeze:
+        gc.freeze()
+
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("%s has snapshot version %s, expected %s" % (filename, snapshot.get('version'), SNAPSHOT_VERSION))
+    return snapshot
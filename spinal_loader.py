@@ -1,6 +1,7 @@
 import json, re, os, pickle
 from itertools import tee
 from spinal.ltag_spinal import SpinalLTAG, Rule
+from spinal.spinal_memory import checkpoint
 
 def pairwise(iterable):
     "s -> (s0,s1), (s1,s2), (s2, s3), ..."
@@ -50,6 +51,7 @@ class CompressedLTAGLoader(SpinalLTAGLoader):
             spinal_ltags = [tree for tree_dict in trees[:limit] for tree in self.parse_ltags_from_dict(tree_dict)]
         else:
             spinal_ltags = [tree for tree_dict in trees for tree in self.parse_ltags_from_dict(tree_dict)]
+        checkpoint("%s.load %s" % (self.__class__.__name__, self.filename), spinal_ltags)
         return spinal_ltags
 
     def lexicalize_tree(self, root, lexicalization_dict):
@@ -120,6 +122,7 @@ class UncompressedSpinalLTAGLoader(SpinalLTAGLoader):
             spinal_ltags = [self.parse_ltag_from_dict(tree_dict) for tree_dict in trees[:limit]]
         else:
             spinal_ltags = [self.parse_ltag_from_dict(tree_dict) for tree_dict in trees]
+        checkpoint("%s.load %s" % (self.__class__.__name__, self.filename), spinal_ltags)
         return spinal_ltags
 
     def parse_ltag_from_dict(self, tree_dict):
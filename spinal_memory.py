@@ -0,0 +1,341 @@
+"""
+Opt-in memory accounting of the loaders, grammar and searches. Nothing is measured unless enable() is
+called, or SPINAL_MEMORY is set in the environment to the number of search expansions between checkpoints
+(SPINAL_MEMORY_TRACE=1 also traces allocations). Reports go to stderr. Run as a module from the directory
+containing output/ to account for loading a grammar and a short search:
+    python -m spinal.spinal_memory [expansions between checkpoints]
+"""
+
+import gc, itertools, os, sys, time, tracemalloc, weakref
+from spinal.ltag_spinal import SpinalLTAG, Rule, ActionLocation
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Components in report order. Lexicalized copies are the nodes of every lexicalized tree after the first one
+# with the same tree_id, which are counted there instead of under nodes
+COMPONENTS = ('nodes', 'lexicalized copies', 'rules', 'caches', 'states', 'grammar')
+
+# Per-node cached values, see SpinalLTAG
+NODE_CACHES = ('_hash', '_leaf_tuple', '_node_count', '_flat_length', '_lengths', '_string', '_spine_index', '_derivation')
+
+# Grammars registered by track(), which census walks even when gc.freeze has hidden them from the collector
+_tracked = weakref.WeakSet()
+
+def track(grammar):
+    _tracked.add(grammar)
+
+def deep_size(obj, seen, skip=(SpinalLTAG, Rule), attributes=False):
+    """
+    Size of a container and everything it holds, counting each object once across calls sharing seen.
+    Instances of skip (by default trees and rules, which are left to their own components) count nothing,
+    and with attributes the attribute dicts of other objects are followed too
+    """
+    if id(obj) in seen or isinstance(obj, skip):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen, skip, attributes) + deep_size(v, seen, skip, attributes) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen, skip, attributes) for item in obj)
+    if attributes and hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += deep_size(obj.__dict__, seen, skip, attributes)
+    return size
+
+class ComponentUsage(object):
+    """
+    The number of objects of one component and the bytes they take up
+    """
+    def __init__(self, name, count=0, size=0):
+        self.name = name
+        self.count = count
+        self.bytes = size
+
+    def add(self, size, count=1):
+        self.count += count
+        self.bytes += size
+
+    def __repr__(self):
+        return "<ComponentUsage: %s, %d objects, %s>" % (self.name, self.count, format_bytes(self.bytes))
+
+def tree_objects(trees):
+    for tree in trees:
+        for node in tree.subtrees():
+            yield node
+            for rule in node.rules:
+                yield rule
+                yield rule.action_location
+
+def census(trees=None):
+    """
+    Counts the live objects of each component, found through the garbage collector, from trees and from
+    the tracked grammars. trees, if given, are the loaded or grammar trees. load_snapshot can freeze objects
+    out of the collector's sight (gc.freeze), so the trees and caches of every tracked grammar are walked
+    explicitly; other frozen objects, such as states alive when a snapshot was loaded, are not counted.
+    Lexicalized copies are told apart within each list of trees
+    """
+    # Imported here, as the grammar and state modules report to this one
+    from spinal.spinal_grammar import SpinalGrammar, GrammarIndex, CompletionTables
+    from spinal.spinal_state import SpinalState, TranspositionEntry, TranspositionTable
+
+    grammars = list(_tracked)
+    tree_lists = ([trees] if trees is not None else []) + [grammar.trees for grammar in grammars]
+
+    copies = set()
+    firsts = set()
+    for tree_list in tree_lists:
+        seen_ids = set()
+        for tree in tree_list:
+            tree_id = getattr(tree, 'tree_id', None)
+            if tree_id is None or getattr(tree, 'lexicalization_count', None) is None:
+                continue
+            if tree_id in seen_ids:
+                copies.update(id(node) for node in tree.subtrees())
+            else:
+                firsts.update(id(node) for node in tree.subtrees())
+            seen_ids.add(tree_id)
+    # A tree can be a copy in one list (such as a grammar view) and the first of its tree_id in another
+    copies -= firsts
+
+    roots = itertools.chain(grammars, (value for grammar in grammars for name, value in grammar.__dict__.items() if name.startswith('_')))
+    tree_walk = itertools.chain.from_iterable(tree_objects(tree_list) for tree_list in tree_lists)
+
+    components = dict((name, ComponentUsage(name)) for name in COMPONENTS)
+    seen = set()
+    counted = set()
+    for obj in itertools.chain(tree_walk, roots, gc.get_objects()):
+        if id(obj) in counted:
+            continue
+        counted.add(id(obj))
+
+        if isinstance(obj, SpinalLTAG):
+            state = obj.__dict__
+            component = components['lexicalized copies' if id(obj) in copies else 'nodes']
+            component.add(sys.getsizeof(obj) + sys.getsizeof(state) + sys.getsizeof(state.get('rules', [])))
+            caches = sum(deep_size(state[name], seen) for name in NODE_CACHES if state.get(name) is not None)
+            if caches > 0:
+                components['caches'].add(caches)
+        elif isinstance(obj, Rule):
+            size = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+            size += deep_size(getattr(obj, 'attach_counts', None), seen)
+            components['rules'].add(size)
+        elif isinstance(obj, ActionLocation):
+            state = obj.__dict__
+            components['rules'].add(sys.getsizeof(obj) + deep_size(state, seen), count=0)
+        elif isinstance(obj, (SpinalState, TranspositionEntry)):
+            components['states'].add(sys.getsizeof(obj) + sys.getsizeof(obj.__dict__))
+        elif isinstance(obj, TranspositionTable):
+            components['states'].add(sys.getsizeof(obj) + deep_size(obj.__dict__, seen))
+        elif isinstance(obj, SpinalGrammar):
+            # Underscored attributes are the grammar's caches, such as its index and completion tables
+            state = dict((name, value) for name, value in obj.__dict__.items() if not name.startswith('_'))
+            caches = dict((name, value) for name, value in obj.__dict__.items() if name.startswith('_'))
+            components['grammar'].add(sys.getsizeof(obj) + deep_size(state, seen))
+            components['caches'].add(deep_size(caches, seen), count=0)
+        elif isinstance(obj, GrammarIndex):
+            components['caches'].add(sys.getsizeof(obj) + deep_size(obj.__dict__, seen))
+        elif isinstance(obj, CompletionTables):
+            state = dict(obj.__dict__)
+            state.pop('grammar', None)
+            components['caches'].add(sys.getsizeof(obj) + deep_size(state, seen))
+    return components
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % size
+
+class MemorySnapshot(object):
+    """
+    Component usage at one checkpoint, with the traced and peak memory of the process.
+    traced and peak_traced (from tracemalloc) are None unless allocations are traced, and max_rss
+    (the peak resident size, in bytes) is None where the resource module is missing
+    """
+    def __init__(self, label, components, gc_objects, traced=None, peak_traced=None, max_rss=None, allocations=None, frozen=0):
+        self.label = label
+        self.time = time.time()
+        self.components = components
+        self.gc_objects = gc_objects
+        self.traced = traced
+        self.peak_traced = peak_traced
+        self.max_rss = max_rss
+        self.allocations = allocations
+        self.frozen = frozen
+
+    def __repr__(self):
+        return "<MemorySnapshot: %s, %s in %d gc objects>" % (self.label, format_bytes(self.total()), self.gc_objects)
+
+    def total(self):
+        return sum(usage.bytes for usage in self.components.values())
+
+    def growth(self, previous, top=5):
+        """
+        The top components that grew most since the previous snapshot, as (name, bytes, count) deltas.
+        When both snapshots traced allocations, the top growing source lines follow as (line, bytes, count)
+        """
+        deltas = []
+        for name, usage in self.components.items():
+            before = previous.components.get(name, ComponentUsage(name))
+            if usage.bytes > before.bytes:
+                deltas.append((name, usage.bytes - before.bytes, usage.count - before.count))
+        deltas.sort(key=lambda delta: -delta[1])
+        deltas = deltas[:top]
+
+        if self.allocations is not None and previous.allocations is not None:
+            for stat in self.allocations.compare_to(previous.allocations, 'lineno')[:top]:
+                if stat.size_diff > 0:
+                    frame = stat.traceback[0]
+                    deltas.append(("%s:%d" % (frame.filename, frame.lineno), stat.size_diff, stat.count_diff))
+        return deltas
+
+    def format(self, previous=None, top=5):
+        lines = ["memory at %s: %s accounted, %d gc objects" % (self.label, format_bytes(self.total()), self.gc_objects)]
+        if self.frozen > 0:
+            lines[0] += " (%d frozen, of which only tracked grammars are counted)" % self.frozen
+        if self.traced is not None:
+            lines[0] += ", %s traced (peak %s)" % (format_bytes(self.traced), format_bytes(self.peak_traced))
+        if self.max_rss is not None:
+            lines[0] += ", peak rss %s" % format_bytes(self.max_rss)
+
+        for name in COMPONENTS:
+            usage = self.components[name]
+            if usage.bytes > 0:
+                lines.append("  %-20s %10d %12s" % (name, usage.count, format_bytes(usage.bytes)))
+        if previous is not None:
+            for name, size, count in self.growth(previous, top=top):
+                lines.append("  grew since %s: %s %+d objects, +%s" % (previous.label, name, count, format_bytes(size)))
+        return "\n".join(lines)
+
+class MemoryAccountant(object):
+    """
+    Takes and keeps snapshots at checkpoints: after loading trees, after SpinalGrammar.from_file,
+    and every `every` search expansions. The peak bytes of each component over all snapshots are kept
+    in peaks. With trace, allocations are traced with tracemalloc, which slows everything down but
+    reports the peak traced memory and the source lines that grew most between snapshots
+    """
+    def __init__(self, every=1000, trace=False, top=5, out=sys.stderr):
+        self.every = every
+        self.trace = trace
+        self.top = top
+        self.out = out
+        self.snapshots = []
+        self.peaks = dict((name, 0) for name in COMPONENTS)
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __repr__(self):
+        return "<MemoryAccountant: %d snapshots, every %d expansions>" % (len(self.snapshots), self.every)
+
+    def snapshot(self, label, trees=None):
+        components = census(trees)
+        frozen = gc.get_freeze_count()
+        gc_objects = len(gc.get_objects()) + frozen
+
+        traced = peak_traced = allocations = None
+        if self.trace and tracemalloc.is_tracing():
+            traced, peak_traced = tracemalloc.get_traced_memory()
+            # Leaving out the allocations of the accounting itself
+            allocations = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+
+        max_rss = None
+        if resource is not None:
+            # Kilobytes on Linux, bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != 'darwin':
+                max_rss *= 1024
+
+        snapshot = MemorySnapshot(label, components, gc_objects, traced, peak_traced, max_rss, allocations, frozen=frozen)
+        previous = self.snapshots[-1] if len(self.snapshots) > 0 else None
+        self.snapshots.append(snapshot)
+        for name, usage in components.items():
+            self.peaks[name] = max(self.peaks[name], usage.bytes)
+
+        if self.out is not None:
+            print(snapshot.format(previous, top=self.top), file=self.out)
+        return snapshot
+
+    def largest_growth(self):
+        """
+        The growth deltas between consecutive snapshots, largest first, as (from, to, name, bytes, count)
+        """
+        deltas = []
+        for previous, snapshot in zip(self.snapshots, self.snapshots[1:]):
+            deltas.extend((previous.label, snapshot.label) + delta for delta in snapshot.growth(previous, top=len(COMPONENTS)))
+        return sorted(deltas, key=lambda delta: -delta[3])
+
+    def report(self):
+        lines = ["peak bytes per component over %d snapshots:" % len(self.snapshots)]
+        for name in COMPONENTS:
+            if self.peaks[name] > 0:
+                lines.append("  %-20s %12s" % (name, format_bytes(self.peaks[name])))
+        for before, after, name, size, count in self.largest_growth()[:self.top]:
+            lines.append("  largest growth %s -> %s: %s %+d objects, +%s" % (before, after, name, count, format_bytes(size)))
+        return "\n".join(lines)
+
+    def close(self):
+        if self.trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+_accountant = None
+
+def enable(every=1000, trace=False, top=5, out=sys.stderr):
+    """
+    Starts memory accounting, returning the MemoryAccountant that the checkpoints report to
+    """
+    global _accountant
+    if _accountant is not None:
+        _accountant.close()
+    _accountant = MemoryAccountant(every=every, trace=trace, top=top, out=out)
+    return _accountant
+
+def disable():
+    global _accountant
+    if _accountant is not None:
+        _accountant.close()
+    accountant, _accountant = _accountant, None
+    return accountant
+
+def accountant():
+    return _accountant
+
+def checkpoint(label, trees=None):
+    """
+    Takes a snapshot if accounting is enabled; otherwise does nothing
+    """
+    if _accountant is not None:
+        return _accountant.snapshot(label, trees)
+
+def search_checkpoint(search):
+    """
+    Called by searches after each expansion, taking a snapshot every `every` expansions
+    """
+    if _accountant is not None and search.stats.expansions % _accountant.every == 0:
+        return _accountant.snapshot("%s expansion %d" % (search.__class__.__name__, search.stats.expansions), search.grammar.trees)
+
+if os.environ.get("SPINAL_MEMORY"):
+    enable(every=int(os.environ["SPINAL_MEMORY"]), trace=os.environ.get("SPINAL_MEMORY_TRACE") == "1")
+
+def demo(every=100):
+    accountant = _accountant or enable(every=every)
+
+    from spinal.spinal_grammar import SpinalGrammar
+    from spinal.spinal_search import BestFirstSearch
+    from spinal.spinal_reward import SpinalReward
+    from spinal.spinal_state import TranspositionTable
+
+    grammar = SpinalGrammar.from_file()
+    reward = SpinalReward(["dog(x)", "cat(y)", "see(x, y)"], ["see(x, y)"])
+    search = BestFirstSearch(grammar, reward, k=3, max_expansions=5 * accountant.every, transpositions=TranspositionTable())
+    search.search()
+    checkpoint("search done", grammar.trees)
+    print(accountant.report(), file=sys.stderr)
+
+if __name__ == "__main__":
+    # Run as a module this file is __main__, while the loaders and searches report to spinal.spinal_memory
+    from spinal.spinal_memory import demo
+    demo(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,319 @@
+"""
+Runs the pipeline from Libin Shen's treebank to a grammar snapshot as a DAG of stages:
+    split: utils/split_tb_into_files.py, the treebank into one file per sentence in trees/
+    extract_<section>: print_generalized_trees.py, one shard of uncompressed trees per section, in parallel
+    merge: the shards into output/uncompressed_trees.json, renumbering tree ids to be unique
+    compress: compress_treebank.py, into output/compressed_trees.json
+    grammar: SpinalGrammar.from_file, into the output/compressed_trees.snapshot
+A stage is skipped when the content hashes of its inputs (code included) and its parameters match its last
+successful run and its outputs are unchanged. Run as a module from the directory containing trees/ and output/:
+    python -m spinal.spinal_pipeline run [--workers N] [stage ...]
+    python -m spinal.spinal_pipeline status
+The treebank, Propbank index and frames are found through TREEBANKDIR, PROPBANKFILE and FRAMEDIR
+"""
+
+import glob, hashlib, json, os, subprocess, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from spinal.spinal_propbank import PBConfig, compiled_filename
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+SECTIONS = list(range(25))
+TREEBANK_FILES = ["derivation.sec0-1.v01", "derivation.train.v01", "derivation.sec22.v01", "derivation.test.v01", "derivation.devel.v01"]
+
+def package_file(name):
+    return os.path.join(PACKAGE_DIR, name)
+
+class Stage(object):
+    """
+    One step of the pipeline. inputs are files, directories (all files below them) or glob patterns,
+    expanded when the stage is about to run, so they may be created by the stages it depends on
+    """
+    def __init__(self, name, action, inputs=(), outputs=(), params=None, deps=()):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.deps = list(deps)
+
+    def __repr__(self):
+        return "<Stage: %s>" % self.name
+
+    def input_files(self):
+        files = set()
+        for pattern in self.inputs:
+            if os.path.isdir(pattern):
+                for directory, _, filenames in os.walk(pattern):
+                    files.update(os.path.join(directory, f) for f in filenames)
+            elif os.path.exists(pattern):
+                files.add(pattern)
+            else:
+                files.update(glob.glob(pattern))
+        return sorted(files)
+
+class StageResult(object):
+    def __init__(self, name, status, seconds=0.0, error=None):
+        self.name = name
+        self.status = status
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self):
+        return "<StageResult: %s %s %.3fs>" % (self.name, self.status, self.seconds)
+
+class Pipeline(object):
+    """
+    Runs stages in dependency order, up to workers at a time, recording the fingerprint and outputs of every
+    successful stage in state_filename. File hashes are cached by size and modification time
+    """
+    def __init__(self, stages, state_filename="output/pipeline_state.json"):
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.state_filename = state_filename
+        self.lock = threading.Lock()
+        if os.path.exists(state_filename):
+            with open(state_filename) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {'files': {}, 'stages': {}}
+
+    def save_state(self):
+        with self.lock:
+            tmp_filename = self.state_filename + ".tmp"
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.state, f, sort_keys=True)
+            os.rename(tmp_filename, self.state_filename)
+
+    def file_hash(self, filename):
+        stat = os.stat(filename)
+        with self.lock:
+            cached = self.state['files'].get(filename)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self.lock:
+            self.state['files'][filename] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def fingerprint(self, stage):
+        sha = hashlib.sha256()
+        sha.update(json.dumps([stage.name, stage.params], sort_keys=True).encode('utf-8'))
+        for filename in stage.input_files():
+            sha.update(("%s %s\n" % (filename, self.file_hash(filename))).encode('utf-8'))
+        return sha.hexdigest()
+
+    def output_stats(self, stage):
+        stats = {}
+        for filename in stage.outputs:
+            if os.path.exists(filename):
+                stat = os.stat(filename)
+                stats[filename] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    def up_to_date(self, stage, fingerprint):
+        record = self.state['stages'].get(stage.name)
+        return (record is not None and record.get('fingerprint') == fingerprint and len(record['outputs']) == len(stage.outputs)
+                and record['outputs'] == self.output_stats(stage))
+
+    def run_stage(self, stage, force=False):
+        start = time.time()
+        fingerprint = self.fingerprint(stage)
+        if not force and self.up_to_date(stage, fingerprint):
+            return StageResult(stage.name, 'skipped', time.time() - start)
+
+        # A stage interrupted with the same inputs resumes from what it left, otherwise it starts over
+        with self.lock:
+            record = self.state['stages'].get(stage.name, {})
+            resume = record.get('running') == fingerprint
+            self.state['stages'][stage.name] = {'running': fingerprint, 'outputs': {}}
+        self.save_state()
+
+        stage.action(stage, resume)
+
+        with self.lock:
+            self.state['stages'][stage.name] = {'fingerprint': fingerprint, 'outputs': self.output_stats(stage), 'seconds': time.time() - start}
+        self.save_state()
+        return StageResult(stage.name, 'ran', time.time() - start)
+
+    def required(self, targets):
+        """
+        The targets and every stage they depend on
+        """
+        required = set()
+        queue = list(targets)
+        while len(queue) > 0:
+            name = queue.pop()
+            if name not in required:
+                required.add(name)
+                queue.extend(self.stages[name].deps)
+        return required
+
+    def run(self, targets=None, workers=None, force=False):
+        """
+        Runs the targets (by default every stage) and the stages they depend on, and returns a StageResult per stage.
+        Stages depending on a failed stage are not run
+        """
+        pending = self.required(targets or self.stages.keys())
+        results = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for name in sorted(pending):
+                    deps = self.stages[name].deps
+                    if any(results.get(d) is not None and results[d].status in ('failed', 'blocked') for d in deps):
+                        results[name] = StageResult(name, 'blocked')
+                        pending.remove(name)
+                    elif all(d in results for d in deps):
+                        running[executor.submit(self.run_stage, self.stages[name], force)] = name
+                        pending.remove(name)
+
+                if len(running) == 0:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        results[name] = StageResult(name, 'failed', error=e)
+        return [results[name] for name in self.order() if name in results]
+
+    def order(self):
+        """
+        Stage names in a topological order
+        """
+        order = []
+        visited = set()
+        def visit(name):
+            if name not in visited:
+                visited.add(name)
+                for dep in self.stages[name].deps:
+                    visit(dep)
+                order.append(name)
+        for name in sorted(self.stages):
+            visit(name)
+        return order
+
+    def status(self):
+        """
+        (stage, up to date) for every stage, without running anything
+        """
+        return [(name, self.up_to_date(self.stages[name], self.fingerprint(self.stages[name]))) for name in self.order()]
+
+def run_split(stage, resume):
+    if not os.path.exists("trees"):
+        os.makedirs("trees")
+    subprocess.check_call([sys.executable, package_file("utils/split_tb_into_files.py"), stage.params['treebank_dir'], "trees"])
+
+def run_extract(stage, resume):
+    shard = stage.outputs[0]
+    if not os.path.exists(os.path.dirname(shard)):
+        os.makedirs(os.path.dirname(shard))
+    if not resume:
+        for filename in [shard, shard + ".manifest"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    subprocess.check_call([sys.executable, package_file("print_generalized_trees.py"), str(stage.params['section']), shard, "print_trees"])
+
+    # A section without sentences still gets its (empty) shard
+    if not os.path.exists(shard):
+        open(shard, 'w').close()
+
+def merge_shards(shard_filenames, output_filename):
+    """
+    Concatenates extraction shards into one json list. Tree ids restart at 0 in every shard, so each shard's
+    tree and parent ids are offset past the previous shard's, as if the sections had been extracted in one run
+    """
+    offset = 0
+    first = True
+    tmp_filename = output_filename + ".tmp"
+    with open(tmp_filename, 'w') as output_file:
+        output_file.write("[")
+        for filename in shard_filenames:
+            next_offset = offset
+            with open(filename) as shard:
+                for line in shard:
+                    line = line.strip().rstrip(",")
+                    if len(line) == 0:
+                        continue
+                    tree = json.loads(line)
+                    next_offset = max(next_offset, offset + tree['tree_id'] + 1)
+                    tree['tree_id'] += offset
+                    if tree['parent_id'] is not None:
+                        tree['parent_id'] += offset
+                    output_file.write(("" if first else ",\n") + json.dumps(tree))
+                    first = False
+            offset = next_offset
+        output_file.write("]")
+    os.rename(tmp_filename, output_filename)
+
+def run_merge(stage, resume):
+    merge_shards(stage.params['shards'], stage.outputs[0])
+
+def run_compress(stage, resume):
+    subprocess.check_call([sys.executable, package_file("compress_treebank.py"), "parallel", str(stage.params['workers'])])
+
+def run_grammar(stage, resume):
+    from spinal.spinal_grammar import SpinalGrammar
+    SpinalGrammar.from_file(filename=stage.inputs[0], update=True)
+
+def default_stages(sections=SECTIONS, treebank_dir=None, workers=None):
+    treebank_dir = treebank_dir or PBConfig.TreeBankDir()
+    propbank_file = PBConfig.PropBankFile()
+    extraction_code = [package_file(f) for f in ["print_generalized_trees.py", "spinal_derivation.py", "spinal_propbank.py"]]
+    compression_code = [package_file(f) for f in ["compress_treebank.py", "ltag_spinal.py", "spinal_loader.py"]]
+
+    stages = [Stage("split", run_split,
+                    inputs=[os.path.join(treebank_dir, f) for f in TREEBANK_FILES] + [package_file("utils/split_tb_into_files.py")],
+                    outputs=["trees"], params={'treebank_dir': treebank_dir})]
+
+    shards = []
+    for section in sections:
+        shard = "output/shards/uncompressed_%d.json" % section
+        shards.append(shard)
+        stages.append(Stage("extract_%d" % section, run_extract,
+                            inputs=["trees/%d_*.txt" % section, propbank_file, compiled_filename(propbank_file), PBConfig.FrameDir()] + extraction_code,
+                            outputs=[shard], params={'section': section}, deps=["split"]))
+
+    stages.append(Stage("merge", run_merge, inputs=shards, outputs=["output/uncompressed_trees.json"],
+                        params={'shards': shards}, deps=["extract_%d" % s for s in sections]))
+    stages.append(Stage("compress", run_compress, inputs=["output/uncompressed_trees.json"] + compression_code,
+                        outputs=["output/compressed_trees.json"], params={'workers': workers or os.cpu_count()}, deps=["merge"]))
+    stages.append(Stage("grammar", run_grammar, inputs=["output/compressed_trees.json", package_file("spinal_grammar.py")] + compression_code,
+                        outputs=["output/compressed_trees.snapshot"], deps=["compress"]))
+    return stages
+
+def print_results(results):
+    print("%-12s %-8s %10s" % ("stage", "status", "seconds"))
+    for result in results:
+        print("%-12s %-8s %10.3f%s" % (result.name, result.status, result.seconds, "  " + repr(result.error) if result.error is not None else ""))
+    print("%-12s %-8s %10.3f" % ("total", "", sum(r.seconds for r in results)))
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] in ('run', 'status'):
+        if not os.path.exists("output"):
+            os.makedirs("output")
+        args = sys.argv[2:]
+        workers = None
+        if '--workers' in args:
+            i = args.index('--workers')
+            if i + 1 >= len(args) or not args[i + 1].isdigit():
+                print(__doc__)
+                sys.exit(1)
+            workers = int(args[i + 1])
+            args = args[:i] + args[i + 2:]
+        pipeline = Pipeline(default_stages(workers=workers))
+        if sys.argv[1] == 'status':
+            for name, up_to_date in pipeline.status():
+                print("%-12s %s" % (name, "up to date" if up_to_date else "out of date"))
+        else:
+            results = pipeline.run(targets=args or None, workers=workers)
+            print_results(results)
+            if any(r.status in ('failed', 'blocked') for r in results):
+                sys.exit(1)
+    else:
+        print(__doc__)
@@ -0,0 +1,934 @@
+"""
+Pure Python reader for the Propbank index (prop-all.idx) and frame files used with Libin Shen's treebank,
+a port of src/edu/upenn/cis/propbank_shen. As in the Java API, the classes keep their Java method names,
+and the index and frames directory are found through the PROPBANKFILE and FRAMEDIR environment variables.
+"""
+
+import functools, hashlib, json, mmap, os, re, struct, sys, traceback
+import xml.etree.ElementTree as ElementTree
+
+__all__ = ['Propbank', 'Annotation', 'PASLoc', 'PAStruct', 'Argument', 'ArgLoc', 'ArgLabel', 'ModLabel',
+           'Inflection', 'RoleSet', 'Role', 'VNRole', 'FrameSet', 'Predicate', 'WordSpan', 'PBConfig',
+           'CorruptDataException', 'CompiledPropbank', 'compile_propbank', 'open_propbank']
+
+class CorruptDataException(Exception):
+    pass
+
+class PBConfig(object):
+    @staticmethod
+    def PropBankFile():
+        return os.environ.get("PROPBANKFILE", "/Users/piffle/Desktop/spinalapi/spinalapi/prop-all.idx")
+
+    @staticmethod
+    def TreeBankDir():
+        return os.environ.get("TREEBANKDIR", "/Users/piffle/Desktop/spinalapi/spinalapi/ltagtb")
+
+    @staticmethod
+    def FrameDir():
+        return os.environ.get("FRAMEDIR", "/Users/piffle/Desktop/spinalapi/spinalapi/frames")
+
+def java_split(pattern, string, flags=0):
+    """
+    String.split(regex) in Java: like re.split, but trailing empty strings are dropped
+    """
+    parts = re.split(pattern, string, flags=flags)
+    while len(parts) > 1 and parts[-1] == '':
+        parts.pop()
+    return parts
+
+def parse_int(string):
+    """
+    Integer.parseInt in Java, which accepts no surrounding whitespace
+    """
+    if re.match(r'[+-]?[0-9]+\Z', string) is None:
+        raise ValueError("For input string: \"%s\"" % string)
+    return int(string)
+
+def decode_int(string):
+    """
+    Integer.decode in Java: decimal, hexadecimal with 0x or #, or octal with a leading 0
+    """
+    match = re.match(r'([+-]?)(0[xX]|#|0(?=[0-7]))?([0-9a-fA-F]+)\Z', string)
+    if match is None:
+        raise ValueError("For input string: \"%s\"" % string)
+    sign, prefix, digits = match.groups()
+    base = 10 if prefix is None else 8 if prefix == '0' else 16
+    value = int(digits, base)
+    return -value if sign == '-' else value
+
+class WordSpan(object):
+    """
+    The span of words from start to end, both inclusive
+    """
+    def __init__(self, start, end):
+        self._start = start
+        self._end = end
+
+    def start(self):
+        return self._start
+
+    def end(self):
+        return self._end
+
+    @staticmethod
+    def combine(w1, w2):
+        if w1 is None and w2 is None:
+            raise ValueError("Attempted to combine two null WordSpans")
+        if w1 is None:
+            return w2
+        if w2 is None:
+            return w1
+        return WordSpan(min(w1.start(), w2.start()), max(w1.end(), w2.end()))
+
+    @staticmethod
+    def merge(word_spans):
+        word_spans = list(word_spans)
+        if len(word_spans) == 0:
+            raise ValueError("Attempted to merge zero WordSpans")
+        return WordSpan(min(w.start() for w in word_spans), max(w.end() for w in word_spans))
+
+    @staticmethod
+    def ofString(string):
+        index = string.find('_')
+        if index == -1:
+            raise CorruptDataException("invalid basic argument location: " + string)
+        return WordSpan(decode_int(string[:index]), decode_int(string[index + 1:]))
+
+    def getSubTree(self, sentence):
+        return sentence.getSubTree(self)
+
+    def compareTo(self, other):
+        if self.start() != other.start():
+            return self.start() - other.start()
+        return self.end() - other.end()
+
+    def __eq__(self, other):
+        return isinstance(other, WordSpan) and self._start == other._start and self._end == other._end
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.compareTo(other) < 0
+
+    def __hash__(self):
+        return hash((self._start, self._end))
+
+    def toString(self):
+        return "%d_%d" % (self._start, self._end)
+
+    __str__ = toString
+
+    def __repr__(self):
+        return "<WordSpan %s>" % self.toString()
+
+class PASLoc(object):
+    """
+    Location of a predicate argument structure: treebank file, sentence number and terminal number
+    """
+    def __init__(self, path, sentno, termno):
+        self.path = path
+        self.sentno = sentno
+        self.termno = termno
+
+    @staticmethod
+    def ofString(string):
+        parts = java_split(" ", string)
+        if len(parts) != 3:
+            raise CorruptDataException("Invalid location of a predicate argument structure: " + string)
+        try:
+            return PASLoc(parts[0], decode_int(parts[1]), decode_int(parts[2]))
+        except ValueError:
+            raise CorruptDataException("Invalid location of a predicate argument structure: " + string)
+
+    def getPath(self):
+        return os.path.join(PBConfig.TreeBankDir(), self.path)
+
+    def key(self):
+        return (self.path, self.sentno, self.termno)
+
+    def __eq__(self, other):
+        return isinstance(other, PASLoc) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def toString(self):
+        return "%s %d %d" % (self.path, self.sentno, self.termno)
+
+    __str__ = toString
+
+    def __repr__(self):
+        return "<PASLoc %s>" % self.toString()
+
+class ArgLabel(object):
+    """
+    Argument label: ARG0-ARG9, ARGM, ARGA, rel or TBERR. Labels are compared by value
+    """
+    prefix = "ARG"
+
+    def __init__(self, name, number=-1):
+        self.name = ArgLabel.prefix + name
+        self.number = number
+
+    @staticmethod
+    def ofString(string):
+        upper = string.upper()
+        if upper == "REL":
+            return ArgLabel.REL
+        if upper == "TBERR":
+            return ArgLabel.TBERR
+        if not upper.startswith("ARG"):
+            raise CorruptDataException("invalid argument label: " + string)
+        if len(string) == 4:
+            if upper.endswith("A"):
+                return ArgLabel.ARGA
+            elif upper.endswith("M"):
+                return ArgLabel.ARGM
+        try:
+            number = decode_int(string[3:])
+        except ValueError:
+            number = -1
+        if number < 0 or number >= len(ArgLabel.numberedLabels):
+            raise CorruptDataException("invalid argument label: " + string)
+        return ArgLabel.numberedLabels[number]
+
+    def isRel(self):
+        return self == ArgLabel.REL
+
+    def isArgM(self):
+        return self == ArgLabel.ARGM
+
+    def isArgA(self):
+        return self == ArgLabel.ARGA
+
+    def isNumbered(self):
+        return self.number != -1
+
+    def isArgument(self):
+        return self.isNumbered() or self.isArgA()
+
+    def getNum(self):
+        return self.number
+
+    def getName(self):
+        return self.name
+
+    def __eq__(self, other):
+        return isinstance(other, ArgLabel) and self.number == other.number and self.name == other.name
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.name, self.number))
+
+    def toString(self):
+        if self.name.endswith("REL"):
+            return "rel"
+        if self.name.endswith("TBERR"):
+            return "TBERR"
+        if self.number < 0:
+            return self.name
+        return self.name + str(self.number)
+
+    __str__ = toString
+
+ArgLabel.ARGM = ArgLabel("M")
+ArgLabel.ARGA = ArgLabel("A")
+ArgLabel.REL = ArgLabel("REL")
+ArgLabel.TBERR = ArgLabel("TBERR")
+ArgLabel.numberedLabels = [ArgLabel("", n) for n in range(10)]
+
+class ModLabel(object):
+    """
+    Function tag of an ARGM. Unknown tags are taken to be prepositions
+    """
+    DESCRIPTIONS = [
+        ("EXT", "extent"), ("LOC", "location"), ("DIR", "direction"), ("MOD", "modal"), ("ADV", "adverbial"),
+        ("MNR", "manner"), ("PRD", "secondary predication"), ("REC", "recipricol"), ("TMP", "temporal"),
+        ("PRP", "purpose (deprecated)"), ("PNC", "purpose, not the cause"), ("CAU", "cause"), ("STR", "stranded"),
+    ]
+
+    # DIR is missing from ModLabel.ofString in the Java API, so it parses as a preposition
+    PARSED = set(["EXT", "LOC", "MOD", "ADV", "MNR", "PRD", "REC", "TMP", "PRP", "PNC", "CAU", "STR"])
+
+    def __init__(self, name, description):
+        self.label_name = name
+        self.label_descr = description
+
+    @staticmethod
+    def ofString(string):
+        if string in ModLabel.PARSED:
+            return getattr(ModLabel, string)
+        return ModLabel(string, "preposition")
+
+    def getDescription(self):
+        return self.label_descr
+
+    def __eq__(self, other):
+        return isinstance(other, ModLabel) and self.label_name == other.label_name and self.label_descr == other.label_descr
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.label_name, self.label_descr))
+
+    def toString(self):
+        return self.label_name
+
+    __str__ = toString
+
+for _name, _description in ModLabel.DESCRIPTIONS:
+    setattr(ModLabel, _name, ModLabel(_name, _description))
+
+class ArgLoc(object):
+    """
+    Location of an argument: a word span, or a concatenation (,) or trace chain (*) of locations
+    """
+    SINGLE = 0
+    CONCAT = 1
+    EQUIVA = 2
+
+    def __init__(self, word_span=None, loc_type=SINGLE, locs=None):
+        if loc_type != ArgLoc.SINGLE and len(locs) < 2:
+            raise ValueError("Illegal call to ArgLoc constructor: length of list must be >= 2")
+        self.loc_type = loc_type
+        self.locs = locs
+        self.ta = word_span
+
+    @staticmethod
+    def ofString(string):
+        for separator, loc_type in [('*', ArgLoc.EQUIVA), (',', ArgLoc.CONCAT)]:
+            if separator in string:
+                return ArgLoc(loc_type=loc_type, locs=[ArgLoc.ofString(s) for s in string.split(separator) if s != ''])
+        return ArgLoc(WordSpan.ofString(string))
+
+    def isSingle(self):
+        return self.loc_type == ArgLoc.SINGLE
+
+    def isConcat(self):
+        return self.loc_type == ArgLoc.CONCAT
+
+    def isTraceChain(self):
+        return self.loc_type == ArgLoc.EQUIVA
+
+    def getWordSpan(self):
+        return self.ta
+
+    def getLocList(self):
+        return self.locs
+
+    def locTypeToString(self):
+        return {ArgLoc.SINGLE: "", ArgLoc.CONCAT: ",", ArgLoc.EQUIVA: "*"}[self.loc_type]
+
+    def getAllWordSpans(self):
+        if self.isSingle():
+            return [self.ta]
+        return [span for loc in self.locs for span in loc.getAllWordSpans()]
+
+    def compareTo(self, other):
+        first = min(self.getAllWordSpans()).compareTo(min(other.getAllWordSpans()))
+        if first != 0:
+            return first
+        if self == other:
+            return 0
+        return _compare(self.toString(), other.toString())
+
+    def __eq__(self, other):
+        return isinstance(other, ArgLoc) and self.loc_type == other.loc_type and self.locs == other.locs and self.ta == other.ta
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.toString())
+
+    def toString(self):
+        if self.isSingle():
+            return self.ta.toString()
+        return self.locTypeToString().join(loc.toString() for loc in self.locs)
+
+    __str__ = toString
+
+def _compare(a, b):
+    return (a > b) - (a < b)
+
+class Argument(object):
+    """
+    One argument of a predicate argument structure, e.g. 0_1-ARG0 or 11_15-ARGM-PRD
+    """
+    sep = "-"
+
+    def __init__(self, arg_label, mod_label=None, location=None):
+        self.arg_label = arg_label
+        self.mod_label = mod_label
+        self.location = location
+
+    @staticmethod
+    def ofString(string):
+        tokens = [token for token in string.split(Argument.sep) if token != '']
+        if len(tokens) < 2 or len(tokens) > 3:
+            raise CorruptDataException("invalid argument string, too few or too many parts: " + string)
+        location = ArgLoc.ofString(tokens[0])
+        arg_label = ArgLabel.ofString(tokens[1])
+        mod_label = ModLabel.ofString(tokens[2]) if len(tokens) == 3 else None
+        return Argument(arg_label, mod_label, location)
+
+    def label_string(self):
+        return self.arg_label.toString() + (self.mod_label.toString() if self.mod_label is not None else "")
+
+    def compareTo(self, other):
+        location = self.location.compareTo(other.location)
+        if location != 0:
+            return location
+        return _compare(self.label_string(), other.label_string())
+
+    def getLocation(self):
+        return self.location
+
+    def setLocation(self, location):
+        self.location = location
+
+    def setMod(self, mod_label):
+        self.mod_label = mod_label
+
+    def setLabel(self, arg_label):
+        self.arg_label = arg_label
+
+    def __eq__(self, other):
+        return isinstance(other, Argument) and (self.arg_label, self.mod_label, self.location) == (other.arg_label, other.mod_label, other.location)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.toString())
+
+    def toString(self):
+        location = self.location.toString() if self.location is not None else "?:?"
+        mod = Argument.sep + self.mod_label.toString() if self.mod_label is not None else ""
+        return location + Argument.sep + self.arg_label.toString() + mod
+
+    __str__ = toString
+
+class PAStruct(object):
+    """
+    Predicate argument structure: a lemma and its arguments, kept sorted by location
+    """
+    def __init__(self, lemma):
+        self.lemma = lemma
+        self.arguments = []
+
+    def getLemma(self):
+        return self.lemma
+
+    def getArgs(self):
+        return self.arguments
+
+    def addArg(self, argument):
+        self.arguments.append(argument)
+        self.arguments.sort(key=functools.cmp_to_key(lambda a, b: a.compareTo(b)))
+
+    def nthArg(self, n):
+        return self.arguments[n]
+
+    def size(self):
+        return len(self.arguments)
+
+    def __eq__(self, other):
+        return isinstance(other, PAStruct) and self.lemma == other.lemma and self.arguments == other.arguments
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.toString())
+
+    def toString(self):
+        return " ".join(argument.toString() for argument in self.arguments)
+
+    __str__ = toString
+
+class Inflection(object):
+    """
+    Five letter inflection code: form, tense, aspect, person and voice. Unknown letters are read as '-'
+    """
+    VALUES = [("form", "igpv-"), ("tense", "fpn-"), ("aspect", "pob-"), ("person", "3-"), ("voice", "ap-")]
+
+    def __init__(self, string):
+        if len(string) != 5:
+            raise CorruptDataException("invalid inflection string: " + string)
+        letters = []
+        for (name, values), letter in zip(Inflection.VALUES, string):
+            if letter not in values:
+                sys.stderr.write("invalid inflection.%s string: %s, defaulting to -\n" % (name, letter))
+                letter = "-"
+            letters.append(letter)
+        self.form, self.tense, self.aspect, self.person, self.voice = letters
+
+    def toString(self):
+        return self.form + self.tense + self.aspect + self.person + self.voice
+
+    __str__ = toString
+
+class VNRole(object):
+    def __init__(self, node):
+        self.vnclass = node.get("vncls")
+        self.vntheta = node.get("vntheta")
+
+    def getVNTheta(self):
+        return self.vntheta
+
+    def getVNClass(self):
+        return self.vnclass
+
+class Role(object):
+    def __init__(self, node):
+        self.descr = node.get("descr")
+        self.arglabel = ArgLabel.ofString("Arg" + node.get("n")) if node.get("n") is not None else None
+        self.modlabel = ModLabel.ofString(node.get("f")) if node.get("f") is not None else None
+        self.vnroles = [VNRole(child) for child in node if child.tag == "vnrole"]
+
+    def getDescription(self):
+        return self.descr
+
+    def getArgLabel(self):
+        return self.arglabel
+
+    def getModLabel(self):
+        return self.modlabel
+
+    def hasModLabel(self):
+        return self.modlabel is not None
+
+    def getVNRoles(self):
+        return self.vnroles
+
+class RoleSet(object):
+    def __init__(self, node):
+        self.node = node
+        self.id = node.get("id")
+        self.name = node.get("name")
+        self.vnclasses = node.get("vncls").split(" ") if node.get("vncls") is not None else []
+        self.roles = [Role(role) for roles in node if roles.tag == "roles" for role in roles if role.tag == "role"]
+
+    @staticmethod
+    def ofId(roleset_id):
+        index = roleset_id.find('.')
+        if index == -1:
+            raise CorruptDataException("invalid roleset id: " + roleset_id)
+        for predicate in FrameSet.get(roleset_id[:index]).getPredicates():
+            for roleset in predicate.getRoleSets():
+                if roleset.getId() == roleset_id:
+                    return roleset
+        sys.stderr.write("no roleset found with id" + roleset_id + "\n")
+        return None
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def hasName(self):
+        return self.name is not None
+
+    def getVNClasses(self):
+        return self.vnclasses
+
+    def getRoles(self):
+        return self.roles
+
+class Predicate(object):
+    def __init__(self, node):
+        self.lemma = node.get("lemma")
+        if self.lemma is None:
+            sys.stderr.write("error with Predicate object, no lemma found\n")
+        self.rolesets = [RoleSet(child) for child in node if child.tag == "roleset"]
+
+    def getLemma(self):
+        return self.lemma
+
+    def isPhrasal(self):
+        return "_" in self.lemma
+
+    def getRoleSets(self):
+        return self.rolesets
+
+class FrameSet(object):
+    """
+    The frames file of one verb. Unlike the Java API, which parses the file again for every lookup,
+    parsed frame sets are cached per verb
+    """
+    cache = {}
+
+    def __init__(self, verb):
+        self.verb = verb
+        path = FrameSet.getPath(verb)
+        try:
+            root = ElementTree.parse(path).getroot()
+        except ElementTree.ParseError:
+            raise CorruptDataException("Bad frames file for " + verb + ".")
+        except (IOError, OSError) as e:
+            raise CorruptDataException(str(e) + "; Couldn't find " + verb)
+        self.predicates = [Predicate(child) for child in root if child.tag == "predicate"]
+
+    @staticmethod
+    def get(verb):
+        if verb not in FrameSet.cache:
+            FrameSet.cache[verb] = FrameSet(verb)
+        return FrameSet.cache[verb]
+
+    @staticmethod
+    def getPath(verb):
+        return os.path.join(PBConfig.FrameDir(), verb + ".xml")
+
+    def getPredicates(self):
+        return self.predicates
+
+    def getVerb(self):
+        return self.verb
+
+class Annotation(object):
+    """
+    One line of the Propbank index, e.g.
+        wsj/00/wsj_0001.mrg 0 8 gold join.01 vf--a 0_1-ARG0 8_8-rel 9_10-ARG1 11_15-ARGM-PRD 16_17-ARGM-TMP
+    """
+    def __init__(self, line):
+        parts = java_split(" ", line.strip())
+        if len(parts) < 7:
+            raise CorruptDataException("invalid annotation line: " + line)
+        self._set_fields(PASLoc.ofString(" ".join(parts[:3])), parts[3], parts[4], Inflection(parts[5]), line)
+        for part in parts[6:]:
+            self.pas.addArg(Argument.ofString(part))
+
+    def _set_fields(self, pasloc, annotator, rolesetid, inflection, line):
+        self.pasloc = pasloc
+        self.annotator = annotator
+        self.rolesetid = rolesetid
+        self.inflection = inflection
+        self.roleset = None
+        self.roleset_loaded = False
+
+        index = self.rolesetid.find(".")
+        if index == -1:
+            raise CorruptDataException("invalid annotation line (bad roleset): " + line)
+        self.pas = PAStruct(self.rolesetid[:index])
+
+    @staticmethod
+    def ofFields(pasloc, annotator, rolesetid, inflection, arguments):
+        """
+        Builds an Annotation from the fields of its line, already split as compile_propbank stores them.
+        arguments are (location, label, function tag or None) strings
+        """
+        annotation = Annotation.__new__(Annotation)
+        annotation._set_fields(pasloc, annotator, rolesetid, Inflection(inflection), rolesetid)
+        for location, arg_label, mod_label in arguments:
+            mod_label = ModLabel.ofString(mod_label) if mod_label is not None else None
+            annotation.pas.addArg(Argument(ArgLabel.ofString(arg_label), mod_label, ArgLoc.ofString(location)))
+        return annotation
+
+    def getPAStruct(self):
+        return self.pas
+
+    def getPASLoc(self):
+        return self.pasloc
+
+    def getRelation(self):
+        for argument in self.pas.getArgs():
+            if argument.arg_label.isRel():
+                return argument
+        raise ValueError("Bad annotation -- doesn't have a relation: " + self.toString())
+
+    def getInflection(self):
+        return self.inflection
+
+    def getRoleSet(self):
+        """
+        The roleset of the annotation from the frames files, or None for unknown (.XX) rolesets
+        """
+        if not self.roleset_loaded and not self.rolesetid.endswith(".XX"):
+            self.roleset = RoleSet.ofId(self.rolesetid)
+            self.roleset_loaded = True
+        return self.roleset
+
+    def getRoleSetId(self):
+        return self.rolesetid
+
+    def getLemma(self):
+        return self.pas.getLemma()
+
+    def getAnnotator(self):
+        return self.annotator
+
+    def toString(self):
+        return " ".join([self.pasloc.toString(), self.annotator, self.rolesetid, self.inflection.toString(), self.pas.toString()])
+
+    __str__ = toString
+
+class Propbank(dict):
+    """
+    Maps the PASLoc of every predicate in the Propbank index to its Annotation.
+
+    As in the Java API, reading stops at the first corrupt line, whose error is printed
+    """
+    def __init__(self, location=None):
+        super(Propbank, self).__init__()
+        location = location or PBConfig.PropBankFile()
+        try:
+            with open(location) as f:
+                for line in f:
+                    annotation = Annotation(line.rstrip("\r\n"))
+                    self[annotation.getPASLoc()] = annotation
+        except (IOError, OSError, CorruptDataException):
+            traceback.print_exc()
+
+        if len(self) == 0:
+            raise RuntimeError("No annotations read from " + location)
+
+COMPILED_MAGIC = b'SPPB'
+COMPILED_VERSION = 2
+# Magic, version and the fingerprint of the frames directory the rolesets were read from
+COMPILED_HEADER = struct.Struct('<4sI20s')
+TABLE_HEADER = struct.Struct('<QQQQ')
+INDEX_ENTRY = struct.Struct('<QIQI')
+
+def compiled_filename(location):
+    return location + ".compiled"
+
+def frames_fingerprint(frame_dir=None):
+    """
+    SHA-1 of the names, sizes and modification times of the files in the frames directory,
+    which changes whenever a frames file is added, removed or edited
+    """
+    frame_dir = frame_dir or PBConfig.FrameDir()
+    digest = hashlib.sha1()
+    if os.path.isdir(frame_dir):
+        for entry in sorted(os.scandir(frame_dir), key=lambda e: e.name):
+            if entry.is_file():
+                stat = entry.stat()
+                digest.update(("%s %d %d\n" % (entry.name, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    return digest.digest()
+
+def _table_layout(items, start):
+    """
+    Lays out a table of str -> bytes items sorted by key: a fixed size index of
+    (key offset, key length, value offset, value length) entries, the keys and the values
+    """
+    items = sorted((key.encode('utf-8'), value) for key, value in items.items())
+    index_offset = start
+    keys_offset = index_offset + len(items) * INDEX_ENTRY.size
+    values_offset = keys_offset + sum(len(key) for key, _ in items)
+
+    index, keys, values = [], [], []
+    key_position, value_position = 0, 0
+    for key, value in items:
+        index.append(INDEX_ENTRY.pack(key_position, len(key), value_position, len(value)))
+        keys.append(key)
+        values.append(value)
+        key_position += len(key)
+        value_position += len(value)
+
+    header = TABLE_HEADER.pack(len(items), index_offset, keys_offset, values_offset)
+    return header, b''.join(index + keys + values)
+
+class _MappedTable(object):
+    """
+    Binary search over a table written by _table_layout, reading only the entries it visits
+    """
+    def __init__(self, buffer, header_offset):
+        self.buffer = buffer
+        self.count, self.index_offset, self.keys_offset, self.values_offset = TABLE_HEADER.unpack_from(buffer, header_offset)
+
+    def entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.buffer, self.index_offset + i * INDEX_ENTRY.size)
+
+    def key(self, i):
+        key_position, key_length, _, _ = self.entry(i)
+        start = self.keys_offset + key_position
+        return self.buffer[start:start + key_length]
+
+    def get(self, key):
+        key = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key(low) == key:
+            _, _, value_position, value_length = self.entry(low)
+            start = self.values_offset + value_position
+            return self.buffer[start:start + value_length]
+        return None
+
+    def keys(self):
+        for i in range(self.count):
+            yield self.key(i).decode('utf-8')
+
+def compile_propbank(location=None, output_filename=None):
+    """
+    Reads the Propbank index and the frames of its rolesets once and writes them to a compact file that
+    CompiledPropbank memory-maps. Each PAS location maps to a JSON record with the fields of its annotation
+    line (annotator, roleset id, inflection and arguments as location, label and function tag) and its lemma,
+    and each roleset id to its frames XML. The header records the frames_fingerprint, so that open_propbank
+    compiles the file again when the frames change
+    """
+    location = location or PBConfig.PropBankFile()
+    output_filename = output_filename or compiled_filename(location)
+    propbank = Propbank(location)
+
+    annotations = {}
+    rolesets = {}
+    for pasloc, annotation in propbank.items():
+        record = {
+            'annotator': annotation.getAnnotator(),
+            'roleset_id': annotation.getRoleSetId(),
+            'inflection': annotation.getInflection().toString(),
+            'arguments': [[argument.getLocation().toString(),
+                           argument.arg_label.toString(),
+                           argument.mod_label.toString() if argument.mod_label is not None else None]
+                          for argument in annotation.getPAStruct().getArgs()],
+            'lemma': annotation.getLemma(),
+            'roleset_error': None,
+        }
+
+        # Rolesets that cannot be read are left to be looked up, and fail, when they are used
+        try:
+            roleset = annotation.getRoleSet()
+        except CorruptDataException as e:
+            record['roleset_error'] = str(e)
+            roleset = None
+        if roleset is not None:
+            rolesets[annotation.getRoleSetId()] = ElementTree.tostring(roleset.node)
+        annotations[pasloc.toString()] = json.dumps(record).encode('utf-8')
+
+    start = COMPILED_HEADER.size + 2 * TABLE_HEADER.size
+    annotation_header, annotation_table = _table_layout(annotations, start)
+    roleset_header, roleset_table = _table_layout(rolesets, start + len(annotation_table))
+
+    tmp_filename = output_filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        f.write(COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, frames_fingerprint()))
+        f.write(annotation_header)
+        f.write(roleset_header)
+        f.write(annotation_table)
+        f.write(roleset_table)
+    os.rename(tmp_filename, output_filename)
+    return output_filename
+
+class CompiledPropbank(object):
+    """
+    Read-only Propbank backed by a memory-mapped file written by compile_propbank. Lookups are a binary search
+    over the mapped index, so processes that open the same file share its pages instead of each parsing the
+    index, and construction costs no more than opening the file.
+
+    Supports the lookups of Propbank (in and []), returning Annotations whose rolesets come from the file.
+    Annotations are built from the compiled fields on first lookup and cached
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.frames_fingerprint = read_compiled_header(self.buffer)
+        if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+            raise ValueError("%s is not a compiled Propbank of version %d" % (filename, COMPILED_VERSION))
+        self.annotations = _MappedTable(self.buffer, COMPILED_HEADER.size)
+        self.rolesets = _MappedTable(self.buffer, COMPILED_HEADER.size + TABLE_HEADER.size)
+        self._roleset_cache = {}
+        self._annotation_cache = {}
+
+    def __repr__(self):
+        return "<CompiledPropbank: %s, %d annotations, %d rolesets>" % (self.filename, self.annotations.count, self.rolesets.count)
+
+    def __len__(self):
+        return self.annotations.count
+
+    def _key(self, pasloc):
+        return pasloc.toString() if isinstance(pasloc, PASLoc) else pasloc
+
+    def __contains__(self, pasloc):
+        return pasloc is not None and self.annotations.get(self._key(pasloc)) is not None
+
+    def record(self, pasloc):
+        """
+        The compiled record of a PAS location as a dict, or None
+        """
+        if pasloc is None:
+            return None
+        value = self.annotations.get(self._key(pasloc))
+        return json.loads(value.decode('utf-8')) if value is not None else None
+
+    def roleset(self, roleset_id):
+        if roleset_id not in self._roleset_cache:
+            value = self.rolesets.get(roleset_id)
+            self._roleset_cache[roleset_id] = RoleSet(ElementTree.fromstring(value)) if value is not None else None
+        return self._roleset_cache[roleset_id]
+
+    def get(self, pasloc, default=None):
+        if pasloc is None:
+            return default
+        key = self._key(pasloc)
+        if key in self._annotation_cache:
+            return self._annotation_cache[key]
+
+        record = self.record(key)
+        if record is None:
+            return default
+        pasloc = pasloc if isinstance(pasloc, PASLoc) else PASLoc.ofString(key)
+        annotation = Annotation.ofFields(pasloc, record['annotator'], record['roleset_id'], record['inflection'], record['arguments'])
+        if record['roleset_error'] is None:
+            annotation.roleset = self.roleset(record['roleset_id'])
+            annotation.roleset_loaded = True
+        self._annotation_cache[key] = annotation
+        return annotation
+
+    def __getitem__(self, pasloc):
+        annotation = self.get(pasloc)
+        if annotation is None:
+            raise KeyError(pasloc)
+        return annotation
+
+    def keys(self):
+        return self.annotations.keys()
+
+    def close(self):
+        self.buffer.close()
+
+def read_compiled_header(buffer):
+    if len(buffer) < COMPILED_HEADER.size:
+        return None, None, None
+    return COMPILED_HEADER.unpack_from(buffer, 0)
+
+def open_propbank(location=None):
+    """
+    Returns the compiled Propbank of the index if it is up to date: newer than the index, of the current version
+    and compiled from the current frames directory. Otherwise the index is compiled again if it exists,
+    and read directly if it can't be
+    """
+    location = location or PBConfig.PropBankFile()
+    compiled = compiled_filename(location)
+    if os.path.exists(compiled) and (not os.path.exists(location) or os.path.getmtime(compiled) >= os.path.getmtime(location)):
+        with open(compiled, 'rb') as f:
+            magic, version, fingerprint = read_compiled_header(f.read(COMPILED_HEADER.size))
+        if magic == COMPILED_MAGIC and version == COMPILED_VERSION and fingerprint == frames_fingerprint():
+            return CompiledPropbank(compiled)
+    if os.path.exists(location):
+        try:
+            return CompiledPropbank(compile_propbank(location, compiled))
+        except (IOError, OSError):
+            traceback.print_exc()
+    return Propbank(location)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'compile':
+        print(compile_propbank(*sys.argv[2:4]))
+    else:
+        print("usage: python spinal_propbank.py compile [prop-all.idx] [output_filename]")
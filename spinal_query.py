@@ -0,0 +1,309 @@
+"""
+Inverted indexes over the tree dicts of the compressed and uncompressed treebanks, queried with
+boolean combinations of field=value terms. Run as a module from the directory containing output/:
+    python -m spinal.spinal_query 'label=S and rule_pos=NP and not semantic_role=ARG1'
+    python -m spinal.spinal_query --uncompressed 'spine_prefix="S VP" and word=ran'
+    python -m spinal.spinal_query --check 'label=DT'    (same hits on both treebanks)
+The index of a treebank is pickled next to it (output/compressed_trees.index) and reused until the treebank changes
+"""
+
+import copy, json, os, pickle, re, sys, time
+from collections import defaultdict
+from spinal.spinal_loader import CompressedLTAGLoader, UncompressedSpinalLTAGLoader
+
+INDEX_VERSION = 1
+
+# Fields with one posting list per value
+FIELDS = ('label', 'spine', 'spine_prefix', 'tree_type', 'predicate', 'roleset', 'rule_pos', 'semantic_role', 'word')
+
+def spine_labels(tree_dict):
+    """
+    The labels of a tree dict's spine, without the ^ marking a foot node (as in the SpinalLTAG constructor),
+    so the labels of both treebanks can be queried alike
+    """
+    return [label[:-1] if label.endswith('^') else label for label in re.sub('[()]', '', tree_dict['spine']).split()]
+
+def tree_terms(tree_dict):
+    """
+    Returns the set of (field, value) terms of a compressed or uncompressed tree dict. Spines and their
+    prefixes are labels joined by spaces, and words are lowercased as in the compressed treebank (as are the
+    words of queries, see Term)
+    """
+    labels = spine_labels(tree_dict)
+    terms = set([('label', labels[0]), ('spine', " ".join(labels))])
+    for i in range(1, len(labels) + 1):
+        terms.add(('spine_prefix', " ".join(labels[:i])))
+
+    for field, key in [('tree_type', 'tree_type'), ('tree_type', 'type'), ('predicate', 'predicate'), ('roleset', 'roleset_id')]:
+        if tree_dict.get(key) is not None:
+            terms.add((field, tree_dict[key]))
+
+    for rule in tree_dict['rules']:
+        terms.add(('rule_pos', rule['pos']))
+        if rule.get('semantic_role') is not None:
+            terms.add(('semantic_role', rule['semantic_role']))
+
+    if 'lexicalization' in tree_dict:
+        terms.update(('word', word) for word in tree_dict['lexicalization'])
+    else:
+        terms.add(('word', tree_dict['terminal'].lower()))
+    return terms
+
+class TreebankIndex(object):
+    """
+    Posting lists of tree dict positions per (field, value) term of one treebank. A query is evaluated on
+    bitsets (python ints, bit i for tree_dicts[i]), built per term on first use and cached, and only the
+    matching dicts are returned or parsed into trees
+    """
+    def __init__(self, tree_dicts):
+        self.tree_dicts = tree_dicts
+        self.all = (1 << len(tree_dicts)) - 1
+
+        postings = defaultdict(list)
+        for i, tree_dict in enumerate(tree_dicts):
+            for term in tree_terms(tree_dict):
+                postings[term].append(i)
+        self.postings = dict(postings)
+        self._masks = {}
+
+    def __repr__(self):
+        return "<TreebankIndex: %d trees, %d terms>" % (len(self.tree_dicts), len(self.postings))
+
+    def __getstate__(self):
+        # Term masks are rebuilt on first use
+        state = dict(self.__dict__)
+        state['_masks'] = {}
+        return state
+
+    @classmethod
+    def from_file(cls, filename, update=False):
+        """
+        Indexes a treebank file. The index is pickled next to it and restored instead of rebuilt
+        unless update is set or the treebank is newer than the pickle
+        """
+        index_filename = filename.split(".")[0] + ".index"
+        if not update and os.path.exists(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+            with open(index_filename, 'rb') as f:
+                saved = pickle.load(f)
+            if saved.get('version') == INDEX_VERSION:
+                return saved['index']
+
+        with open(filename) as json_file:
+            index = cls(json.loads(json_file.read()))
+        index.save(index_filename)
+        return index
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump({'version': INDEX_VERSION, 'index': self}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def values(self, field):
+        """
+        The indexed values of a field, with the number of trees having each
+        """
+        return dict((value, len(indices)) for (f, value), indices in self.postings.items() if f == field)
+
+    def term_mask(self, field, value):
+        if field not in FIELDS:
+            raise KeyError("unknown field %s, expected one of %s" % (field, ", ".join(FIELDS)))
+
+        term = (field, value)
+        if term not in self._masks:
+            # Built from a bit string, as in GrammarIndex.mask_of
+            bits = bytearray(b'0' * len(self.tree_dicts))
+            for i in self.postings.get(term, []):
+                bits[i] = ord('1')
+            self._masks[term] = int(bytes(bits[::-1]) or b'0', 2)
+        return self._masks[term]
+
+    def indices(self, query):
+        bits = bin(query.mask(self))[:1:-1]
+        return [i for i, bit in enumerate(bits) if bit == '1']
+
+    def count(self, query):
+        return bin(query.mask(self)).count('1')
+
+    def search(self, query):
+        """
+        Returns the tree dicts matching query
+        """
+        return [self.tree_dicts[i] for i in self.indices(query)]
+
+    def tree_ids(self, query):
+        return [self.tree_dicts[i]['tree_id'] for i in self.indices(query)]
+
+    def trees(self, query):
+        """
+        Parses the matching tree dicts into SpinalLTAGs, one per lexicalization for the compressed treebank
+        """
+        trees = []
+        for tree_dict in self.search(query):
+            if 'lexicalization' in tree_dict:
+                # The loader rewrites rule dicts in place, so it gets a copy
+                trees.extend(CompressedLTAGLoader().parse_ltags_from_dict(copy.deepcopy(tree_dict)))
+            else:
+                trees.append(UncompressedSpinalLTAGLoader().parse_ltag_from_dict(tree_dict))
+        return trees
+
+class Query(object):
+    """
+    A boolean query over a TreebankIndex, combined with &, | and ~
+    """
+    def mask(self, index):
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+class Term(Query):
+    """
+    Trees with value in field. Words are indexed lowercased, so word values are lowercased too
+    """
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value.lower() if field == 'word' else value
+
+    def mask(self, index):
+        return index.term_mask(self.field, self.value)
+
+    def __repr__(self):
+        return '%s="%s"' % (self.field, self.value)
+
+class And(Query):
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def mask(self, index):
+        mask = index.all
+        for query in self.queries:
+            mask &= query.mask(index)
+            if mask == 0:
+                break
+        return mask
+
+    def __repr__(self):
+        return "(" + " and ".join(repr(q) for q in self.queries) + ")"
+
+class Or(Query):
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def mask(self, index):
+        mask = 0
+        for query in self.queries:
+            mask |= query.mask(index)
+        return mask
+
+    def __repr__(self):
+        return "(" + " or ".join(repr(q) for q in self.queries) + ")"
+
+class Not(Query):
+    def __init__(self, query):
+        self.query = query
+
+    def mask(self, index):
+        return index.all & ~self.query.mask(index)
+
+    def __repr__(self):
+        return "not %r" % (self.query,)
+
+def compare_treebanks(query, compressed, uncompressed):
+    """
+    Checks that a query has the same hits on the compressed and the uncompressed treebank indexes, comparing
+    the spines of the matching trees. Returns the spines only matched in the compressed and in the uncompressed
+    treebank, both empty when they agree
+    """
+    compressed_spines = set(" ".join(spine_labels(tree_dict)) for tree_dict in compressed.search(query))
+    uncompressed_spines = set(" ".join(spine_labels(tree_dict)) for tree_dict in uncompressed.search(query))
+    return compressed_spines - uncompressed_spines, uncompressed_spines - compressed_spines
+
+TOKEN = re.compile(r'\(|\)|[^\s()=]+="[^"]*"|[^\s()]+')
+
+def parse_query(string):
+    """
+    Parses a query such as 'label=S and (word=ran or not predicate=run)'. "not" binds tightest, then "and"
+    (which may be left out between terms), then "or". Values with spaces or parentheses are double quoted
+    """
+    tokens = TOKEN.findall(string)
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        token = peek()
+        if token is None:
+            raise ValueError("unexpected end of query: %s" % string)
+        position[0] += 1
+        return token
+
+    def parse_or():
+        queries = [parse_and()]
+        while peek() == 'or':
+            take()
+            queries.append(parse_and())
+        return queries[0] if len(queries) == 1 else Or(*queries)
+
+    def parse_and():
+        queries = [parse_not()]
+        while peek() is not None and peek() not in ('or', ')'):
+            if peek() == 'and':
+                take()
+            queries.append(parse_not())
+        return queries[0] if len(queries) == 1 else And(*queries)
+
+    def parse_not():
+        token = take()
+        if token == 'not':
+            return Not(parse_not())
+        if token == '(':
+            query = parse_or()
+            if take() != ')':
+                raise ValueError("expected ) in query: %s" % string)
+            return query
+        if '=' not in token:
+            raise ValueError("expected field=value, got %s" % token)
+        field, value = token.split('=', 1)
+        return Term(field, value[1:-1] if value.startswith('"') else value)
+
+    query = parse_or()
+    if peek() is not None:
+        raise ValueError("unexpected %s in query: %s" % (peek(), string))
+    return query
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) == 2 and args[0] == '--check':
+        query = parse_query(args[1])
+        only_compressed, only_uncompressed = compare_treebanks(query, TreebankIndex.from_file("output/compressed_trees.json"), TreebankIndex.from_file("output/uncompressed_trees.json"))
+        for spine in sorted(only_compressed):
+            print("only compressed: %s" % spine)
+        for spine in sorted(only_uncompressed):
+            print("only uncompressed: %s" % spine)
+        print("%s: %s" % (query, "same hits on both treebanks" if len(only_compressed) + len(only_uncompressed) == 0 else "different hits"), file=sys.stderr)
+        sys.exit(1 if len(only_compressed) + len(only_uncompressed) > 0 else 0)
+
+    filename = "output/compressed_trees.json"
+    if len(args) > 0 and args[0] == '--uncompressed':
+        filename = "output/uncompressed_trees.json"
+        args = args[1:]
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(1)
+
+    start = time.time()
+    index = TreebankIndex.from_file(filename)
+    indexed = time.time()
+    query = parse_query(args[0])
+    matches = index.search(query)
+    searched = time.time()
+
+    for tree_dict in matches:
+        print(json.dumps(tree_dict))
+    print("%s: %d matches of %d trees (index %.3fs, query %.3fs)" % (query, len(matches), len(index.tree_dicts), indexed - start, searched - indexed), file=sys.stderr)
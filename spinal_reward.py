@@ -1,9 +1,182 @@
 import copy
 import itertools
+import random
+import sys
+from collections import defaultdict
+import numpy as np
 import config
 from reward import Reward
 from default.semantics import SemanticMeaning
 
+def meaning_key(meaning):
+    return (meaning.meaning_string, tuple(meaning.meaning_arguments))
+
+class WorldIndex(object):
+    """
+    Indexes world facts and goals for evaluation: every meaning is interned as an integer id keyed by
+    (predicate name, argument tuple), each entity maps to the ids of the world facts it appears in,
+    and each predicate name maps to its argument tuples in the world
+    """
+    def __init__(self, world, goals):
+        self.meaning_ids = {}
+        self.meanings = []
+        self.world_ids = frozenset(self.intern(m) for m in world)
+        self.goal_ids = frozenset(self.intern(g) for g in goals)
+
+        entity_meanings = defaultdict(set)
+        predicate_arguments = defaultdict(set)
+        for meaning in world:
+            meaning_id = self.intern(meaning)
+            predicate_arguments[meaning.meaning_string].add(tuple(meaning.meaning_arguments))
+            for argument in meaning.meaning_arguments:
+                entity_meanings[argument].add(meaning_id)
+
+        self.entity_meanings = dict((e, frozenset(ids)) for e, ids in entity_meanings.items())
+        self.predicate_arguments = dict((p, frozenset(args)) for p, args in predicate_arguments.items())
+
+    def intern(self, meaning):
+        key = meaning_key(meaning)
+        meaning_id = self.meaning_ids.get(key)
+        if meaning_id is None:
+            meaning_id = len(self.meanings)
+            self.meaning_ids[key] = meaning_id
+            self.meanings.append(meaning)
+        return meaning_id
+
+    def lookup(self, key):
+        """
+        Returns the id of the meaning with the given key, or None if it is neither a world fact nor a goal
+        """
+        return self.meaning_ids.get(key)
+
+    def in_world(self, key):
+        return self.meaning_ids.get(key) in self.world_ids
+
+    def entity_facts(self, entity):
+        return self.entity_meanings.get(entity, frozenset())
+
+class BindingMeanings(object):
+    """
+    The meanings of a tree's semantics under one binding of its entities to world entities,
+    built once and then queried by every term of the score
+    """
+    def __init__(self, index, binding, semantic_meanings):
+        self.keys = set()
+        for meaning in semantic_meanings:
+            try:
+                arguments = tuple(binding[arg] for arg in meaning.meaning_arguments)
+            except KeyError:
+                continue
+            self.keys.add((meaning.meaning_string, arguments))
+
+        self.ids = set()
+        self.possible = True
+        self.entity_ids = defaultdict(set)
+        self.undescribed = set()
+        for key in self.keys:
+            meaning_id = index.lookup(key)
+            if meaning_id is None or meaning_id not in index.world_ids:
+                self.possible = False
+                self.undescribed.update(key[1])
+            if meaning_id is not None:
+                self.ids.add(meaning_id)
+                for argument in key[1]:
+                    self.entity_ids[argument].add(meaning_id)
+
+    def describes(self, index, entity):
+        """
+        Whether every meaning about entity under this binding is a world fact about entity
+        """
+        return entity not in self.undescribed and self.entity_ids.get(entity, set()) <= index.entity_facts(entity)
+
+# Codes are int64, so the blocks of all (predicate, arity) pairs must fit below this
+MAX_CODE = 2 ** 63 - 1
+
+class MeaningCodes(object):
+    """
+    Packs meanings over world entities into integer codes, used to evaluate all bindings of a tree at once:
+    each (predicate, arity) gets a range of n ** arity codes (n world entities) and the arguments' entity
+    indexes are the digits of the code within it. Ranges are only numbered, never allocated: the world facts
+    and goals are kept as sorted arrays of their codes, and ranges for predicates only seen in trees are
+    added as they come up
+    """
+    def __init__(self, index, entities):
+        self.entities = entities
+        self.entity_ids = dict((e, i) for i, e in enumerate(entities))
+        self.num_entities = len(entities)
+        self.offsets = {}
+        self.size = 0
+        self._permutations = {}
+
+        codes = dict((meaning_id, self.code(meaning, add=True)) for meaning_id, meaning in enumerate(index.meanings))
+        # Goals about entities that are not in the world can never be bound
+        self.world_codes = np.array(sorted(set(codes[i] for i in index.world_ids if codes[i] is not None)), dtype=np.int64)
+        self.goal_codes = np.array(sorted(set(codes[i] for i in index.goal_ids if codes[i] is not None)), dtype=np.int64)
+
+    def __repr__(self):
+        return "<MeaningCodes: %d entities, %d blocks, %d world codes>" % (self.num_entities, len(self.offsets), len(self.world_codes))
+
+    def block(self, name, arity, add=False):
+        """
+        The first code of the (name, arity) range. Raises OverflowError if adding it would leave the int64 range
+        """
+        key = (name, arity)
+        if key not in self.offsets:
+            if not add:
+                return None
+            size = self.size + self.num_entities ** arity
+            if size > MAX_CODE:
+                raise OverflowError("too many meaning codes for %s/%d" % key)
+            self.offsets[key] = self.size
+            self.size = size
+        return self.offsets[key]
+
+    def in_world(self, codes):
+        return self._members(codes, self.world_codes)
+
+    def is_goal(self, codes):
+        return self._members(codes, self.goal_codes)
+
+    def _members(self, codes, members):
+        """
+        Boolean array of which codes are in the sorted array members
+        """
+        if len(members) == 0:
+            return np.zeros(codes.shape, dtype=bool)
+        found = np.minimum(np.searchsorted(members, codes), len(members) - 1)
+        return members[found] == codes
+
+    def code(self, meaning, add=False):
+        """
+        The code of a meaning, or None if an argument is not a world entity or (unless add) its block is unknown
+        """
+        ids = [self.entity_ids.get(arg) for arg in meaning.meaning_arguments]
+        if None in ids:
+            return None
+        offset = self.block(meaning.meaning_string, len(ids), add=add)
+        if offset is None:
+            return None
+        return offset + sum(i * self.num_entities ** k for k, i in enumerate(ids))
+
+    def bound_codes(self, meaning, positions, bindings):
+        """
+        The codes of a tree meaning under every binding, given the bound object position of each argument
+        and the (binding, position) array of world entity indexes
+        """
+        code = self.block(meaning.meaning_string, len(positions), add=True)
+        for k, i in enumerate(positions):
+            code = code + bindings[:, i] * self.num_entities ** k
+        return code
+
+    def permutations(self, length):
+        """
+        The bindings of length objects as a (binding, object) array of world entity indexes,
+        in the order of SpinalReward.get_possible_bindings
+        """
+        if length not in self._permutations:
+            self._permutations[length] = np.array(list(itertools.permutations(range(self.num_entities), length)), dtype=np.int64).reshape(-1, length)
+        return self._permutations[length]
+
 class SpinalReward(Reward):
     def __init__(self, worldfile, goalfile):
         self.cached = False
@@ -28,27 +201,34 @@ class SpinalReward(Reward):
                     self.relations[argument] = []
                 self.relations[argument].append(meaning)
 
+        self.index = WorldIndex(self.world, self.goals)
+        self.entities_in_goals = set()
+        for goal in self.goals:
+            self.entities_in_goals.update(goal.meaning_arguments)
+
     def _evaluate(self, tree):
         total_possible, max_score = 0.0, float('-inf')
         max_binding = {}
         describes_count = {}
         
-        entities_in_goals = self.get_entities_in_goals()
+        entities_in_goals = self.entities_in_goals
         entities, semantics = tree.fol_semantics()
         semantic_meaning = [SemanticMeaning.parse(s) for s in semantics]
+        semantic_keys = [meaning_key(m) for m in semantic_meaning]
         bindings = self.get_possible_bindings(entities)
 
         for binding, inverse_binding in bindings:
-            binding_meaning = self.mutate_meanings_for_new_assignment(binding, semantic_meaning)
+            binding_meaning = BindingMeanings(self.index, binding, semantic_meaning)
 
             score = 0.0
-            if self.assignment_is_possible(binding_meaning):
-                score += 500 * sum([1 for g in self.goals if self.fulfills_goal(binding_meaning, g)])
-                score += 100 * sum([1 if self.fulfills_goal(binding_meaning, p) else -1 for p in semantic_meaning])
+            if binding_meaning.possible:
+                score += 500 * len(self.index.goal_ids & binding_meaning.ids)
+                score += 100 * sum([1 if k in binding_meaning.keys else -1 for k in semantic_keys])
                 total_possible += 1
 
-            for entity in self.entities:
-                if self.describes(binding_meaning, entity) and entity in inverse_binding:
+            # Entities outside the binding can not be counted, so only bound world entities are checked
+            for entity in inverse_binding:
+                if binding_meaning.describes(self.index, entity):
                     describes_count.setdefault(inverse_binding[entity], set()).add(entity)
 
             if score > max_score:
@@ -61,12 +241,111 @@ class SpinalReward(Reward):
                 else:
                     max_score += 50 / len(describes_count[entity])
 
-        final_val = (max_score / (total_possible or 300.0)) - (0.001 * len(str(tree)))
+        final_val = (max_score / (total_possible or 300.0)) - (0.001 * tree.pformat_length())
         #print(tree, tree.fol_semantics(), final_val)
         return final_val
 
+    def evaluate_many(self, trees):
+        """
+        Scores a batch of trees with the same result as evaluating each one.
+        Trees are still scored one after another; what is vectorized is each tree's loop over its
+        bindings, see _evaluate_codes. Meanings that do not fit MeaningCodes are scored by _evaluate
+        """
+        if getattr(self, '_codes', None) is None:
+            try:
+                self._codes = MeaningCodes(self.index, list(self.entities))
+            except OverflowError:
+                self._codes = False
+        if self._codes is False:
+            return [self._evaluate(tree) for tree in trees]
+
+        scores = []
+        for tree in trees:
+            try:
+                scores.append(self._evaluate_codes(tree))
+            except OverflowError:
+                scores.append(self._evaluate(tree))
+        return scores
+
+    def _evaluate_codes(self, tree):
+        """
+        _evaluate on arrays over the tree's bindings: the bound meanings of every binding are packed codes in a
+        (binding, meaning) array, from which possibility, goal fulfilment, the semantics term and the described
+        entities are computed at once. Only the running maximum over bindings is left as a loop over floats,
+        to keep the scalar path's order of floating point operations
+        """
+        codes = self._codes
+        entities, semantics = tree.fol_semantics()
+        objects = list(entities)
+        semantic_meaning = [SemanticMeaning.parse(s) for s in semantics]
+        length_penalty = 0.001 * tree.pformat_length()
+
+        perm_len = min(len(objects), codes.num_entities)
+        if perm_len == 0:
+            return (float('-inf') / 300.0) - length_penalty
+
+        bindings = codes.permutations(perm_len)
+        rows = np.arange(len(bindings))
+        position = dict((o, i) for i, o in enumerate(objects[:perm_len]))
+
+        # Bound meanings are those whose arguments are all bound, packed per binding
+        kept = [m for m in semantic_meaning if all(arg in position for arg in m.meaning_arguments)]
+        bound = np.empty((len(bindings), len(kept)), dtype=np.int64)
+        for j, meaning in enumerate(kept):
+            bound[:, j] = codes.bound_codes(meaning, [position[arg] for arg in meaning.meaning_arguments], bindings)
+
+        in_world = codes.in_world(bound)
+        possible = in_world.all(axis=1)
+
+        # Bound meanings are a set per binding, so goals are only counted at their first occurrence in a row
+        ordered = np.sort(bound, axis=1)
+        first = np.ones(ordered.shape, dtype=bool)
+        first[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+        goals = (codes.is_goal(ordered) & first).sum(axis=1)
+
+        # +1 for every semantic meaning that is also a bound meaning (when written with world entities), else -1
+        semantic_term = np.zeros(len(bindings), dtype=np.int64)
+        for meaning in semantic_meaning:
+            code = codes.code(meaning)
+            if code is None:
+                semantic_term -= 1
+            else:
+                semantic_term += 2 * (bound == code).any(axis=1) - 1
+
+        scores = np.where(possible, 500.0 * goals + 100.0 * semantic_term, 0.0).tolist()
+        total_possible = float(possible.sum())
+
+        # A world entity is described by a binding unless a bound meaning outside the world mentions it
+        undescribed = np.zeros((len(bindings), codes.num_entities), dtype=bool)
+        for j, meaning in enumerate(kept):
+            for arg in meaning.meaning_arguments:
+                undescribed[rows, bindings[:, position[arg]]] |= ~in_world[:, j]
+
+        # For each goal entity bound as a tree object, the number of world entities it was described as so far
+        goal_counts = []
+        for entity in self.entities_in_goals:
+            if entity not in position:
+                goal_counts.append([0] * len(bindings))
+                continue
+            i = position[entity]
+            described = np.zeros((len(bindings), codes.num_entities), dtype=bool)
+            described[rows, bindings[:, i]] = ~undescribed[rows, bindings[:, i]]
+            goal_counts.append(np.logical_or.accumulate(described, axis=0).sum(axis=1).tolist())
+
+        max_score = float('-inf')
+        for b, score in enumerate(scores):
+            if score > max_score:
+                max_score = score
+            for counts in goal_counts:
+                if counts[b] == 0:
+                    max_score -= 50
+                else:
+                    max_score += 50 / counts[b]
+
+        return (max_score / (total_possible or 300.0)) - length_penalty
+
     def describes(self, meanings, entity):
-        world_entity = set(filter(lambda x: entity in x.meaning_arguments, self.world))
+        world_entity = set(self.index.meanings[i] for i in self.index.entity_facts(entity))
         assignment_entity = set(filter(lambda x: entity in x.meaning_arguments, meanings))
         return assignment_entity <= world_entity
 
@@ -95,14 +374,58 @@ class SpinalReward(Reward):
         return new_meanings
 
     def get_entities_in_goals(self):
-        entity_set = set()
-        for goal in self.goals:
-            entity_set.update(goal.meaning_arguments)
-        return entity_set
+        return set(self.entities_in_goals)
 
     def assignment_is_possible(self, meanings):
-        meaning_set = set(meanings)
-        return meaning_set <= self.world
+        return all(self.index.in_world(meaning_key(m)) for m in meanings)
 
     def fulfills_goal(self, meanings, goal):
-        return goal in set(meanings)
+        if not isinstance(meanings, (set, frozenset)):
+            meanings = set(meanings)
+        return goal in meanings
+
+def check_batch(worlds=3000, num_trees=40, seed=0):
+    """
+    Scores derived trees of the grammar in randomly generated worlds with evaluate and evaluate_many,
+    which must give identical scores
+    """
+    from spinal.spinal_grammar import SpinalGrammar
+    grammar = SpinalGrammar.from_file()
+    rng = random.Random(seed)
+
+    trees = []
+    for _ in range(num_trees):
+        tree = rng.choice(grammar.tree_dict[grammar.start])
+        for _ in range(rng.randint(0, 6)):
+            if tree.terminal_tree():
+                break
+            pos = rng.choice(tree.open_actions())
+            derived = [t for attached in tree.attach_many(grammar.tree_dict[pos][:5]) for t in attached]
+            if len(derived) == 0:
+                break
+            tree = rng.choice(derived)
+        trees.append(tree)
+
+    predicates = [('dog', 1), ('cat', 1), ('man', 1), ('food', 1), ('big', 1), ('run', 1), ('see', 2), ('eat', 2), ('give', 3)]
+    entities = ['x', 'y', 'z', 'w']
+    for w in range(worlds):
+        world = set()
+        for _ in range(rng.randint(1, 6)):
+            name, arity = rng.choice(predicates)
+            world.add("%s(%s)" % (name, ", ".join(rng.sample(entities, arity))))
+        goals = rng.sample(sorted(world), min(2, len(world)))
+        if rng.random() < 0.3:
+            goals.append("see(z, x)")
+        if rng.random() < 0.3:
+            world.add("dog(ARG0)")
+            goals.append("dog(ARG0)")
+
+        reward = SpinalReward(world, goals)
+        scalar = [reward.evaluate(tree) for tree in trees]
+        batch = reward.evaluate_many(trees)
+        assert scalar == batch, (w, sorted(world), goals, [(a, b) for a, b in zip(scalar, batch) if a != b])
+    print("%d worlds x %d trees: evaluate_many equals evaluate" % (worlds, len(trees)))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check_batch()
@@ -0,0 +1,242 @@
+import heapq, itertools, sys, time
+from spinal.spinal_grammar import SpinalGrammar, INFINITY
+from spinal.spinal_state import SpinalState, TranspositionTable
+from spinal.spinal_memory import search_checkpoint
+
+class SearchStats(object):
+    """
+    Counters collected while a search runs, used to report throughput
+    """
+    def __init__(self):
+        self.expansions = 0
+        self.generated = 0
+        self.evaluations = 0
+        self.duplicates = 0
+        self.pruned = 0
+        self.elapsed = 0.0
+
+    def expansions_per_second(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.expansions / self.elapsed
+
+    def __repr__(self):
+        return "<SearchStats: %d expansions, %d generated, %d duplicates, %d pruned, %d evaluations, %.3fs, %.1f expansions/s>" % (
+            self.expansions, self.generated, self.duplicates, self.pruned, self.evaluations, self.elapsed, self.expansions_per_second())
+
+class SpinalSearch(object):
+    """
+    Base class for searches that generate derivations by expanding SpinalStates
+    and scoring them with the state's reward function.
+    If a TranspositionTable is given, states that are the same derived tree as an already
+    generated state are dropped and their values are shared instead of re-evaluated.
+    If the grammar's CompletionTables are given, states that can never become terminal are dropped.
+    on_terminal, if given, is called with (score, state) as each terminal state enters the results,
+    before the search is done; with BeamSearch a better one found later may still push it out
+    """
+    def __init__(self, grammar, reward, k=1, max_expansions=1000, exploration_constant=0.5, transpositions=None, completion=None, on_terminal=None):
+        self.grammar = grammar
+        self.reward = reward
+        self.k = k
+        self.max_expansions = max_expansions
+        self.exploration_constant = exploration_constant
+        self.transpositions = transpositions
+        self.completion = completion
+        self.on_terminal = on_terminal
+        self.stats = SearchStats()
+        self._counter = itertools.count()
+
+    def initial_state(self):
+        return SpinalState(self.exploration_constant, None, self.grammar, self.reward)
+
+    def expand(self, state):
+        """
+        Returns every successor of state: one per initial tree for an empty state,
+        otherwise one per tree produced by attaching each action's tree at each possible location
+        """
+        self.stats.expansions += 1
+        actions = state.actions()
+        if state.tree is None:
+            trees = [action.execute(state.tree) for action in actions]
+        else:
+            trees = [tree for candidate in state.tree.attach_many([action.tree for action in actions]) for tree in candidate]
+
+        children = []
+        for tree in trees:
+            child = SpinalState(state.explorationconstant, tree, state.grammar, state.reward)
+            self.stats.generated += 1
+
+            if self.completion is not None and self.completion.remaining_cost(tree) == INFINITY:
+                self.stats.pruned += 1
+                continue
+
+            if self.transpositions is not None:
+                if child in self.transpositions:
+                    self.stats.duplicates += 1
+                    continue
+                self.transpositions.entry(child)
+
+            children.append(child)
+
+        search_checkpoint(self)
+        return children
+
+    def score(self, state):
+        if self.transpositions is not None:
+            # A hit reuses the stored value; counting it as a visit without its value would dilute the mean
+            entry = self.transpositions.lookup(state)
+            if entry is not None and entry.visits > 0:
+                return entry.value()
+
+        self.stats.evaluations += 1
+        value = state.get_value()
+
+        if self.transpositions is not None:
+            self.transpositions.update(state, value)
+        return value
+
+    def search(self):
+        """
+        Runs the search and returns up to k (score, state) pairs for terminal states, best first
+        """
+        self.stats = SearchStats()
+        start = time.time()
+        try:
+            results = self._search()
+        finally:
+            self.stats.elapsed = time.time() - start
+        return results
+
+    def _search(self):
+        raise NotImplementedError
+
+    def _found(self, score, state):
+        if self.on_terminal is not None:
+            self.on_terminal(score, state)
+
+    def _push_bounded(self, heap, score, state, bound):
+        """
+        Keeps the bound highest scoring states in a min-heap of (score, tiebreak, state).
+        Returns whether state was kept
+        """
+        item = (score, next(self._counter), state)
+        if len(heap) < bound:
+            heapq.heappush(heap, item)
+        elif item[0] > heap[0][0]:
+            heapq.heapreplace(heap, item)
+        else:
+            return False
+        return True
+
+    def _sorted_results(self, heap):
+        return [(score, state) for score, _, state in sorted(heap, reverse=True)]
+
+class BeamSearch(SpinalSearch):
+    """
+    Expands every state of the current beam, then keeps only the beam_width best scoring
+    non-terminal successors for the next step
+    """
+    def __init__(self, grammar, reward, beam_width=10, **kwargs):
+        super(BeamSearch, self).__init__(grammar, reward, **kwargs)
+        self.beam_width = beam_width
+
+    def _search(self):
+        terminals = []
+        beam = [self.initial_state()]
+
+        while len(beam) > 0 and self.stats.expansions < self.max_expansions:
+            next_beam = []
+            for state in beam:
+                if self.stats.expansions >= self.max_expansions:
+                    break
+
+                for child in self.expand(state):
+                    score = self.score(child)
+                    if child.is_terminal():
+                        if self._push_bounded(terminals, score, child, self.k):
+                            self._found(score, child)
+                    else:
+                        self._push_bounded(next_beam, score, child, self.beam_width)
+            beam = [state for _, _, state in next_beam]
+
+        return self._sorted_results(terminals)
+
+class BestFirstSearch(SpinalSearch):
+    """
+    Always expands the best scoring state seen so far. The frontier is a priority queue
+    bounded to max_frontier states; the worst states are dropped when it overflows.
+    With CompletionTables, a state's priority is its score minus heuristic_weight times the
+    lower bound on the actions it needs to become terminal
+    """
+    def __init__(self, grammar, reward, max_frontier=10000, heuristic_weight=0.0, **kwargs):
+        super(BestFirstSearch, self).__init__(grammar, reward, **kwargs)
+        self.max_frontier = max_frontier
+        self.heuristic_weight = heuristic_weight
+
+    def priority(self, state):
+        score = self.score(state)
+        if self.completion is not None and self.heuristic_weight != 0:
+            score -= self.heuristic_weight * self.completion.heuristic(state)
+        return score
+
+    def _search(self):
+        terminals = []
+        # heapq is a min-heap, so priorities are negated to pop the best state first
+        frontier = [(0.0, next(self._counter), self.initial_state())]
+
+        while len(frontier) > 0 and self.stats.expansions < self.max_expansions:
+            neg_priority, _, state = heapq.heappop(frontier)
+
+            if state.is_terminal():
+                # Terminal states need no more actions, so their priority is their score
+                terminals.append((-neg_priority, next(self._counter), state))
+                self._found(-neg_priority, state)
+                if len(terminals) >= self.k:
+                    break
+                continue
+
+            for child in self.expand(state):
+                heapq.heappush(frontier, (-self.priority(child), next(self._counter), child))
+
+            if len(frontier) > 2 * self.max_frontier:
+                frontier = heapq.nsmallest(self.max_frontier, frontier)
+                heapq.heapify(frontier)
+
+        return self._sorted_results(terminals)
+
+def demo():
+    grammar = SpinalGrammar.from_file()
+    world = ["dog(x)", "cat(y)", "see(x, y)"]
+    goals = ["see(x, y)"]
+
+    from spinal.spinal_reward import SpinalReward
+    reward = SpinalReward(world, goals)
+
+    for search in [BeamSearch(grammar, reward, beam_width=5, k=3, max_expansions=200), BestFirstSearch(grammar, reward, k=3, max_expansions=200, transpositions=TranspositionTable(), completion=grammar.completion(), heuristic_weight=0.1)]:
+        results = search.search()
+        print(search.__class__.__name__, search.stats)
+        for score, state in results:
+            print(score, state.sentence())
+
+def check_transpositions():
+    """
+    Scores the same state repeatedly through a TranspositionTable, which must give the same value each time
+    """
+    grammar = SpinalGrammar.from_file()
+    from spinal.spinal_reward import SpinalReward
+    reward = SpinalReward(["dog(x)", "cat(y)", "see(x, y)"], ["see(x, y)"])
+
+    search = BeamSearch(grammar, reward, transpositions=TranspositionTable())
+    state = search.initial_state()
+    while not state.is_terminal():
+        state = search.expand(state)[0]
+    scores = [search.score(state) for _ in range(3)]
+    assert scores[0] == scores[1] == scores[2] == reward.evaluate(state.tree), scores
+    assert search.stats.evaluations == 1, search.stats
+    print("same score %s from %d evaluation" % (scores[0], search.stats.evaluations))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check_transpositions()
+    else:
+        demo()
@@ -0,0 +1,284 @@
+"""
+Long-running generation service. The grammar is loaded once per worker process and kept in memory,
+so requests only pay for their search.
+
+Protocol: one JSON object per line in each direction. A request looks like
+    {"id": 1, "world": ["dog(x)", ...], "goals": ["see(x, y)"], "search": "beam", "k": 3}
+and is answered by {"type": "partial", ...} lines for terminal trees as the search finds them, then one
+{"type": "result", ...} line per generated tree, best first, followed by a {"type": "done", ...} line with the
+request's latency. {"type": "metrics"} returns latency statistics for all requests served so far.
+"""
+
+import argparse, asyncio, itertools, json, multiprocessing, os, socket, threading, time
+from concurrent.futures import ProcessPoolExecutor
+from spinal.spinal_grammar import SpinalGrammar
+from spinal.spinal_search import BeamSearch, BestFirstSearch
+from spinal.spinal_state import TranspositionTable
+
+SEARCHES = {
+    'beam': BeamSearch,
+    'best_first': BestFirstSearch,
+}
+
+SEARCH_OPTIONS = ['k', 'max_expansions', 'beam_width', 'max_frontier', 'exploration_constant']
+
+_grammar = None
+_barrier = None
+_messages = None
+
+def _init_worker(grammar_kwargs, barrier, messages):
+    global _grammar, _barrier, _messages
+    _grammar = SpinalGrammar.from_file(**grammar_kwargs)
+    _barrier = barrier
+    _messages = messages
+
+def _warm_up():
+    """
+    Blocks until one call runs in every worker, so that each has been started and has loaded its grammar
+    """
+    _barrier.wait()
+    return os.getpid()
+
+def _result(score, state):
+    return {
+        'score': score,
+        'sentence': state.sentence(),
+        'leaves': state.tree.leaves(),
+        'semantics': sorted(state.tree.fol_semantics()[1]),
+    }
+
+def _run_search(key, request):
+    """
+    Runs in a worker process: builds the reward for the request's world and goals and searches the warm grammar.
+    The time it was picked up and the terminal trees found along the way are sent back on the message queue
+    under key, which ends with a 'finished' message whether or not the search succeeds
+    """
+    from spinal.spinal_reward import SpinalReward
+
+    start = time.time()
+    _messages.put((key, 'started', start))
+    try:
+        reward = SpinalReward(request.get('world', []), request.get('goals', []))
+        search_cls = SEARCHES[request.get('search', 'beam')]
+        options = dict((k, request[k]) for k in SEARCH_OPTIONS if k in request)
+        if request.get('transpositions', True):
+            options['transpositions'] = TranspositionTable()
+
+        search = search_cls(_grammar, reward, on_terminal=lambda score, state: _messages.put((key, 'partial', _result(score, state))), **options)
+        results = [_result(score, state) for score, state in search.search()]
+    finally:
+        _messages.put((key, 'finished', None))
+
+    return {
+        'results': results,
+        'expansions': search.stats.expansions,
+        'expansions_per_second': search.stats.expansions_per_second(),
+        'search_time': time.time() - start,
+    }
+
+class LatencyMetrics(object):
+    """
+    Keeps the latencies of the most recent requests and summarizes them
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.latencies = []
+        self.count = 0
+        self.errors = 0
+
+    def add(self, latency):
+        self.count += 1
+        self.latencies.append(latency)
+        if len(self.latencies) > self.max_size:
+            self.latencies = self.latencies[-self.max_size:]
+
+    def percentile(self, p):
+        if len(self.latencies) == 0:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean': sum(self.latencies) / len(self.latencies) if len(self.latencies) > 0 else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': max(self.latencies) if len(self.latencies) > 0 else None,
+        }
+
+class GenerationServer(object):
+    """
+    Accepts generation requests concurrently and dispatches their searches to a pool of warm worker processes.
+    Workers report back on a shared queue, which a thread forwards to the requests waiting on the event loop
+    """
+    def __init__(self, workers=None, **grammar_kwargs):
+        self.workers = workers or os.cpu_count()
+        self.grammar_kwargs = grammar_kwargs
+        self.metrics = LatencyMetrics()
+        self.executor = None
+        self.messages = None
+        self.pending = {}
+        self._keys = itertools.count()
+
+    def start_workers(self):
+        context = multiprocessing.get_context()
+        self.messages = context.Queue()
+        barrier = context.Barrier(self.workers)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker, initargs=(self.grammar_kwargs, barrier, self.messages))
+
+        # Each warm-up call waits for all the others, so they run in as many distinct workers,
+        # each started and with its grammar loaded before the first request arrives
+        futures = [self.executor.submit(_warm_up) for _ in range(self.workers)]
+        return set(future.result() for future in futures)
+
+    def stop_workers(self):
+        self.executor.shutdown()
+        self.messages.put(None)
+
+    def forward_messages(self, loop):
+        """
+        Runs in a thread, handing each worker message to the event loop until stop_workers
+        """
+        while True:
+            message = self.messages.get()
+            if message is None:
+                break
+            loop.call_soon_threadsafe(self.dispatch, *message)
+
+    def dispatch(self, key, kind, value):
+        queue = self.pending.get(key)
+        if queue is not None:
+            queue.put_nowait((kind, value))
+
+    async def handle_request(self, request, writer):
+        received = time.time()
+        request_id = request.get('id')
+
+        if request.get('type') == 'metrics':
+            await self.send(writer, {'id': request_id, 'type': 'metrics', 'latency': self.metrics.to_dict()})
+            return
+
+        key = next(self._keys)
+        messages = self.pending[key] = asyncio.Queue()
+        started = None
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, _run_search, key, request)
+            # A worker that dies never sends 'finished'
+            future.add_done_callback(lambda f: f.exception() is not None and messages.put_nowait(('finished', None)))
+
+            while True:
+                kind, value = await messages.get()
+                if kind == 'started':
+                    started = value
+                elif kind == 'partial':
+                    value.update({'id': request_id, 'type': 'partial'})
+                    await self.send(writer, value)
+                elif kind == 'finished':
+                    break
+            output = await future
+        except Exception as e:
+            self.metrics.errors += 1
+            await self.send(writer, {'id': request_id, 'type': 'error', 'error': repr(e)})
+            return
+        finally:
+            del self.pending[key]
+
+        for rank, result in enumerate(output['results']):
+            result.update({'id': request_id, 'type': 'result', 'rank': rank})
+            await self.send(writer, result)
+
+        latency = time.time() - received
+        self.metrics.add(latency)
+        await self.send(writer, {
+            'id': request_id,
+            'type': 'done',
+            'latency': latency,
+            'search_time': output['search_time'],
+            # From accepting the request to a worker picking it up
+            'queue_time': started - received,
+            'expansions': output['expansions'],
+            'expansions_per_second': output['expansions_per_second'],
+        })
+
+    async def send(self, writer, message):
+        writer.write((json.dumps(message) + "\n").encode('utf-8'))
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Every line received is handled as its own task, so one connection can have many requests in flight
+        """
+        tasks = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                await self.send(writer, {'type': 'error', 'error': repr(e)})
+                continue
+
+            task = asyncio.ensure_future(self.handle_request(request, writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks)
+        writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=8765):
+        forwarder = threading.Thread(target=self.forward_messages, args=(asyncio.get_running_loop(),), daemon=True)
+        forwarder.start()
+
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+
+        async with server:
+            await server.serve_forever()
+
+    def run(self, path=None, host='127.0.0.1', port=8765):
+        self.start_workers()
+        try:
+            asyncio.run(self.serve(path=path, host=host, port=port))
+        finally:
+            self.stop_workers()
+
+def request(message, path=None, host='127.0.0.1', port=8765):
+    """
+    Sends a single request to a running server and yields its response lines as they arrive
+    """
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host, port))
+
+    with sock, sock.makefile('rw') as stream:
+        stream.write(json.dumps(message) + "\n")
+        stream.flush()
+        for line in stream:
+            response = json.loads(line)
+            yield response
+            if response['type'] in ('done', 'error', 'metrics'):
+                break
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve generation requests from a grammar held in memory")
+    parser.add_argument('--socket', help="unix socket path; serves on localhost TCP if not given")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--grammar', default="output/compressed_trees.json")
+    args = parser.parse_args()
+
+    server = GenerationServer(workers=args.workers, filename=args.grammar)
+    server.run(path=args.socket, host=args.host, port=args.port)
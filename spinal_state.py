@@ -1,4 +1,7 @@
+import sys
+from collections import OrderedDict
 from spinal.spinal_grammar import SpinalGrammar
+from spinal.spinal_encoding import Derivation
 from state import State
 
 class SpinalState(State):
@@ -17,10 +20,31 @@ class SpinalState(State):
         """
         treeclone = None
         if self.tree is not None:
-            treeclone = self.tree.copy(True)
+            treeclone = self.tree.thaw()
+            # The copy is derived the same way, even when the tree is still a grammar tree itself
+            treeclone._derivation = getattr(self.tree, '_derivation', None) or (self.tree,)
         s = SpinalState(self.explorationconstant, treeclone, self.grammar, self.reward)
         return s
 
+    def derivation(self):
+        """
+        Returns the Derivation of this state's tree against its grammar
+        """
+        return Derivation.from_tree(self.tree, self.grammar)
+
+    def to_bytes(self):
+        """
+        Encodes this state's tree as its derivation, see spinal_encoding
+        """
+        return self.derivation().to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data, exploration_constant, grammar, reward):
+        """
+        Rebuilds a state encoded by to_bytes against the same grammar
+        """
+        return cls(exploration_constant, Derivation.from_bytes(data).replay(grammar), grammar, reward)
+
     def execute_action(self, action_idx):
         """
         Modifies this state's tree by applying the given action
@@ -56,8 +80,13 @@ class SpinalState(State):
 
         sub_actions = []
 
+        # Whether a tree can be attached only depends on its root label, so each POS is checked once
         for pos in self.tree.open_actions():
-            for tree in self.grammar.tree_dict[pos]:
+            trees = self.grammar.tree_dict[pos]
+            if len(trees) == 0 or not self.tree.can_attach(trees[0]):
+                continue
+
+            for tree in trees:
                 sub_actions.append(SubstituteAction(tree))
 
         return sub_actions
@@ -70,7 +99,7 @@ class SpinalState(State):
 
     def sentence(self):
         """
-        Returns the sentence stored by this state's tree
+        Returns the sentence stored by this state's tree, rendered once per tree
         """
         if self.tree is None:
             return ""
@@ -85,12 +114,109 @@ class SpinalState(State):
         else:
             return self.tree.terminal_tree()
 
+    def canonical_hash(self):
+        """
+        Returns a hash that is equal for states whose trees are the same derived tree,
+        regardless of the order of attachments used to reach them
+        """
+        if self.tree is None:
+            return hash(None)
+        return self.tree.canonical_hash()
+
+    def canonical_key(self):
+        """
+        Returns the leaves and remaining rule keys of this state's tree, compared by TranspositionTable
+        to tell states apart whose canonical hashes collide
+        """
+        if self.tree is None:
+            return None
+        return (self.tree.leaf_tuple(), tuple(sorted(rule.key() for rule in self.tree.all_rules())))
+
     def exploration_constant(self):
         return self.explorationconstant
 
     def __repr__(self):
         return "<SpinalState: %s>" % (str(self.tree))
 
+class TranspositionEntry(object):
+    """
+    Visit and value statistics shared by all states with the same canonical hash and key
+    """
+    def __init__(self, key=None):
+        self.key = key
+        self.visits = 0
+        self.total_value = 0.0
+
+    def value(self):
+        if self.visits == 0:
+            return 0.0
+        return self.total_value / self.visits
+
+    def __repr__(self):
+        return "<TranspositionEntry: visits=%d, value=%f>" % (self.visits, self.value())
+
+class TranspositionTable(object):
+    """
+    Bounded map from a state's canonical hash to its merged statistics.
+    Entries also keep the canonical key of their state, so a state whose hash collides with a different
+    state's is not given its statistics. When full, the least recently used entry is evicted
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, state):
+        entry = self.entries.get(state.canonical_hash())
+        return entry is not None and entry.key == state.canonical_key()
+
+    def lookup(self, state):
+        """
+        Returns the entry for state, or None if no equivalent state has been stored
+        """
+        hash_key = state.canonical_hash()
+        entry = self.entries.get(hash_key)
+        if entry is None or entry.key != state.canonical_key():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(hash_key)
+        return entry
+
+    def entry(self, state):
+        """
+        Returns the entry for state, creating it if necessary. The entry of a different state
+        with the same hash is replaced
+        """
+        hash_key = state.canonical_hash()
+        key = state.canonical_key()
+        entry = self.entries.get(hash_key)
+        if entry is None or entry.key != key:
+            entry = TranspositionEntry(key)
+            self.entries[hash_key] = entry
+            self.entries.move_to_end(hash_key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(hash_key)
+        return entry
+
+    def update(self, state, value, visits=1):
+        """
+        Adds a visit with the given value to the statistics shared by state's equivalents
+        """
+        entry = self.entry(state)
+        entry.visits += visits
+        entry.total_value += value
+        return entry
+
+    def __repr__(self):
+        return "<TranspositionTable: %d/%d entries, %d hits, %d misses>" % (len(self.entries), self.max_size, self.hits, self.misses)
+
 class TreeAction(object):
     """
     Stores a tree that can be applied as an action to another tree to generate a new tree
@@ -135,8 +261,35 @@ def demo():
     print(state)
     state.tree.draw()
 
+def check_thaw():
+    """
+    Mutates thawed copies of every grammar tree, and tries to mutate the grammar trees themselves,
+    which must leave the grammar trees unchanged
+    """
+    grammar = SpinalGrammar.from_file()
+    before = [(tree.pformat(), [len(node.rules) for node in tree.subtrees()]) for tree in grammar.trees]
+
+    for tree in grammar.trees:
+        copy = tree.thaw()
+        for node in copy.subtrees():
+            node.rules.append(None)
+            node.rules += [None]
+        copy.append("extra")
+        for node in tree.subtrees():
+            try:
+                node.rules += [None]
+            except TypeError:
+                pass
+
+    after = [(tree.pformat(), [len(node.rules) for node in tree.subtrees()]) for tree in grammar.trees]
+    assert before == after, "mutating thawed copies changed the grammar trees"
+    print("%d grammar trees unchanged" % len(grammar.trees))
+
 if __name__ == "__main__":
-    demo()
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check_thaw()
+    else:
+        demo()
 
 
 
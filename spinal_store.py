@@ -0,0 +1,571 @@
+import pickle
+from array import array
+from collections import defaultdict, deque
+from spinal.ltag_spinal import SpinalLTAG, Rule, ActionLocation, TreeAddress
+
+# Stored in place of None in every id and integer column
+NONE = -1
+
+FOOT = 1
+ATTACHED = 2
+
+# Node attributes that have their own column (or are rebuilt) rather than being kept in extras
+NODE_COLUMNS = set([
+    '_label', '_parent', '_hash', 'rules', 'children', 'foot', 'attached', 'tree_type', 'predicate',
+    'roleset_id', 'semantic_role', 'num_args', 'tree_id', 'parent_id', 'lexicalization_count', 'tree_count',
+    '_leaf_tuple', '_node_count', '_flat_length', '_lengths', '_string', '_spine_index', '_derivation', '_frozen',
+])
+
+# Attributes SpinalLTAG.__init__ sets to None, which only need storing when they are not None
+NODE_INIT_DEFAULTS = set(['parent_attach_id'])
+
+RULE_COLUMNS = set(['rule_type', 'pos', 'action_location', 'semantic_role', 'role_desc'])
+
+class StringTable(object):
+    """
+    Interns strings as integer ids
+    """
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, string):
+        if string is None:
+            return NONE
+        i = self.ids.get(string)
+        if i is None:
+            i = len(self.strings)
+            self.ids[string] = i
+            self.strings.append(string)
+        return i
+
+    def get(self, i):
+        if i == NONE:
+            return None
+        return self.strings[i]
+
+def _int_or_none(value):
+    return NONE if value is None else value
+
+def _none_or_int(value):
+    return None if value == NONE else value
+
+class CompactTreeStore(object):
+    """
+    Stores a set of elementary trees in typed arrays instead of one ParentedTree object per node.
+
+    Every node and leaf of every tree is an entry, numbered in preorder so that each subtree is a
+    contiguous range of entries. Per entry columns hold its label id, parent and node attributes,
+    and the children of entry e are child_entries[child_offsets[e]:child_offsets[e + 1]].
+    Rules are stored in per rule columns, grouped into rule lists; lists shared between trees
+    (as lexicalizations of one tree share theirs) are stored once.
+    Attributes without a column are kept in small per entry dicts.
+
+    TreeView gives read access with the same API as SpinalLTAG; a real SpinalLTAG is only built
+    by materialize(), which views call when copied, attached or drawn.
+    """
+    def __init__(self):
+        self.strings = StringTable()
+
+        # Entry columns
+        self.entry_label = array('i')
+        self.entry_is_leaf = array('b')
+        self.entry_parent = array('i')
+        self.entry_end = array('i')
+        self.child_offsets = array('i', [0])
+        self.child_entries = array('i')
+
+        # Node columns, NONE for leaves
+        self.node_flags = array('b')
+        self.node_rules = array('i')
+        self.node_tree_type = array('i')
+        self.node_predicate = array('i')
+        self.node_roleset_id = array('i')
+        self.node_semantic_role = array('i')
+        self.node_num_args = array('i')
+        self.node_tree_id = array('i')
+        self.node_parent_id = array('i')
+        self.node_lexicalization_count = array('q')
+        self.node_tree_count = array('q')
+        self.node_extras = {}
+
+        # Tree columns
+        self.tree_root = array('i')
+
+        # Rule columns
+        self.rule_list_offsets = array('i', [0])
+        self.rule_type = array('i')
+        self.rule_pos = array('i')
+        self.rule_semantic_role = array('i')
+        self.rule_role_desc = array('i')
+        self.rule_slot = array('i')
+        self.rule_order = array('i')
+        self.rule_treeposition_offsets = array('i', [0])
+        self.rule_treepositions = array('i')
+        self.rule_original_offsets = array('i', [0])
+        self.rule_originals = array('i')
+        self.rule_has_original = array('b')
+        self.rule_extras = {}
+        self._rule_list_ids = {}
+        self._hashes = {}
+
+    def __len__(self):
+        return len(self.tree_root)
+
+    def __getstate__(self):
+        # The rule list ids are only needed while adding trees and refer to the original rule objects
+        state = dict(self.__dict__)
+        state['_rule_list_ids'] = {}
+        # Hashes are salted per process
+        state['_hashes'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_hashes', {})
+
+    def __repr__(self):
+        return "<CompactTreeStore: %d trees, %d entries, %d rules, %d bytes>" % (len(self), len(self.entry_label), len(self.rule_type), self.nbytes())
+
+    @classmethod
+    def from_trees(cls, trees):
+        store = cls()
+        for tree in trees:
+            store.add(tree)
+        return store
+
+    def add(self, tree):
+        """
+        Appends a SpinalLTAG to the store and returns its index
+        """
+        root = len(self.entry_label)
+        self.tree_root.append(root)
+        self._add_entry(tree, NONE)
+
+        # Lay out each entry's children contiguously, in entry order
+        children = defaultdict(list)
+        for entry in range(root + 1, len(self.entry_label)):
+            children[self.entry_parent[entry]].append(entry)
+        for entry in range(root, len(self.entry_label)):
+            self.child_entries.extend(children.get(entry, []))
+            self.child_offsets.append(len(self.child_entries))
+
+        return len(self.tree_root) - 1
+
+    def _add_entry(self, node, parent):
+        entry = len(self.entry_label)
+        self.entry_parent.append(parent)
+        self.entry_end.append(NONE)
+
+        if not isinstance(node, SpinalLTAG):
+            self.entry_label.append(self.strings.intern(node))
+            self.entry_is_leaf.append(1)
+            for column in [self.node_flags, self.node_rules, self.node_tree_type, self.node_predicate, self.node_roleset_id,
+                    self.node_semantic_role, self.node_num_args, self.node_tree_id, self.node_parent_id,
+                    self.node_lexicalization_count, self.node_tree_count]:
+                column.append(NONE)
+            self.entry_end[entry] = entry + 1
+            return entry
+
+        self.entry_label.append(self.strings.intern(node.label()))
+        self.entry_is_leaf.append(0)
+        self.node_flags.append((FOOT if node.foot else 0) | (ATTACHED if node.attached else 0))
+        self.node_rules.append(self._add_rule_list(node.rules))
+        self.node_tree_type.append(self.strings.intern(node.tree_type))
+        self.node_predicate.append(self.strings.intern(node.predicate))
+        self.node_roleset_id.append(self.strings.intern(node.roleset_id))
+        self.node_semantic_role.append(self.strings.intern(node.semantic_role))
+        self.node_num_args.append(_int_or_none(node.num_args))
+        self.node_tree_id.append(_int_or_none(node.tree_id))
+        self.node_parent_id.append(_int_or_none(node.parent_id))
+        self.node_lexicalization_count.append(_int_or_none(getattr(node, 'lexicalization_count', None)))
+        self.node_tree_count.append(_int_or_none(getattr(node, 'tree_count', None)))
+
+        extras = dict((k, v) for k, v in node.__dict__.items() if k not in NODE_COLUMNS and not (k in NODE_INIT_DEFAULTS and v is None))
+        if len(extras) > 0:
+            self.node_extras[entry] = extras
+
+        for child in node:
+            self._add_entry(child, entry)
+        self.entry_end[entry] = len(self.entry_label)
+        return entry
+
+    def _add_rule_list(self, rules):
+        key = id(rules)
+        if key in self._rule_list_ids and self._rule_list_ids[key][1] is rules:
+            return self._rule_list_ids[key][0]
+
+        for rule in rules:
+            self._add_rule(rule)
+        self.rule_list_offsets.append(len(self.rule_type))
+        list_id = len(self.rule_list_offsets) - 2
+        self._rule_list_ids[key] = (list_id, rules)
+        return list_id
+
+    def _add_rule(self, rule):
+        index = len(self.rule_type)
+        loc = rule.action_location
+        self.rule_type.append(self.strings.intern(rule.rule_type))
+        self.rule_pos.append(self.strings.intern(rule.pos))
+        self.rule_semantic_role.append(self.strings.intern(rule.semantic_role))
+        self.rule_role_desc.append(self.strings.intern(rule.role_desc))
+        self.rule_slot.append(loc.slot)
+        self.rule_order.append(loc.order)
+        self.rule_treepositions.extend(loc.treeposition)
+        self.rule_treeposition_offsets.append(len(self.rule_treepositions))
+        if loc.original_treeposition is not None:
+            self.rule_originals.extend(loc.original_treeposition)
+        self.rule_has_original.append(0 if loc.original_treeposition is None else 1)
+        self.rule_original_offsets.append(len(self.rule_originals))
+
+        extras = dict((k, v) for k, v in rule.__dict__.items() if k not in RULE_COLUMNS)
+        if len(extras) > 0:
+            self.rule_extras[index] = extras
+
+    def nbytes(self):
+        """
+        Returns the number of bytes used by the store's arrays
+        """
+        return sum(column.itemsize * len(column) for column in self.__dict__.values() if isinstance(column, array))
+
+    def children(self, entry):
+        return self.child_entries[self.child_offsets[entry]:self.child_offsets[entry + 1]]
+
+    def view(self, index):
+        return TreeView(self, self.tree_root[index])
+
+    def views(self):
+        return [TreeView(self, root) for root in self.tree_root]
+
+    def grammar(self, start_symbol="S", limit=None):
+        """
+        Returns a SpinalGrammar over views of the stored trees
+        """
+        from spinal.spinal_grammar import SpinalGrammar
+        return SpinalGrammar(self.views(), start_symbol, limit=limit)
+
+    def rule_list(self, list_id):
+        return [self.rule(i) for i in range(self.rule_list_offsets[list_id], self.rule_list_offsets[list_id + 1])]
+
+    def rule(self, i):
+        treeposition = TreeAddress(self.rule_treepositions[self.rule_treeposition_offsets[i]:self.rule_treeposition_offsets[i + 1]])
+        original = None
+        if self.rule_has_original[i]:
+            original = TreeAddress(self.rule_originals[self.rule_original_offsets[i]:self.rule_original_offsets[i + 1]])
+
+        loc = ActionLocation(treeposition, self.rule_slot[i], self.rule_order[i], original_treeposition=original)
+        rule = Rule(self.strings.get(self.rule_type[i]), self.strings.get(self.rule_pos[i]), loc,
+                semantic_role=self.strings.get(self.rule_semantic_role[i]), role_desc=self.strings.get(self.rule_role_desc[i]))
+        rule.__dict__.update(self.rule_extras.get(i, {}))
+        return rule
+
+    def rule_key(self, i):
+        """
+        Rule.key() of rule i, without building the Rule
+        """
+        treeposition = tuple(self.rule_treepositions[self.rule_treeposition_offsets[i]:self.rule_treeposition_offsets[i + 1]])
+        return (self.strings.get(self.rule_type[i]), self.strings.get(self.rule_pos[i]), self.strings.get(self.rule_semantic_role[i]),
+                treeposition, self.rule_slot[i], self.rule_order[i])
+
+    def canonical_hash(self, entry):
+        """
+        SpinalLTAG.canonical_hash() of the subtree stored at entry, computed from the columns and cached per entry
+        """
+        value = self._hashes.get(entry)
+        if value is None:
+            child_hashes = tuple(hash(self.strings.get(self.entry_label[c])) if self.entry_is_leaf[c] else self.canonical_hash(c) for c in self.children(entry))
+            list_id = self.node_rules[entry]
+            rule_keys = tuple(sorted(self.rule_key(i) for i in range(self.rule_list_offsets[list_id], self.rule_list_offsets[list_id + 1])))
+            value = hash((self.strings.get(self.entry_label[entry]), bool(self.node_flags[entry] & FOOT), self.strings.get(self.node_predicate[entry]),
+                    self.strings.get(self.node_semantic_role[entry]), rule_keys, child_hashes))
+            self._hashes[entry] = value
+        return value
+
+    def materialize(self, entry):
+        """
+        Builds a SpinalLTAG equal to the subtree stored at entry
+        """
+        children = [self.strings.get(self.entry_label[c]) if self.entry_is_leaf[c] else self.materialize(c) for c in self.children(entry)]
+        flags = self.node_flags[entry]
+        node = SpinalLTAG(
+            self.strings.get(self.entry_label[entry]),
+            children=children,
+            tree_type=self.strings.get(self.node_tree_type[entry]),
+            predicate=self.strings.get(self.node_predicate[entry]),
+            rules=self.rule_list(self.node_rules[entry]),
+            attached=bool(flags & ATTACHED),
+            semantic_role=self.strings.get(self.node_semantic_role[entry]),
+            roleset_id=self.strings.get(self.node_roleset_id[entry]),
+            num_args=_none_or_int(self.node_num_args[entry]),
+            tree_id=_none_or_int(self.node_tree_id[entry]),
+            parent_id=_none_or_int(self.node_parent_id[entry]),
+        )
+        node.foot = bool(flags & FOOT)
+        for attr, column in [('lexicalization_count', self.node_lexicalization_count), ('tree_count', self.node_tree_count)]:
+            if column[entry] != NONE:
+                setattr(node, attr, column[entry])
+        node.__dict__.update(self.node_extras.get(entry, {}))
+        return node
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+class TreeView(object):
+    """
+    Read-only view of one node of a CompactTreeStore with the read API of SpinalLTAG.
+    Attachment checks and hashes are answered from the store; anything that builds trees
+    (copy, attach, draw) works on the view's materialized SpinalLTAG
+    """
+    __slots__ = ('store', 'entry', '_tree')
+
+    def __init__(self, store, entry):
+        self.store = store
+        self.entry = entry
+        self._tree = None
+
+    def __getstate__(self):
+        # The materialized tree is rebuilt on demand
+        return (self.store, self.entry)
+
+    def __setstate__(self, state):
+        self.store, self.entry = state
+        self._tree = None
+
+    def _nodes(self):
+        """
+        Entries of all non-leaf nodes in this subtree, in preorder
+        """
+        store = self.store
+        return [e for e in range(self.entry, store.entry_end[self.entry]) if not store.entry_is_leaf[e]]
+
+    def label(self):
+        return self.store.strings.get(self.store.entry_label[self.entry])
+
+    def __len__(self):
+        return self.store.child_offsets[self.entry + 1] - self.store.child_offsets[self.entry]
+
+    def __iter__(self):
+        for c in self.store.children(self.entry):
+            yield self.store.strings.get(self.store.entry_label[c]) if self.store.entry_is_leaf[c] else TreeView(self.store, c)
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple)):
+            node = self
+            for i in index:
+                node = node[i]
+            return node
+        return list(self)[index]
+
+    def __eq__(self, other):
+        return isinstance(other, TreeView) and self.store is other.store and self.entry == other.entry
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.store), self.entry))
+
+    @property
+    def rules(self):
+        return self.store.rule_list(self.store.node_rules[self.entry])
+
+    @property
+    def foot(self):
+        return bool(self.store.node_flags[self.entry] & FOOT)
+
+    @property
+    def attached(self):
+        return bool(self.store.node_flags[self.entry] & ATTACHED)
+
+    @property
+    def tree_type(self):
+        return self.store.strings.get(self.store.node_tree_type[self.entry])
+
+    @property
+    def predicate(self):
+        return self.store.strings.get(self.store.node_predicate[self.entry])
+
+    @property
+    def roleset_id(self):
+        return self.store.strings.get(self.store.node_roleset_id[self.entry])
+
+    @property
+    def semantic_role(self):
+        return self.store.strings.get(self.store.node_semantic_role[self.entry])
+
+    @property
+    def num_args(self):
+        return _none_or_int(self.store.node_num_args[self.entry])
+
+    @property
+    def tree_id(self):
+        return _none_or_int(self.store.node_tree_id[self.entry])
+
+    @property
+    def parent_id(self):
+        return _none_or_int(self.store.node_parent_id[self.entry])
+
+    @property
+    def lexicalization_count(self):
+        return self._count(self.store.node_lexicalization_count, 'lexicalization_count')
+
+    @property
+    def tree_count(self):
+        return self._count(self.store.node_tree_count, 'tree_count')
+
+    def _count(self, column, attr):
+        if column[self.entry] == NONE:
+            raise AttributeError(attr)
+        return column[self.entry]
+
+    def __getattr__(self, attr):
+        extras = self.store.node_extras.get(self.entry, {})
+        if attr in extras:
+            return extras[attr]
+        elif attr in NODE_INIT_DEFAULTS:
+            return None
+        raise AttributeError(attr)
+
+    def parent(self):
+        parent = self.store.entry_parent[self.entry]
+        return None if parent == NONE else TreeView(self.store, parent)
+
+    def root(self):
+        node = self
+        while node.parent() is not None:
+            node = node.parent()
+        return node
+
+    def treeposition(self):
+        position = []
+        node = self
+        while node.parent() is not None:
+            parent = node.parent()
+            position.append(list(self.store.children(parent.entry)).index(node.entry))
+            node = parent
+        return tuple(reversed(position))
+
+    def leaves(self):
+        store = self.store
+        return [store.strings.get(store.entry_label[e]) for e in range(self.entry, store.entry_end[self.entry]) if store.entry_is_leaf[e]]
+
+    def all_rules(self):
+        return [rule for e in self._nodes() for rule in TreeView(self.store, e).rules]
+
+    def applicable_rules(self):
+        return SpinalLTAG.applicable_rules(self)
+
+    def all_applicable_rules(self):
+        return [rule for e in self._nodes() for rule in TreeView(self.store, e).applicable_rules()]
+
+    def terminal_tree(self):
+        store = self.store
+        return all(store.rule_list_offsets[store.node_rules[e]] == store.rule_list_offsets[store.node_rules[e] + 1] for e in self._nodes())
+
+    def open_actions(self):
+        return list(set([r.pos for r in self.all_applicable_rules()]))
+
+    def pos_rule_dict(self):
+        return SpinalLTAG.pos_rule_dict(self)
+
+    def pos_set(self):
+        store = self.store
+        pos = set()
+        for e in self._nodes():
+            pos.add(store.strings.get(store.entry_label[e]))
+            for i in range(store.rule_list_offsets[store.node_rules[e]], store.rule_list_offsets[store.node_rules[e] + 1]):
+                pos.add(store.strings.get(store.rule_pos[i]))
+        return pos
+
+    def spine_index(self):
+        store = self.store
+        count = 0
+        for c in store.children(self.entry):
+            if store.entry_is_leaf[c] or not store.node_flags[c] & ATTACHED:
+                return count
+            count += 1
+        assert False
+
+    def attachment_index(self, rule, spine_index=None):
+        return SpinalLTAG.attachment_index(self, rule, spine_index)
+
+    def _feasible_locations(self, label):
+        """
+        SpinalLTAG._feasible_locations over the stored entries. Rules are only built for nodes that
+        have a rule for label, and nothing is materialized
+        """
+        store = self.store
+        pos = store.strings.ids.get(label)
+        if pos is None:
+            return
+
+        queue = deque([self.entry])
+        while len(queue) > 0:
+            entry = queue.popleft()
+            queue.extend(c for c in store.children(entry) if not store.entry_is_leaf[c])
+
+            list_id = store.node_rules[entry]
+            if pos not in store.rule_pos[store.rule_list_offsets[list_id]:store.rule_list_offsets[list_id + 1]]:
+                continue
+
+            current = TreeView(store, entry)
+            spine_index = current.spine_index()
+            for rule in current.applicable_rules():
+                if rule.pos == label and current.attachment_index(rule, spine_index) is not None:
+                    yield current, rule
+
+    def feasible_locations(self, att_tree):
+        return list(self._feasible_locations(att_tree.label()))
+
+    def can_attach(self, att_tree):
+        return next(self._feasible_locations(att_tree.label()), None) is not None
+
+    def canonical_hash(self):
+        return self.store.canonical_hash(self.entry)
+
+    def materialize(self):
+        """
+        The SpinalLTAG this view stands for, built once per view and frozen, since every view shares it
+        """
+        if self._tree is None:
+            self._tree = self.store.materialize(self.entry).freeze_in_place()
+        return self._tree
+
+    def copy(self, deep=False):
+        return self.materialize().thaw()
+
+    def thaw(self):
+        return self.materialize().thaw()
+
+    def attach(self, att_tree):
+        return self.materialize().attach(att_tree)
+
+    def attach_at(self, att_tree, treeposition, rule):
+        return self.materialize().attach_at(att_tree, treeposition, rule)
+
+    def attach_many(self, att_trees, lazy=False):
+        return self.materialize().attach_many(att_trees, lazy=lazy)
+
+    def amr_semantics(self):
+        return self.materialize().amr_semantics()
+
+    def fol_semantics(self):
+        return self.materialize().fol_semantics()
+
+    def draw(self):
+        return self.materialize().draw()
+
+    def __str__(self):
+        return str(self.materialize())
+
+    def __repr__(self):
+        return "<TreeView: %s>" % str(self)
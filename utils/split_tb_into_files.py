@@ -1,4 +1,4 @@
-import re, sys
+import os, re, sys
 
 def split_treebank(treebank_dir="/Users/piffle/Desktop/spinalapi/spinalapi/ltagtb/", output_dir='trees/'):
     filenames = [
@@ -12,7 +12,7 @@ def split_treebank(treebank_dir="/Users/piffle/Desktop/spinalapi/spinalapi/ltagt
     tree_end = "^\s$"
 
     for filename in filenames:
-        with open(directory + filename) as f:
+        with open(os.path.join(treebank_dir, filename)) as f:
             tree = []
             for line in f:
                 m_begin = re.search(tree_begin, line)
@@ -21,7 +21,7 @@ def split_treebank(treebank_dir="/Users/piffle/Desktop/spinalapi/spinalapi/ltagt
                 if m_begin:
                     tree = [line]
                 elif m_end:
-                    output_file = 'trees/' + tree[0].replace(" ", "_").strip() + ".txt"
+                    output_file = os.path.join(output_dir, tree[0].replace(" ", "_").strip() + ".txt")
                     with open(output_file, 'w') as f:
                         f.write(''.join(tree))
                     tree = []